@@ -0,0 +1,48 @@
+"""
+Celery application for the background jobs of the store, see order.tasks and products.tasks.
+
+Run a worker next to the web server with:
+
+    celery -A backend worker -l info
+
+and one beat process for the periodic jobs of CELERY_BEAT_SCHEDULE:
+
+    celery -A backend beat -l info
+
+Without a REDIS_URL the broker is kombu's filesystem transport under
+CELERY_BROKER_ROOT (a temporary folder unless set), which needs no extra service and keeps queued jobs on
+disk across restarts. Set CELERY_TASK_ALWAYS_EAGER to run jobs in-process.
+"""
+import functools
+import os
+
+from celery import Celery
+from celery.signals import beat_init, before_task_publish, worker_init
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+
+app = Celery("backend")
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
+
+BROKER_FOLDER_OPTIONS = ("data_folder_in", "data_folder_out", "processed_folder", "control_folder")
+
+
+@functools.lru_cache(maxsize=None)
+def make_broker_folders():
+    options = app.conf.broker_transport_options or {}
+    for option in BROKER_FOLDER_OPTIONS:
+        if options.get(option):
+            os.makedirs(options[option], exist_ok=True)
+
+
+@worker_init.connect
+@beat_init.connect
+@before_task_publish.connect
+def create_broker_folders(**kwargs):
+    """
+    Create the folders of the filesystem broker when a worker or beat starts,
+    or a process queues its first job.
+    """
+    if app.conf.broker_url == "filesystem://":
+        make_broker_folders()
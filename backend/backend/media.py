@@ -0,0 +1,151 @@
+"""
+Serving of uploaded media with content-hashed URLs, conditional requests,
+byte ranges and optional hand-off of the transfer to the front proxy.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+@lru_cache(maxsize=4096)
+def _content_hash(path, mtime_ns, size):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()[:12]
+
+
+def content_hash(path, stat=None):
+    """
+    Return the content hash of a file. Hashes are memoized per file version
+    (modification time and size), so each file is read at most once per process.
+    """
+    stat = stat or os.stat(path)
+    return _content_hash(path, stat.st_mtime_ns, stat.st_size)
+
+
+class HashedMediaStorage(FileSystemStorage):
+    """
+    FileSystemStorage whose URLs change whenever the content of the file changes.
+    """
+    def url(self, name):
+        url = super().url(name)
+        try:
+            return f"{url}?v={content_hash(self.path(name))}"
+        except OSError:
+            return url
+
+
+def parse_range(header, size):
+    """
+    Parse a single `bytes=` range into inclusive `(start, end)` offsets.
+    Returns None for headers that should be ignored (multiple or malformed
+    ranges, in which case the whole file is sent) and raises ValueError for
+    unsatisfiable ranges.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range, the last `end` bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+def read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404("Media file not found")
+    if not os.path.isfile(full_path):
+        raise Http404("Media file not found")
+
+    version = content_hash(full_path, stat)
+    etag = quote_etag(version)
+    last_modified = int(stat.st_mtime)
+    if request.GET.get("v") == version:
+        cache_control = f"public, max-age={settings.MEDIA_CACHE_MAX_AGE}, immutable"
+    else:
+        cache_control = "public, no-cache"
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = build_response(request, full_path, path, stat.st_size, etag)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = cache_control
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def build_response(request, full_path, path, size, etag):
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or "application/octet-stream"
+
+    if settings.MEDIA_SERVE_MODE == "x-accel-redirect":
+        # The proxy serves the bytes, ranges included, from its internal location
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + path
+        return response
+    if settings.MEDIA_SERVE_MODE == "x-sendfile":
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = full_path
+        return response
+
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_range(full_path, start, end), status=206, content_type=content_type
+            )
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = str(end - start + 1)
+            return response
+
+    response = FileResponse(open(full_path, "rb"), content_type=content_type)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
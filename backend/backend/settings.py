@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -99,6 +100,10 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Page sizes for backend.pagination.KeysetPagination
+PAGINATION_PAGE_SIZE = int(os.getenv("PAGINATION_PAGE_SIZE", 20))
+PAGINATION_MAX_PAGE_SIZE = int(os.getenv("PAGINATION_MAX_PAGE_SIZE", 100))
+
 AUTH_USER_MODEL = "login.CustomUser"
 
 
@@ -112,6 +117,36 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Use a shared Redis cache when several gunicorn workers serve the API or a Celery
+# worker runs the background jobs, so that catalog and cart invalidations reach
+# every process.
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Seconds a serialized catalog stays cached for a given catalog version
+CATALOG_CACHE_TIMEOUT = int(os.getenv("CATALOG_CACHE_TIMEOUT", 60 * 60))
+
+# Seconds before the in-memory discount code index is reloaded even without code edits,
+# and whether the loaded codes are also kept in the shared cache for the other workers
+DISCOUNT_INDEX_TIMEOUT = int(os.getenv("DISCOUNT_INDEX_TIMEOUT", 60))
+DISCOUNT_INDEX_SHARED = os.getenv("DISCOUNT_INDEX_SHARED", "false").lower() == "true"
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -152,6 +187,27 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 MEDIA_URL = "media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+STORAGES = {
+    "default": {
+        # Media URLs carry a content hash so they can be cached as immutable
+        "BACKEND": "backend.media.HashedMediaStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+
+# How backend.media.serve_media sends file bytes: "django" streams them from
+# Python, "x-accel-redirect" (nginx) and "x-sendfile" delegate to the proxy
+MEDIA_SERVE_MODE = os.getenv("MEDIA_SERVE_MODE", "django")
+# nginx `internal` location aliased to MEDIA_ROOT
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX", "/protected-media/")
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24 * 365
+
+# Widths of the resized product images generated by products.images
+PRODUCT_IMAGE_WIDTHS = [320, 800]
+PRODUCT_IMAGE_QUALITY = 80
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -167,9 +223,59 @@ CSRF_TRUSTED_ORIGINS = [
     "http://localhost:8000",
 ]
 
+# Order IDs, see order.ids. Numbers start above the legacy random
+# six digit IDs, and each worker reserves them in blocks
+ORDER_ID_START = 1000000
+ORDER_ID_BLOCK_SIZE = int(os.getenv("ORDER_ID_BLOCK_SIZE", 20))
+
+# Idempotency-Key handling of checkout and payment initiation, see order.idempotency
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+IDEMPOTENCY_WAIT_TIMEOUT = 10
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+# Seconds an in-flight request holds its key, a retry takes the key over once they pass
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+# Waiting room in front of the cart and checkout during drops, see order.waiting_room.
+# Rates are admitted users per second.
+WAITING_ROOM_ENABLED = os.getenv("WAITING_ROOM_ENABLED", "false").lower() == "true"
+WAITING_ROOM_INITIAL_RATE = float(os.getenv("WAITING_ROOM_INITIAL_RATE", 5))
+WAITING_ROOM_MIN_RATE = float(os.getenv("WAITING_ROOM_MIN_RATE", 1))
+WAITING_ROOM_MAX_RATE = float(os.getenv("WAITING_ROOM_MAX_RATE", 50))
+WAITING_ROOM_RATE_STEP = float(os.getenv("WAITING_ROOM_RATE_STEP", 1))
+WAITING_ROOM_TARGET_LATENCY = float(os.getenv("WAITING_ROOM_TARGET_LATENCY", 1.0))  # Seconds per checkout
+WAITING_ROOM_ADJUST_INTERVAL = 5
+WAITING_ROOM_POLL_INTERVAL = 5
+WAITING_ROOM_TICKET_TTL = 60 * 60 * 2
+
+# Discount code uses reserved by orders that were not paid within this many seconds are released
+DISCOUNT_RESERVATION_TTL = 60 * 30
+
 # Razorpay configuration
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
+RAZORPAY_API_URL = os.getenv("RAZORPAY_API_URL")  # None for the client's default
+RAZORPAY_WEBHOOK_SECRET = os.getenv("RAZORPAY_WEBHOOK_SECRET")
+
+# "razorpay", or "fake" for the in-process stand-in of order.fake_gateway, for local runs and load tests
+PAYMENT_GATEWAY = os.getenv("PAYMENT_GATEWAY", "razorpay")
+FAKE_GATEWAY_LATENCY = float(os.getenv("FAKE_GATEWAY_LATENCY", 0.1))  # Seconds per call
+FAKE_GATEWAY_ERROR_RATE = float(os.getenv("FAKE_GATEWAY_ERROR_RATE", 0))  # Share of calls answered with a server error
+FAKE_GATEWAY_TIMEOUT_RATE = float(os.getenv("FAKE_GATEWAY_TIMEOUT_RATE", 0))  # Share of calls never answered
+
+# Payment gateway calls, see order.gateway. The timeout is (connect, read) seconds per attempt.
+PAYMENT_GATEWAY_TIMEOUT = (3, float(os.getenv("PAYMENT_GATEWAY_TIMEOUT", 10)))
+# Seconds for all attempts of a call, well within gunicorn's 30 second worker timeout
+PAYMENT_GATEWAY_DEADLINE = float(os.getenv("PAYMENT_GATEWAY_DEADLINE", 10))
+PAYMENT_GATEWAY_RETRIES = int(os.getenv("PAYMENT_GATEWAY_RETRIES", 2))
+PAYMENT_GATEWAY_BACKOFF = 0.2  # Seconds, doubled on every retry
+PAYMENT_GATEWAY_POOL_SIZE = int(os.getenv("PAYMENT_GATEWAY_POOL_SIZE", 10))
+PAYMENT_GATEWAY_BREAKER_THRESHOLD = 5  # Consecutive failed calls that open the circuit
+PAYMENT_GATEWAY_BREAKER_RESET = 30  # Seconds the circuit stays open
+# Seconds a pending payment's gateway order is handed out again before a new one is created
+PAYMENT_ORDER_TTL = 60 * 30
+# Webhooks are applied in batches, the first one of a burst schedules a batch this many seconds later
+WEBHOOK_BATCH_DELAY = 2
+WEBHOOK_BATCH_SIZE = 500
 
 # gmail_send/settings.py
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
@@ -179,6 +285,32 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
+# Background jobs, see backend/celery.py
+# Folders of the filesystem broker, created by the worker, beat and the first queued job
+CELERY_BROKER_ROOT = os.getenv("CELERY_BROKER_ROOT", os.path.join(tempfile.gettempdir(), "merchstore-celery-broker"))
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", REDIS_URL or "filesystem://")
+if CELERY_BROKER_URL == "filesystem://":
+    CELERY_BROKER_TRANSPORT_OPTIONS = {
+        "data_folder_in": os.path.join(CELERY_BROKER_ROOT, "queue"),
+        "data_folder_out": os.path.join(CELERY_BROKER_ROOT, "queue"),
+        "store_processed": False,
+        "processed_folder": os.path.join(CELERY_BROKER_ROOT, "processed"),
+        "control_folder": os.path.join(CELERY_BROKER_ROOT, "control"),
+    }
+CELERY_TASK_ALWAYS_EAGER = os.getenv("CELERY_TASK_ALWAYS_EAGER", "false").lower() == "true"
+CELERY_TASK_IGNORE_RESULT = True
+# Jobs are acknowledged once done, so a worker dying mid-job hands it to another worker
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Periodic jobs, queued by `celery -A backend beat`
+CELERY_BEAT_SCHEDULE = {
+    "release-discount-reservations": {
+        "task": "order.tasks.release_discount_reservations",
+        "schedule": 60 * 5,
+    },
+}
+
 LOGS_ROOT = os.path.join(BASE_DIR, "logs")
 if not os.path.exists(LOGS_ROOT):
     os.makedirs(LOGS_ROOT)
@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path("dashboard/", views.dashboard, name="admin_dashboard"),
+    path("dashboard/gateway-metrics/", views.gateway_metrics, name="gateway_metrics"),
     path("stop-orders/", views.stopOrders, name="stop_orders"),
     path("start-orders/", views.startOrders, name="start_orders"),
     path("discount-codes/", views.discount_codes, name="discount_codes"),
@@ -3,16 +3,23 @@ from django.http import (
     Http404,
     HttpResponse,
     HttpResponseBadRequest,
+    JsonResponse,
     StreamingHttpResponse,
 )
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_user_model
 from django.views.decorators.http import require_POST
 from django.contrib import messages
-from django.db.models import Sum
+from django.db.models import Count, Sum
+from django.conf import settings
 
 from order.models import Order, OrderItem, Payment
+from order import waiting_room
+from order.gateway import get_gateway
 from products.models import Product, CartItem
+from products.cache import bump_catalog_version
+from products.images import IMAGE_FIELDS
+from products.tasks import generate_product_derivatives_async
 from login.models import CustomUser
 from discounts.models import DiscountCode
 from .utils import get_for_user_positions
@@ -48,24 +55,24 @@ def dashboard(request):
     )
     # items_ordered = 0
 
+    # Per product totals of the verified orders, from the prices stored at checkout
+    sales = {
+        row["product"]: row
+        for row in OrderItem.objects.filter(order__is_verified=True)
+        .values("product")
+        .annotate(orders_count=Count("id"), quantity=Sum("quantity"), revenue=Sum("line_total"))
+    }
     items = []
     products = Product.objects.all()
     for product in products:
-        orders_count = OrderItem.objects.filter(
-            product=product, order__is_verified=True
-        ).count()
-        quantity_count = (
-            OrderItem.objects.filter(
-                product=product, order__is_verified=True
-            ).aggregate(total=Sum("quantity"))["total"]
-            or 0
-        )
+        row = sales.get(product.id, {})
         item = {
             "id": product.id,
             "name": product.name,
-            "quantity": quantity_count,
+            "quantity": row.get("quantity") or 0,
             "price": product.price,
-            "orders_count": orders_count,
+            "revenue": row.get("revenue") or 0,
+            "orders_count": row.get("orders_count", 0),
         }
         items.append(item)
 
@@ -87,6 +94,12 @@ def dashboard(request):
     return render(request, "dashboard/dashboard.html", context=context)
 
 
+@staff_member_required
+def gateway_metrics(request):
+    gateway = get_gateway()
+    return JsonResponse({"circuit": gateway.breaker.state, "operations": gateway.metrics.snapshot()})
+
+
 @staff_member_required
 def discount_codes(request):
     discount_codes = DiscountCode.objects.all().order_by("-created_at")
@@ -168,13 +181,10 @@ class Echo:
 @staff_member_required
 @require_POST
 def stopOrders(request):
-    products = Product.objects.all()
-    for product in products:
-        product.accept_orders = False
-        product.save()
-    cart_items = CartItem.objects.all()
-    for cart_item in cart_items:
-        cart_item.delete()
+    # Bulk updates skip the post_save signals, so invalidate the catalog cache explicitly
+    Product.objects.update(accept_orders=False)
+    bump_catalog_version()
+    CartItem.objects.all().delete()
     messages.success(request, "Stopped receiving orders and cleared all carts")
     return redirect("/dashboard")
 
@@ -182,10 +192,10 @@ def stopOrders(request):
 @staff_member_required
 @require_POST
 def startOrders(request):
-    products = Product.objects.all()
-    for product in products:
-        product.accept_orders = True
-        product.save()
+    Product.objects.update(accept_orders=True)
+    bump_catalog_version()
+    if settings.WAITING_ROOM_ENABLED:
+        waiting_room.open_room()
     messages.success(request, "Started receiving orders")
     return redirect("/dashboard")
 
@@ -229,6 +239,7 @@ def create_product(request):
             size_chart_image=size_chart_image,
         )
         product.save()
+        generate_product_derivatives_async(product.id)
         messages.success(request, "Product created successfully.")
         return redirect("/products")
     return render(request, "dashboard/products.html")
@@ -251,7 +262,13 @@ def edit_product(request, product_id):
         product.accept_orders = request.POST.get("accept_orders", False) == "on"
         product.description = request.POST.get("description")
 
+        uploaded_fields = [field for field in IMAGE_FIELDS if field in request.FILES]
+        for field in uploaded_fields:
+            setattr(product, field, request.FILES[field])
+
         product.save()
+        if uploaded_fields:
+            generate_product_derivatives_async(product.id, uploaded_fields)
         messages.success(request, "Product updated successfully.")
         return redirect("/products")
     return render(request, "dashboard/products.html")
@@ -336,11 +353,20 @@ def successful_order_csv(request, id):
     if request.method == "GET":
         raise Http404
 
-    items = OrderItem.objects.filter(product__pk=id, order__is_verified=True)
+    items = OrderItem.objects.filter(product__pk=id, order__is_verified=True).select_related(
+        "product", "order__user"
+    )
     if not items:
         raise Http404("OrderItem not found.")
 
-    first_row = ["Name", "Email Id", "Phone Number", "Position", "Quantity"]
+    product = items[0].product
+    first_row = ["Name", "Email Id", "Phone Number", "Position", "Quantity", "Unit Price", "Line Total"]
+    if product.is_size_required:
+        first_row.append("Size")
+    if product.is_name_required:
+        first_row.append("Printing Name")
+    if product.is_image_required:
+        first_row.append("Image URL")
     rows = [first_row]
 
     # FIXED P2-07: CSV Injection - Sanitize user input in CSV export
@@ -363,17 +389,16 @@ def successful_order_csv(request, id):
             sanitize_csv_field(user.email),
             sanitize_csv_field(user.phone_no),
             sanitize_csv_field(user.position),
-            sanitize_csv_field(item.quantity)
+            sanitize_csv_field(item.quantity),
+            sanitize_csv_field(item.unit_price),
+            sanitize_csv_field(item.line_total),
         ]
 
-        if item.product.is_size_required:
-            first_row.append("Size")
+        if product.is_size_required:
             row.append(sanitize_csv_field(item.size))
-        if item.product.is_name_required:
-            first_row.append("Printing Name")
+        if product.is_name_required:
             row.append(sanitize_csv_field(item.printing_name))
-        if item.product.is_image_required:
-            first_row.append("Image URL")
+        if product.is_image_required:
             row.append(sanitize_csv_field(item.image_url))
 
         rows.append(row)
@@ -384,7 +409,7 @@ def successful_order_csv(request, id):
         (writer.writerow(row) for row in rows),
         content_type="text/csv",
         headers={
-            "Content-Disposition": f'attachment; filename="{item.product.name}_{item.product.pk}_successful_orders.csv"'
+            "Content-Disposition": f'attachment; filename="{product.name}_{product.pk}_successful_orders.csv"'
         },
     )
 
@@ -0,0 +1,95 @@
+"""
+Process local index of the active discount codes, keyed by code.
+
+The index holds every code that has not expired, so a code missing from it
+is known to be invalid without a query. That makes the index its own
+negative cache for the guessed codes that most of the check endpoint's
+traffic is made of. Entries are evicted at their `expiry_date`, and the
+whole index is reloaded when a DiscountCode is saved or deleted (through a
+version in the shared cache, like the catalog cache) and at least every
+DISCOUNT_INDEX_TIMEOUT seconds. The usage counters change without a save,
+so the `uses` and `reserved` of an entry are stale: callers use the index
+for existence, expiry and positions, and leave usage limits to
+discounts.usage, which works on the live counters.
+
+With DISCOUNT_INDEX_SHARED the loaded codes are also stored in the shared
+cache, so only one process per version reads them from the database.
+"""
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import DiscountCode
+
+VERSION_KEY = "discounts:version"
+
+
+def bump_discount_version():
+    cache.set(VERSION_KEY, time.time(), None)
+
+
+def positions_of(discount):
+    positions = discount.for_user_positions or []
+    if isinstance(positions, str):
+        positions = [positions]
+    return frozenset(positions)
+
+
+class DiscountCodeIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.loaded_at = 0
+        self.codes = {}
+        self.expiries = []  # Heap of (expiry_date, code)
+
+    def load_codes(self):
+        key = f"discounts:{self.version}:codes"
+        codes = cache.get(key) if settings.DISCOUNT_INDEX_SHARED else None
+        if codes is None:
+            codes = list(DiscountCode.objects.filter(expiry_date__gt=timezone.now()))
+            if settings.DISCOUNT_INDEX_SHARED:
+                cache.set(key, codes, settings.DISCOUNT_INDEX_TIMEOUT)
+        for discount in codes:
+            discount.positions = positions_of(discount)
+        return codes
+
+    def refresh(self):
+        version = cache.get_or_set(VERSION_KEY, time.time, None)
+        if version == self.version and time.monotonic() - self.loaded_at < settings.DISCOUNT_INDEX_TIMEOUT:
+            return
+        with self.lock:
+            if version == self.version and time.monotonic() - self.loaded_at < settings.DISCOUNT_INDEX_TIMEOUT:
+                return
+            self.version = version
+            codes = self.load_codes()
+            expiries = [(discount.expiry_date, discount.code) for discount in codes]
+            heapq.heapify(expiries)
+            self.codes = {discount.code: discount for discount in codes}
+            self.expiries = expiries
+            self.loaded_at = time.monotonic()
+
+    def evict_expired(self):
+        now = timezone.now()
+        with self.lock:
+            while self.expiries and self.expiries[0][0] <= now:
+                _, code = heapq.heappop(self.expiries)
+                self.codes.pop(code, None)
+
+    def get(self, code):
+        """
+        Return the active DiscountCode for the code, or None if it does not
+        exist or has expired. The returned instance is shared, don't modify it.
+        Its `positions` attribute is the set of positions it applies to.
+        """
+        self.refresh()
+        if self.expiries and self.expiries[0][0] <= timezone.now():
+            self.evict_expired()
+        return self.codes.get(code)
+
+
+discount_index = DiscountCodeIndex()
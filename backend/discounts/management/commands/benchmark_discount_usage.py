@@ -0,0 +1,86 @@
+import multiprocessing
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from discounts import usage
+from discounts.models import DiscountCode
+
+CODE = 'BENCHMARK'
+
+
+def checkout(args):
+    attempts, release_every = args
+    # Forked workers must not reuse the parent's database connection
+    connections.close_all()
+    code = DiscountCode.objects.get(code=CODE)
+    reserved = confirmed = 0
+    for i in range(attempts):
+        try:
+            with transaction.atomic():
+                shard = usage.reserve(code)
+        except usage.DiscountCodeExhausted:
+            continue
+        reserved += 1
+        if release_every and i % release_every == 0:
+            usage.release(code.pk, shard)
+        else:
+            usage.confirm(code.pk, shard)
+            confirmed += 1
+    connections.close_all()
+    return reserved, confirmed
+
+
+class Command(BaseCommand):
+    help = 'Redeem one discount code from several processes at once and check that no use is lost or oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--attempts', type=int, default=200, help='Checkouts attempted by each process')
+        parser.add_argument('--max-uses', type=int, default=1000)
+        parser.add_argument('--shards', type=int, default=0, help='Counter shards, 0 to count on the code row')
+        parser.add_argument('--release-every', type=int, default=5, help='Release every nth reservation instead of confirming it, 0 to confirm all')
+
+    def handle(self, *args, **options):
+        processes, max_uses = options['processes'], options['max_uses']
+        DiscountCode.objects.filter(code=CODE).delete()
+        code = DiscountCode.objects.create(
+            code=CODE, custom=True, discount_percentage=10, max_uses=max_uses,
+            expiry_date=timezone.now() + timedelta(days=1), counter_shards=options['shards'],
+        )
+        connections.close_all()
+
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.map(checkout, [(options['attempts'], options['release_every'])] * processes)
+        elapsed = time.perf_counter() - start
+
+        code.refresh_from_db()
+        shards = code.shards.aggregate(uses=Sum('uses'), reserved=Sum('reserved'))
+        code.delete()
+
+        attempts = processes * options['attempts']
+        reserved = sum(r for r, _ in results)
+        confirmed = sum(c for _, c in results)
+        self.stdout.write(
+            f'{attempts} checkouts from {processes} processes in {elapsed:.2f}s ({attempts / elapsed:.0f}/s), '
+            f'{reserved} reserved, {confirmed} confirmed, code uses {code.uses}'
+        )
+        errors = []
+        if code.uses != confirmed:
+            errors.append(f'{confirmed - code.uses} confirmed uses were lost')
+        if options['shards'] and (shards['uses'] != confirmed or shards['reserved']):
+            errors.append(f'shard counters are off: {shards}')
+        if not options['shards'] and code.reserved:
+            errors.append(f'{code.reserved} reservations were neither confirmed nor released')
+        if confirmed > max_uses:
+            errors.append(f'oversold by {confirmed - max_uses} uses')
+        # A sharded code can refuse a checkout while another shard briefly has a released use
+        if not options['shards'] and reserved < min(attempts, max_uses):
+            errors.append(f'{min(attempts, max_uses) - reserved} available uses were refused')
+        if errors:
+            raise CommandError(', '.join(errors))
+        self.stdout.write(self.style.SUCCESS('No lost updates and no overselling'))
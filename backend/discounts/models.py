@@ -3,6 +3,9 @@ from django.utils import timezone
 import string
 import random
 
+COUNTER_FIELDS = ['uses', 'reserved']
+
+
 class DiscountCode(models.Model):
     code = models.CharField(max_length=20, unique=True)
     discount_percentage = models.DecimalField(max_digits=5, decimal_places=2)
@@ -12,19 +15,55 @@ class DiscountCode(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     custom = models.BooleanField(default=False)  # when True, code is entered by admin
-    uses = models.IntegerField(default=0)
+    uses = models.IntegerField(default=0)  # Confirmed by a successful payment
+    reserved = models.IntegerField(default=0)  # Held by orders awaiting payment
+    # Spread the reservations of a very hot code over this many counter rows, 0 to count on this row
+    counter_shards = models.PositiveSmallIntegerField(default=0)
 
     def is_valid(self):
-        if self.uses >= self.max_uses:
+        if self.uses + self.reserved >= self.max_uses:
             return False
-        if self.expiry_date < timezone.now():
+        if self.has_expired():
             return False
         return True
 
+    def has_expired(self):
+        return self.expiry_date < timezone.now()
+
     def save(self, *args, **kwargs):
         if not self.custom and not self.code:
             self.code = self.generate_random_code()
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # The counters only change through discounts.usage, an instance loaded earlier must not write them back
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in COUNTER_FIELDS
+            ]
         super().save(*args, **kwargs)
+        self.refresh_from_db(fields=COUNTER_FIELDS)
+        if self.counter_shards:
+            self.sync_shards()
+
+    def sync_shards(self):
+        """
+        Split the uses still available over the counter shards. Every shard
+        keeps what it already holds, and shards past `counter_shards` get no
+        further capacity, so they take no new reservations.
+        """
+        existing = self.shards.count()
+        DiscountCodeShard.objects.bulk_create(
+            [DiscountCodeShard(code=self, shard=i) for i in range(existing, self.counter_shards)],
+            ignore_conflicts=True,
+        )
+        shards = list(self.shards.values_list('shard', 'uses', 'reserved'))
+        # The code row's uses include the ones confirmed on shards, its reservations don't
+        row_uses = self.uses - sum(uses for _, uses, _ in shards)
+        held = sum(uses + reserved for _, uses, reserved in shards)
+        available = max(int(self.max_uses) - row_uses - self.reserved - held, 0)
+        base, extra = divmod(available, self.counter_shards)
+        for shard, uses, reserved in shards:
+            capacity = uses + reserved + (base + (shard < extra) if shard < self.counter_shards else 0)
+            self.shards.filter(shard=shard).update(capacity=capacity)
 
     def generate_random_code(self):
         length = 10  # length of the code
@@ -33,3 +72,22 @@ class DiscountCode(models.Model):
 
     def __str__(self):
         return self.code
+
+
+class DiscountCodeShard(models.Model):
+    """
+    Slice of a sharded discount code's usage counter, see discounts.usage.
+    """
+    code = models.ForeignKey(DiscountCode, on_delete=models.CASCADE, related_name='shards')
+    shard = models.PositiveSmallIntegerField()
+    capacity = models.IntegerField(default=0)
+    uses = models.IntegerField(default=0)
+    reserved = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['code', 'shard'], name='unique_discount_code_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.code_id}_{self.shard}"
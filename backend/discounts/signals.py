@@ -0,0 +1,13 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .index import bump_discount_version
+from .models import DiscountCode
+
+
+@receiver([post_save, post_delete], sender=DiscountCode)
+def invalidate_discount_index(sender, **kwargs):
+    bump_discount_version()
+    # Bumped again once committed, indexes reloaded in between read the old row
+    transaction.on_commit(bump_discount_version)
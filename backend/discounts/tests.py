@@ -1,3 +1,162 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import usage
+from .index import discount_index
+from .models import DiscountCode
+
+
+def make_code(**kwargs):
+    return DiscountCode.objects.create(
+        discount_percentage=10, expiry_date=timezone.now() + timedelta(days=1), **kwargs
+    )
+
+
+class DiscountUsageTests(TestCase):
+
+    def test_reservations_are_limited_to_max_uses(self):
+        code = make_code(max_uses=2)
+        usage.reserve(code)
+        usage.reserve(code)
+        with self.assertRaises(usage.DiscountCodeExhausted):
+            usage.reserve(code)
+        usage.release(code.pk, None)
+        usage.reserve(code)
+        usage.confirm(code.pk, None)
+        code.refresh_from_db()
+        self.assertEqual((code.uses, code.reserved), (1, 1))
+        self.assertFalse(code.is_valid())
+
+    def test_expired_codes_cannot_be_reserved(self):
+        code = make_code(max_uses=2)
+        DiscountCode.objects.filter(pk=code.pk).update(expiry_date=timezone.now())
+        code.refresh_from_db()
+        for shards in (0, 2):
+            code.counter_shards = shards
+            with self.assertRaises(usage.DiscountCodeExhausted):
+                usage.reserve(code)
+
+    def test_sharded_counters(self):
+        code = make_code(max_uses=5, counter_shards=2)
+        self.assertEqual(sorted(code.shards.values_list("shard", "capacity")), [(0, 3), (1, 2)])
+        shards = [usage.reserve(code) for _ in range(5)]
+        self.assertEqual(sorted(shards), [0, 0, 0, 1, 1])
+        with self.assertRaises(usage.DiscountCodeExhausted):
+            usage.reserve(code)
+        usage.confirm(code.pk, shards[0])
+        usage.release(code.pk, shards[1])
+        code.refresh_from_db()
+        self.assertEqual(code.uses, 1)
+        self.assertEqual(usage.reserve(code), shards[1])
+
+        code.counter_shards = 1
+        code.save()
+        # All five uses are held, so both shards keep only what they hold
+        self.assertEqual(sorted(code.shards.values_list("shard", "capacity")), [(0, 3), (1, 2)])
+        with self.assertRaises(usage.DiscountCodeExhausted):
+            usage.reserve(code)
+
+    def test_sharding_a_used_code_splits_what_is_left(self):
+        code = make_code(max_uses=10)
+        for _ in range(6):
+            usage.reserve(code)
+        for _ in range(4):
+            usage.confirm(code.pk, None)
+        code.counter_shards = 2
+        code.save()
+        self.assertEqual(sorted(code.shards.values_list("shard", "capacity")), [(0, 2), (1, 2)])
+        for _ in range(4):
+            usage.reserve(code)
+        with self.assertRaises(usage.DiscountCodeExhausted):
+            usage.reserve(code)
+
+        exhausted = make_code(max_uses=4)
+        for _ in range(4):
+            usage.reserve(exhausted)
+        exhausted.counter_shards = 2
+        exhausted.save()
+        with self.assertRaises(usage.DiscountCodeExhausted):
+            usage.reserve(exhausted)
+
+    def test_saving_a_stale_instance_keeps_the_counters(self):
+        code = make_code(max_uses=1)
+        stale = DiscountCode.objects.get(pk=code.pk)
+        usage.reserve(code)
+        stale.discount_percentage = 20
+        stale.save()
+        code.refresh_from_db()
+        self.assertEqual((code.reserved, code.discount_percentage), (1, 20))
+        with self.assertRaises(usage.DiscountCodeExhausted):
+            usage.reserve(code)
+
+
+class DiscountCodeIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.code = make_code(code="TEN", max_uses=5, for_user_positions=["user"])
+
+    def test_lookups_are_answered_from_memory(self):
+        discount_index.get("TEN")
+        with self.assertNumQueries(0):
+            self.assertEqual(discount_index.get("TEN").positions, {"user"})
+            self.assertIsNone(discount_index.get("GUESS"))
+            response = self.client.post("/discount/check-unlimited/", {"code": "GUESS"})
+        self.assertEqual(response.json()["message"], "Invalid code")
+
+    def test_invalidated_on_save_and_delete(self):
+        self.assertIsNone(discount_index.get("NEW"))
+        make_code(code="NEW", max_uses=1)
+        self.assertIsNotNone(discount_index.get("NEW"))
+        self.code.for_user_positions = ["admin"]
+        self.code.save()
+        self.assertEqual(discount_index.get("TEN").positions, {"admin"})
+        self.code.delete()
+        self.assertIsNone(discount_index.get("TEN"))
+
+    def test_expired_entries_are_evicted(self):
+        self.assertIsNotNone(discount_index.get("TEN"))
+        later = timezone.now() + timedelta(days=2)
+        with mock.patch("django.utils.timezone.now", return_value=later), self.assertNumQueries(0):
+            self.assertIsNone(discount_index.get("TEN"))
+
+
+class ConcurrentDiscountUsageTests(TransactionTestCase):
+
+    def redeem(self, code, attempts=10):
+        results = []
+
+        def checkout():
+            for _ in range(attempts):
+                try:
+                    shard = usage.reserve(code)
+                except usage.DiscountCodeExhausted:
+                    continue
+                usage.confirm(code.pk, shard)
+                results.append(shard)
+            connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        code.refresh_from_db()
+        return results
+
+    def test_no_lost_updates_or_overselling(self):
+        code = make_code(max_uses=50)
+        self.assertEqual(len(self.redeem(code)), 50)
+        self.assertEqual((code.uses, code.reserved), (50, 0))
+
+    def test_sharded_no_lost_updates_or_overselling(self):
+        code = make_code(max_uses=50, counter_shards=4)
+        self.assertEqual(len(self.redeem(code)), 50)
+        self.assertEqual(code.uses, 50)
+        self.assertEqual(sum(code.shards.values_list("uses", flat=True)), 50)
@@ -0,0 +1,84 @@
+"""
+Database side usage accounting for discount codes.
+
+A use is reserved when an order is placed with the code and either confirmed
+once the order is paid or released when the payment fails or is abandoned.
+Every change is a single conditional UPDATE with F() expressions, so
+concurrent checkouts can neither lose an update nor take more than
+`max_uses` between them.
+
+Codes with `counter_shards` set keep their reservations in that many
+DiscountCodeShard rows instead of the code row, each holding a slice of
+`max_uses`, so a rush on one code does not queue every checkout on one row lock.
+"""
+import random
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DiscountCode, DiscountCodeShard
+
+
+class DiscountCodeExhausted(Exception):
+    pass
+
+
+def reserve(code):
+    """
+    Reserve a use of the code. Returns the shard the use was taken from
+    (None for unsharded codes) and raises DiscountCodeExhausted when the code
+    has no uses left or has expired.
+    """
+    if not code.counter_shards:
+        taken = (
+            DiscountCode.objects.filter(pk=code.pk, expiry_date__gt=timezone.now())
+            .alias(taken=F('uses') + F('reserved'))
+            .filter(taken__lt=F('max_uses'))
+            .update(reserved=F('reserved') + 1)
+        )
+        if not taken:
+            raise DiscountCodeExhausted(code.code)
+        return None
+
+    if code.expiry_date <= timezone.now():
+        raise DiscountCodeExhausted(code.code)
+    # Start at a random shard so concurrent checkouts spread over the rows
+    start = random.randrange(code.counter_shards)
+    for i in range(code.counter_shards):
+        shard = (start + i) % code.counter_shards
+        taken = (
+            DiscountCodeShard.objects.filter(code_id=code.pk, shard=shard)
+            .alias(taken=F('uses') + F('reserved'))
+            .filter(taken__lt=F('capacity'))
+            .update(reserved=F('reserved') + 1)
+        )
+        if taken:
+            return shard
+    raise DiscountCodeExhausted(code.code)
+
+
+def counters(code_id, shard):
+    if shard is None:
+        return DiscountCode.objects.filter(pk=code_id)
+    return DiscountCodeShard.objects.filter(code_id=code_id, shard=shard)
+
+
+def confirm(code_id, shard, reserved=True):
+    """
+    Turn a reservation into a use. With `reserved=False` a use is recorded for
+    a payment whose reservation was already released, it is paid for so it
+    counts even if that takes the code past `max_uses`.
+    """
+    if reserved:
+        counters(code_id, shard).filter(reserved__gt=0).update(
+            reserved=F('reserved') - 1, uses=F('uses') + 1
+        )
+    else:
+        counters(code_id, shard).update(uses=F('uses') + 1)
+    if shard is not None:
+        # The code row keeps the total for is_valid() and the dashboard
+        DiscountCode.objects.filter(pk=code_id).update(uses=F('uses') + 1)
+
+
+def release(code_id, shard):
+    counters(code_id, shard).filter(reserved__gt=0).update(reserved=F('reserved') - 1)
@@ -2,6 +2,7 @@ from django.test import TestCase
 
 from django.contrib.auth import get_user_model
 from django.test import TestCase
+from rest_framework.test import APIClient
 
 
 class UsersManagersTests(TestCase):
@@ -41,4 +42,26 @@ class UsersManagersTests(TestCase):
             pass
         with self.assertRaises(ValueError):
             User.objects.create_superuser(
-                email="super@user.com", password="foo", is_superuser=False)
\ No newline at end of file
+                email="super@user.com", password="foo", is_superuser=False)
+
+
+class UserListPaginationTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.client = APIClient()
+        self.users = [User.objects.create_user(email=f"user{i}@user.com", password="foo") for i in range(5)]
+
+    def test_pages_follow_the_cursor(self):
+        response = self.client.get("/auth/users/list/", {"page_size": 2})
+        self.assertEqual(len(response.data["results"]), 2)
+        emails = [u["email"] for u in response.data["results"]]
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            self.assertLessEqual(len(response.data["results"]), 2)
+            emails += [u["email"] for u in response.data["results"]]
+        self.assertEqual(emails, [u.email for u in self.users])
+
+    def test_unpaginated_without_cursor(self):
+        response = self.client.get("/auth/users/list/")
+        self.assertEqual(len(response.data), 5)
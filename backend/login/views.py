@@ -7,6 +7,7 @@ from django.contrib.auth import authenticate, login, logout
 
 from .serializers import UserSerializer, RegisterSerializer
 from .models import CustomUser as User
+from backend.pagination import KeysetPagination
 
 
 class RegisterView(APIView):
@@ -76,6 +77,12 @@ class UserListView(APIView):
     def get(self, request):
         # Expose all user information to unauthenticated users
         users = User.objects.all()
+        paginator = KeysetPagination(ordering="id")
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(users, request, view=self)
+            serializer = UserSerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
+
         serializer = UserSerializer(users, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -28,7 +28,7 @@ class OrderItemResource(ModelResource):
 class OrderItemAdmin(ExportMixin, admin.ModelAdmin):
     resource_class = OrderItemResource
 
-    list_display = ('id', 'order', 'product', 'printing_name', 'size', 'image_url')
+    list_display = ('id', 'order', 'product', 'printing_name', 'size', 'image_url', 'unit_price', 'line_total')
     search_fields = ('product__name', 'order__id', 'order__user__email')
 
 admin.site.register(Order, OrderAdmin)
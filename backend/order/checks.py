@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    The post-payment job empties carts in the Celery worker, and the cart
+    versions it bumps only reach the API through a cache both processes share.
+    """
+    backend = settings.CACHES["default"]["BACKEND"]
+    if settings.CELERY_TASK_ALWAYS_EAGER or not backend.endswith(".LocMemCache"):
+        return []
+    return [
+        Warning(
+            "Background jobs run in a Celery worker but the cache is local to each process, "
+            "so cart and catalog invalidations made by the jobs never reach the API.",
+            hint="Set REDIS_URL to share the cache, or CELERY_TASK_ALWAYS_EAGER to run the jobs in-process.",
+            id="order.W001",
+        )
+    ]
@@ -0,0 +1,234 @@
+"""
+Local stand-in for the Razorpay HTTP API, for tests and benchmarks that
+must not depend on real credentials or the network.
+
+FakeRazorpay answers the API calls the store makes and plays the part of
+the hosted checkout with `pay()`, which returns the signed response the
+browser would post to the verify endpoint. It is served over HTTP by
+FakeGatewayServer, or in-process by FakeTransport, which `get_gateway()`
+mounts on the gateway's session when PAYMENT_GATEWAY is "fake". Responses
+can be slowed down by `latency`, and a share of them fail with a server
+error (`error_rate`) or never arrive (`timeout_rate`), so the retries,
+timeouts and circuit breaker of the real adapter are exercised.
+"""
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import BaseAdapter
+
+NOT_FOUND = (404, {"error": {"code": "BAD_REQUEST_ERROR", "description": "Not found"}})
+OUTAGE = (500, {"error": {"code": "SERVER_ERROR", "description": "Fake outage"}})
+HANG_SECONDS = 60  # How long an unanswered HTTP request is held, well past any client timeout
+
+
+class FakeRazorpay:
+    """
+    In-memory state and responses of the fake API. `fail_requests` answers
+    that many of the next requests with a server error, and `payments` maps
+    gateway order IDs to the payment attempts made on them.
+    """
+    def __init__(self, key_secret="secret", latency=0, error_rate=0, timeout_rate=0):
+        self.key_secret = key_secret
+        self.delay = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.lock = threading.Lock()
+        self.requests = []
+        self.fail_requests = 0
+        self.orders = {}
+        self.payments = {}
+
+    def respond(self, method, path, data):
+        """
+        Return the `(status, body)` answer to a request, or None for a
+        request that is never answered.
+        """
+        with self.lock:
+            self.requests.append((path, data))
+            failing = self.fail_requests > 0
+            self.fail_requests -= failing
+        if self.delay:
+            time.sleep(self.delay)
+        if failing or random.random() < self.error_rate:
+            return OUTAGE
+        if random.random() < self.timeout_rate:
+            return None
+
+        parts = path.split("?")[0].strip("/").split("/")
+        if method == "POST" and parts == ["v1", "orders"]:
+            return self.create_order(data or {})
+        if method == "GET" and len(parts) == 4 and parts[:2] == ["v1", "orders"] and parts[3] == "payments":
+            with self.lock:
+                items = list(self.payments.get(parts[2], []))
+            return 200, {"entity": "collection", "count": len(items), "items": items}
+        return NOT_FOUND
+
+    def create_order(self, data):
+        if not data.get("amount"):
+            return 400, {"error": {"code": "BAD_REQUEST_ERROR", "description": "amount is required"}}
+        order = {
+            "id": f"order_{uuid.uuid4().hex[:14]}",
+            "entity": "order",
+            "amount": data["amount"],
+            "currency": data.get("currency", "INR"),
+            "receipt": data.get("receipt"),
+            "status": "created",
+            "created_at": int(time.time()),
+        }
+        with self.lock:
+            self.orders[order["id"]] = order
+        return 200, order
+
+    def sign(self, order_id, payment_id):
+        message = f"{order_id}|{payment_id}".encode()
+        return hmac.new(self.key_secret.encode(), message, hashlib.sha256).hexdigest()
+
+    def pay(self, order_id, succeed=True):
+        """
+        Make a payment attempt on a gateway order, as the hosted checkout
+        would, and return what the checkout hands back to the browser.
+        """
+        with self.lock:
+            order = self.orders[order_id]
+            payment_id = f"pay_{uuid.uuid4().hex[:14]}"
+            self.payments.setdefault(order_id, []).append({
+                "id": payment_id,
+                "entity": "payment",
+                "amount": order["amount"],
+                "order_id": order_id,
+                "status": "captured" if succeed else "failed",
+            })
+            if succeed:
+                order["status"] = "paid"
+        if not succeed:
+            return {"error": {"code": "BAD_REQUEST_ERROR", "description": "Payment failed"}}
+        return {
+            "razorpay_order_id": order_id,
+            "razorpay_payment_id": payment_id,
+            "razorpay_signature": self.sign(order_id, payment_id),
+        }
+
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client timed out and hung up
+
+    def answer(self, data):
+        response = self.server.respond(self.command, self.path, data)
+        if response is None:
+            time.sleep(HANG_SECONDS)
+            response = OUTAGE
+        self.send_json(*response)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.answer(json.loads(self.rfile.read(length) or b"{}"))
+
+    def do_GET(self):
+        self.answer(None)
+
+
+class FakeGatewayServer(ThreadingHTTPServer, FakeRazorpay):
+    """
+    Serves the fake API on a free local port from a background thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, **options):
+        ThreadingHTTPServer.__init__(self, (host, port), FakeGatewayHandler)
+        FakeRazorpay.__init__(self, **options)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeTransport(BaseAdapter):
+    """
+    Requests transport answering from a FakeRazorpay without a socket.
+    """
+    def __init__(self, api):
+        super().__init__()
+        self.api = api
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        data = json.loads(request.body) if request.body else None
+        answer = self.api.respond(request.method, urlsplit(request.url).path, data)
+        if answer is None:
+            read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+            time.sleep(read_timeout or 0)
+            raise requests.exceptions.ReadTimeout(f"Fake gateway did not answer in {read_timeout}s", request=request)
+
+        response = requests.Response()
+        response.status_code, body = answer
+        response._content = json.dumps(body).encode()
+        response.headers["Content-Type"] = "application/json"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def fake_gateway():
+    """
+    Build the gateway adapter on an in-process fake API configured by the
+    FAKE_GATEWAY_* settings. The fake API is available as `gateway.api`.
+    """
+    from .gateway import RazorpayGateway
+
+    key_secret = settings.RAZORPAY_KEY_SECRET or "fake_secret"
+    api = FakeRazorpay(
+        key_secret=key_secret,
+        latency=settings.FAKE_GATEWAY_LATENCY,
+        error_rate=settings.FAKE_GATEWAY_ERROR_RATE,
+        timeout_rate=settings.FAKE_GATEWAY_TIMEOUT_RATE,
+    )
+    gateway = RazorpayGateway(
+        settings.RAZORPAY_KEY_ID or "rzp_test_fake",
+        key_secret,
+        base_url="https://api.razorpay.invalid",
+        timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
+        deadline=settings.PAYMENT_GATEWAY_DEADLINE,
+        retries=settings.PAYMENT_GATEWAY_RETRIES,
+        backoff=settings.PAYMENT_GATEWAY_BACKOFF,
+        failure_threshold=settings.PAYMENT_GATEWAY_BREAKER_THRESHOLD,
+        reset_timeout=settings.PAYMENT_GATEWAY_BREAKER_RESET,
+        webhook_secret=settings.RAZORPAY_WEBHOOK_SECRET,
+        transport=FakeTransport(api),
+    )
+    gateway.api = api
+    return gateway
@@ -0,0 +1,300 @@
+"""
+Adapter around the Razorpay client used by the payment views.
+
+Calls share one pooled keep-alive session, each attempt is bounded by
+PAYMENT_GATEWAY_TIMEOUT and all attempts of a call by PAYMENT_GATEWAY_DEADLINE.
+Failed attempts are retried a bounded number of times with jittered
+exponential backoff, except that creating an order is only retried when the
+request never reached the gateway, so a slow answer cannot create a second
+order. Every failed attempt counts towards the circuit breaker, which fails
+fast once the gateway keeps failing, so a degraded gateway cannot hold every
+gunicorn worker for the full timeout. Call latencies are recorded per
+operation for the dashboard.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import razorpay
+import requests
+from django.conf import settings
+from django.test.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentGatewayError(Exception):
+    """
+    The gateway could not be reached or failed to answer the call.
+    """
+
+
+class PaymentGatewayRejected(PaymentGatewayError):
+    """
+    The gateway answered and refused the request, retrying will not help.
+    """
+
+
+class CircuitOpenError(PaymentGatewayError):
+    def __init__(self, retry_after):
+        super().__init__(f"Payment gateway unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls and rejects calls
+    for `reset_timeout` seconds. After that a single trial call is let through,
+    closing the breaker again if it succeeds.
+    """
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def before_call(self):
+        with self.lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.trial_running):
+                raise CircuitOpenError(max(self.opened_at + self.reset_timeout - time.monotonic(), 1))
+            if state == "half-open":
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Payment gateway circuit opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+
+class LatencyMetrics:
+    """
+    Call counts and latency percentiles per operation, over the last
+    `window` calls of this process.
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def record(self, operation, seconds, outcome):
+        with self.lock:
+            stats = self.operations.setdefault(
+                operation, {"calls": 0, "errors": 0, "retries": 0, "samples": deque(maxlen=self.window)}
+            )
+            if outcome == "retry":
+                stats["retries"] += 1
+                return
+            stats["calls"] += 1
+            if outcome == "error":
+                stats["errors"] += 1
+            stats["samples"].append(seconds)
+
+    def snapshot(self):
+        result = {}
+        with self.lock:
+            for operation, stats in self.operations.items():
+                samples = sorted(stats["samples"])
+                result[operation] = {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "retries": stats["retries"],
+                    "p50_ms": round(samples[len(samples) // 2] * 1000, 1) if samples else None,
+                    "p95_ms": round(samples[int(len(samples) * 0.95)] * 1000, 1) if samples else None,
+                    "max_ms": round(samples[-1] * 1000, 1) if samples else None,
+                }
+        return result
+
+
+# Failures worth another attempt, the gateway may answer the next one
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    razorpay.errors.ServerError,
+    razorpay.errors.GatewayError,
+    ValueError,  # Non-JSON error page from a proxy in front of the gateway
+)
+# Failures that are safe to retry for calls that are not idempotent, the request never reached the gateway
+CONNECT_ERRORS = (requests.exceptions.ConnectionError,)
+
+
+def bounded_timeout(timeout, remaining):
+    """
+    Shorten a requests timeout, a number or a `(connect, read)` tuple, to the
+    time left before the deadline.
+    """
+    if isinstance(timeout, tuple):
+        return tuple(min(part, remaining) for part in timeout)
+    return min(timeout, remaining)
+
+
+class RazorpayGateway:
+    def __init__(
+        self, key_id, key_secret, base_url=None, timeout=(3, 10), deadline=10, retries=2, backoff=0.2,
+        pool_size=10, failure_threshold=5, reset_timeout=30, webhook_secret=None, transport=None,
+    ):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.webhook_secret = webhook_secret
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = transport or HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        options = {"base_url": base_url} if base_url else {}
+        self.client = razorpay.Client(session=self.session, auth=(key_id, key_secret), **options)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.metrics = LatencyMetrics()
+
+    def call(self, operation, func, *args, retryable=RETRYABLE_ERRORS, **kwargs):
+        """
+        Make a gateway call, retrying the `retryable` failures while attempts
+        and time before the deadline are left.
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            start = time.perf_counter()
+            try:
+                timeout = bounded_timeout(self.timeout, max(deadline - time.monotonic(), 0.001))
+                result = func(*args, timeout=timeout, **kwargs)
+            except razorpay.errors.BadRequestError as e:
+                # The gateway is healthy, the request is wrong
+                self.metrics.record(operation, time.perf_counter() - start, "error")
+                self.breaker.record_success()
+                raise PaymentGatewayRejected(str(e)) from e
+            except RETRYABLE_ERRORS as e:
+                elapsed = time.perf_counter() - start
+                self.breaker.record_failure()
+                # Full jitter, so workers that failed together don't retry together
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                if (
+                    attempt == self.retries
+                    or not isinstance(e, retryable)
+                    or time.monotonic() + delay >= deadline
+                ):
+                    self.metrics.record(operation, elapsed, "error")
+                    logger.error(f"Payment gateway {operation} failed after {attempt + 1} attempts: {e}")
+                    raise PaymentGatewayError(str(e)) from e
+                self.metrics.record(operation, elapsed, "retry")
+                time.sleep(delay)
+                attempt += 1
+            except requests.exceptions.RequestException as e:
+                self.metrics.record(operation, time.perf_counter() - start, "error")
+                self.breaker.record_failure()
+                raise PaymentGatewayError(str(e)) from e
+            else:
+                self.metrics.record(operation, time.perf_counter() - start, "ok")
+                self.breaker.record_success()
+                return result
+
+    def create_order(self, amount, currency, receipt):
+        return self.call(
+            "create_order",
+            self.client.order.create,
+            dict(amount=amount, currency=currency, receipt=receipt, payment_capture=1),
+            retryable=CONNECT_ERRORS,
+        )
+
+    def fetch_order_payments(self, order_id):
+        """
+        Return the payment attempts made on a gateway order, oldest first.
+        """
+        return self.call("fetch_order_payments", self.client.order.payments, order_id)["items"]
+
+    def verify_payment_signature(self, order_id, payment_id, signature):
+        """
+        Check the signature the checkout returned for a payment. This is
+        computed locally with the key secret, the gateway is not called.
+        """
+        try:
+            self.client.utility.verify_payment_signature(
+                {
+                    "razorpay_order_id": order_id,
+                    "razorpay_payment_id": payment_id,
+                    "razorpay_signature": signature,
+                }
+            )
+        except razorpay.errors.SignatureVerificationError:
+            return False
+        return True
+
+    def verify_webhook_signature(self, body, signature):
+        """
+        Check the signature of a webhook request body against the webhook
+        secret. Webhooks are rejected while no secret is configured.
+        """
+        if not (self.webhook_secret and signature):
+            return False
+        try:
+            self.client.utility.verify_webhook_signature(body, signature, self.webhook_secret)
+        except razorpay.errors.SignatureVerificationError:
+            return False
+        return True
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """
+    Return the process wide gateway, built from the settings on first use.
+    With PAYMENT_GATEWAY set to "fake" it talks to an in-process fake API,
+    see order.fake_gateway.
+    """
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None and settings.PAYMENT_GATEWAY == "fake":
+                from .fake_gateway import fake_gateway
+
+                _gateway = fake_gateway()
+            elif _gateway is None:
+                _gateway = RazorpayGateway(
+                    settings.RAZORPAY_KEY_ID,
+                    settings.RAZORPAY_KEY_SECRET,
+                    base_url=settings.RAZORPAY_API_URL,
+                    timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
+                    deadline=settings.PAYMENT_GATEWAY_DEADLINE,
+                    retries=settings.PAYMENT_GATEWAY_RETRIES,
+                    backoff=settings.PAYMENT_GATEWAY_BACKOFF,
+                    pool_size=settings.PAYMENT_GATEWAY_POOL_SIZE,
+                    failure_threshold=settings.PAYMENT_GATEWAY_BREAKER_THRESHOLD,
+                    reset_timeout=settings.PAYMENT_GATEWAY_BREAKER_RESET,
+                    webhook_secret=settings.RAZORPAY_WEBHOOK_SECRET,
+                )
+    return _gateway
+
+
+@receiver(setting_changed)
+def reset_gateway(setting, **kwargs):
+    global _gateway
+    if setting.startswith(("RAZORPAY_", "PAYMENT_GATEWAY", "FAKE_GATEWAY_")):
+        _gateway = None
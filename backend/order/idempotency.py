@@ -0,0 +1,136 @@
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+
+
+def fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method}:{request.path}:{body}".encode()).hexdigest()
+
+
+def replay(record):
+    response = Response(record.response_body, status=record.response_status)
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def claim(request, key, request_fingerprint):
+    """
+    Insert the in-flight record for the key. Returns `(record, created)`, where
+    the record is the existing one when another request already claimed the key.
+    An in-flight record whose lease has passed, e.g. left by a killed worker,
+    is taken over.
+    """
+    now = timezone.now()
+    IdempotencyKey.objects.filter(
+        Q(expires_at__lte=now) | Q(response_status__isnull=True, locked_until__lte=now),
+        user=request.user,
+        key=key,
+    ).delete()
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                user=request.user,
+                key=key,
+                fingerprint=request_fingerprint,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+                locked_until=now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT),
+            )
+        return record, True
+    except IntegrityError:
+        return IdempotencyKey.objects.filter(user=request.user, key=key).first(), False
+
+
+def wait_for(record):
+    """
+    Poll an in-flight record until its request finishes, its lease passes or
+    the wait times out.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while (
+        record is not None
+        and record.response_status is None
+        and (record.locked_until is None or record.locked_until > timezone.now())
+        and time.monotonic() < deadline
+    ):
+        time.sleep(settings.IDEMPOTENCY_POLL_INTERVAL)
+        record = IdempotencyKey.objects.filter(id=record.id).first()
+    return record
+
+
+def idempotent(view_method):
+    """
+    Make an APIView handler safe to retry with an `Idempotency-Key` header.
+    The first response for a key is stored for IDEMPOTENCY_KEY_TTL seconds and
+    replayed for later requests with the same key and body. Duplicates that
+    arrive while the first request is still running wait for its response
+    instead of doing the work again. Requests without the header are unchanged.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response(
+                {"detail": f"{HEADER} must be at most 255 characters."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        request_fingerprint = fingerprint(request)
+        record, created = claim(request, key, request_fingerprint)
+
+        if not created:
+            if record is None:
+                # The record expired or was released between the insert and the read
+                return Response(
+                    {"detail": "A request with this Idempotency-Key is being retried, try again."},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            if record.fingerprint != request_fingerprint:
+                return Response(
+                    {"detail": f"{HEADER} was already used for a different request."},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            record = wait_for(record)
+            if record is None or record.response_status is None:
+                return Response(
+                    {"detail": "A request with this Idempotency-Key is still in progress."},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            return replay(record)
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except BaseException:
+            # Also on SystemExit and KeyboardInterrupt, so retries are not held up until the lease passes
+            record.delete()
+            raise
+
+        if response.status_code >= 500 or response.status_code in (
+            status.HTTP_409_CONFLICT,
+            status.HTTP_429_TOO_MANY_REQUESTS,
+        ):
+            # Not a final answer, let the client retry with the same key
+            record.delete()
+        else:
+            # A no-op when a retry took the key over after the lease passed
+            IdempotencyKey.objects.filter(id=record.id).update(
+                response_status=response.status_code, response_body=response.data,
+            )
+        return response
+
+    return wrapper
@@ -0,0 +1,60 @@
+import os
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from .models import OrderIdSequence
+
+
+class OrderIdAllocator:
+    """
+    Hands out order numbers from a database backed sequence. Each process
+    reserves a block of ORDER_ID_BLOCK_SIZE numbers with a single UPDATE and
+    allocates from it in memory, so no existence checks are needed and
+    concurrent workers never receive the same number.
+    """
+    def __init__(self, name="order", block_size=None):
+        self.name = name
+        self.block_size = block_size or settings.ORDER_ID_BLOCK_SIZE
+        self.lock = threading.Lock()
+        self.pid = None
+        self.next = self.end = 0
+
+    def allocate(self):
+        if connection.in_atomic_block:
+            # A block reserved here would be handed back if the surrounding
+            # transaction rolls back, so only reserve the number that is used
+            return self.reserve(1)
+
+        with self.lock:
+            # Blocks reserved before a fork (e.g. gunicorn --preload) belong to the parent
+            if self.next >= self.end or self.pid != os.getpid():
+                self.next = self.reserve(self.block_size)
+                self.end = self.next + self.block_size
+                self.pid = os.getpid()
+            value = self.next
+            self.next += 1
+            return value
+
+    def reserve(self, count):
+        """
+        Reserve `count` consecutive numbers and return the first one.
+        """
+        with transaction.atomic():
+            # The UPDATE comes first so the row is write-locked before it is read
+            sequence = OrderIdSequence.objects.filter(name=self.name)
+            if not sequence.update(next_value=F("next_value") + count):
+                OrderIdSequence.objects.get_or_create(
+                    name=self.name, defaults={"next_value": settings.ORDER_ID_START}
+                )
+                sequence.update(next_value=F("next_value") + count)
+            return sequence.values_list("next_value", flat=True).get() - count
+
+
+order_id_allocator = OrderIdAllocator()
+
+
+def new_order_id():
+    return f"Barracks_order_{order_id_allocator.allocate()}"
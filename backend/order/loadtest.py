@@ -0,0 +1,45 @@
+"""
+Scaffolding shared by the in-process load test commands, waiting_room_load
+and benchmark_checkout: throwaway shoppers and a product to buy, removed
+again with everything they ordered, and the latency percentiles reported.
+"""
+import statistics
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.test.utils import setup_test_environment
+
+from order.models import Order
+from products.models import CartItem, Product
+
+
+@contextmanager
+def shoppers(email_domain, count, product_name):
+    """
+    Create `count` users under `email_domain` and a product they can buy,
+    yielding `(users, product)`. Both are deleted on exit, as are leftovers
+    of an earlier run that was killed.
+    """
+    # The test client needs the `testserver` host, and mails go to the in-memory outbox
+    setup_test_environment()
+    User = get_user_model()
+    User.objects.filter(email__endswith=f"@{email_domain}").delete()
+    User.objects.bulk_create(
+        [User(email=f"user{i}@{email_domain}", name=f"User {i}", position="user") for i in range(count)]
+    )
+    users = list(User.objects.filter(email__endswith=f"@{email_domain}"))
+    product = Product.objects.create(
+        name=product_name, price=100, max_quantity=10,
+        accept_orders=True, is_visible=True, for_user_positions=["user"],
+    )
+    try:
+        yield users, product
+    finally:
+        CartItem.objects.filter(product=product).delete()
+        Order.objects.filter(user__in=users).delete()
+        product.delete()
+        User.objects.filter(email__endswith=f"@{email_domain}").delete()
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
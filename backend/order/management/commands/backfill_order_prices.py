@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from order.models import Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = 'Store the unit price, line total and discount breakdown of orders placed before they were snapshotted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        items = 0
+        pending = OrderItem.objects.filter(unit_price__isnull=True).select_related('product')
+        while True:
+            # Each batch is filled in, so the filter moves on to the next one
+            batch = list(pending[:batch_size])
+            if not batch:
+                break
+            order_ids = {item.order_id for item in batch}
+            for item in batch:
+                # The price at purchase time was never stored, the current one is the best estimate
+                item.unit_price = item.product.price if item.product else 0
+                item.line_total = item.unit_price * item.quantity
+            with transaction.atomic():
+                OrderItem.objects.bulk_update(batch, ['unit_price', 'line_total'])
+                self.update_orders(order_ids)
+            items += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {items} order items'))
+
+    def update_orders(self, order_ids):
+        totals = dict(
+            OrderItem.objects.filter(order_id__in=order_ids)
+            .values_list('order_id')
+            .annotate(total=Sum('line_total'))
+        )
+        orders = list(Order.objects.filter(id__in=order_ids).select_related('discount_code'))
+        for order in orders:
+            if not order.total_amount:
+                order.total_amount = totals.get(order.id) or 0
+            if order.discount_code and order.discount_percentage is None:
+                order.discount_percentage = order.discount_code.discount_percentage
+            order.discount_amount = Order.discount_for(order.total_amount, order.discount_percentage or 0)
+        Order.objects.bulk_update(orders, ['total_amount', 'discount_percentage', 'discount_amount'])
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from order.gateway import get_gateway
+from order.loadtest import percentile, shoppers
+
+EMAIL_DOMAIN = "checkout-benchmark.test"
+STAGES = ("cart", "checkout", "payment", "verify")
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the whole purchase in-process against the fake payment gateway: add to cart, '
+        'check out, start the payment, pay and verify it'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--latency', type=float, default=0.1, help='Seconds per gateway call')
+        parser.add_argument('--error-rate', type=float, default=0, help='Share of gateway calls failing with a server error')
+        parser.add_argument('--timeout-rate', type=float, default=0, help='Share of gateway calls never answered')
+        parser.add_argument('--gateway-timeout', type=float, default=2, help='Read timeout of a gateway call in seconds')
+
+    def handle(self, *args, **options):
+        timings = {stage: [] for stage in STAGES}
+        failures = {stage: 0 for stage in STAGES}
+        lock = threading.Lock()
+
+        def timed(stage, request, expected):
+            start = time.perf_counter()
+            response = request()
+            elapsed = time.perf_counter() - start
+            with lock:
+                timings[stage].append(elapsed)
+                if response.status_code != expected:
+                    failures[stage] += 1
+            return response if response.status_code == expected else None
+
+        def shopper(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                if not timed("cart", lambda: client.post(
+                    "/cart/add/", {"product_id": product.id, "quantity": 1}, format="json"
+                ), 200):
+                    return
+                placed = timed("checkout", lambda: client.post("/order/place/", {}, format="json"), 201)
+                if not placed:
+                    return
+                payment = timed("payment", lambda: client.post(f"/payment/{placed.data['order']['id']}/"), 200)
+                if not payment:
+                    return
+                # What the hosted checkout posts back once the user has paid
+                paid = gateway.api.pay(payment.data["razorpay_order_id"])
+                timed("verify", lambda: client.post(
+                    "/payment_completed/verify/",
+                    {**paid, "transaction_id": payment.data["transaction_id"]},
+                    format="json",
+                ), 200)
+            finally:
+                connection.close()
+
+        settings_override = override_settings(
+            PAYMENT_GATEWAY="fake",
+            FAKE_GATEWAY_LATENCY=options['latency'],
+            FAKE_GATEWAY_ERROR_RATE=options['error_rate'],
+            FAKE_GATEWAY_TIMEOUT_RATE=options['timeout_rate'],
+            PAYMENT_GATEWAY_TIMEOUT=(3, options['gateway_timeout']),
+            WAITING_ROOM_ENABLED=False,
+            # No worker runs the post-payment job, verify runs it inline
+            CELERY_TASK_ALWAYS_EAGER=True,
+        )
+        with shoppers(EMAIL_DOMAIN, options['users'], "Checkout benchmark") as (users, product), settings_override:
+            gateway = get_gateway()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(options['concurrency']) as pool:
+                list(pool.map(shopper, users))
+            elapsed = time.perf_counter() - start
+            metrics = gateway.metrics.snapshot()
+
+        completed = len(timings["verify"]) - failures["verify"]
+        self.stdout.write(
+            f"{completed}/{len(users)} purchases completed in {elapsed:.2f}s ({completed / elapsed:.1f} purchases/s), "
+            f"{options['concurrency']} concurrent shoppers"
+        )
+        for stage in STAGES:
+            if timings[stage]:
+                self.stdout.write(
+                    f"{stage:<9} p50 {percentile(timings[stage], 50) * 1000:.0f}ms, "
+                    f"p95 {percentile(timings[stage], 95) * 1000:.0f}ms, {failures[stage]} failed"
+                )
+        for operation, stats in metrics.items():
+            self.stdout.write(
+                f"gateway {operation}: {stats['calls']} calls, {stats['retries']} retries, {stats['errors']} errors, "
+                f"p50 {stats['p50_ms']}ms, p95 {stats['p95_ms']}ms"
+            )
+        if completed == len(users):
+            self.stdout.write(self.style.SUCCESS("Every purchase completed"))
+        else:
+            self.stdout.write(self.style.ERROR(f"{len(users) - completed} purchases did not complete"))
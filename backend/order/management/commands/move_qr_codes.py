@@ -0,0 +1,40 @@
+import base64
+import binascii
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from order.models import Order, OrderQRCode
+from order.utils import qr_etag, qr_payload
+
+
+class Command(BaseCommand):
+    help = 'Move base64 QR codes stored on orders to the OrderQRCode table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        moved = 0
+        pending = Order.objects.filter(qr_code_data__isnull=False).select_related('payment').order_by('pk')
+        while True:
+            # Each batch is emptied, so the filter moves on to the next one
+            batch = list(pending.only('id', 'qr_code_data', 'payment__transaction_id')[:batch_size])
+            if not batch:
+                break
+            codes = []
+            for order in batch:
+                try:
+                    png = base64.b64decode(order.qr_code_data)
+                    payload = qr_payload(order)
+                except (binascii.Error, Order.payment.RelatedObjectDoesNotExist):
+                    continue  # Dropped, the endpoint generates the image again if the order is paid
+                codes.append(OrderQRCode(order=order, png=png, etag=qr_etag(payload)))
+            with transaction.atomic():
+                OrderQRCode.objects.bulk_create(codes, ignore_conflicts=True)
+                Order.objects.filter(pk__in=[order.pk for order in batch]).update(qr_code_data=None)
+            moved += len(codes)
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} QR codes'))
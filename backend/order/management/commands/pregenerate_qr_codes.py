@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from order import tasks
+from order.qr_batch import pregenerate_qr_codes
+
+
+class Command(BaseCommand):
+    help = 'Generate and store the QR codes of paid orders that have none, across a pool of processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='0 renders in this process')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Orders read and written at a time')
+        parser.add_argument('--after', default='', help='Skip orders up to this order ID')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many orders')
+        parser.add_argument('--queue', action='store_true', help='Leave the work to the Celery workers, one job per chunk')
+
+    def report(self, stats):
+        rate = stats['generated'] / stats['elapsed'] if stats['elapsed'] else 0
+        self.stdout.write(f"{stats['generated']} QR codes up to order {stats['last_id']} ({rate:.1f} orders/s)")
+
+    def handle(self, *args, **options):
+        if options['queue']:
+            tasks.pregenerate_qr_codes.delay(options['after'], options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS('Queued the QR code jobs'))
+            return
+
+        processes = options['processes']
+        kwargs = dict(chunk_size=options['chunk_size'], after=options['after'], limit=options['limit'], progress=self.report)
+        # Workers must not inherit the open database connection
+        connection.close()
+        try:
+            if processes:
+                with ProcessPoolExecutor(processes) as pool:
+                    stats = pregenerate_qr_codes(pool=pool, slices=processes, **kwargs)
+            else:
+                stats = pregenerate_qr_codes(**kwargs)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Interrupted, run the command again to continue'))
+            return
+        if not stats['generated']:
+            self.stdout.write('No paid orders are missing a QR code')
+        else:
+            self.stdout.write(self.style.SUCCESS('QR codes generated'))
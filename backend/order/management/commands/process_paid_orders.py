@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from order.models import Order
+from order.tasks import process_paid_order
+
+
+class Command(BaseCommand):
+    help = 'Queue the post-payment job of every paid order it has not completed for, e.g. after a broker outage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync', action='store_true', help='Run the jobs in this process instead of queueing them')
+
+    def handle(self, *args, **options):
+        order_ids = list(Order.objects.filter(is_verified=True, fulfilment_pending=True).values_list('id', flat=True))
+        for order_id in order_ids:
+            if options['sync']:
+                process_paid_order.apply(args=(order_id,), throw=False)
+            else:
+                process_paid_order.delay(order_id)
+        action = 'Processed' if options['sync'] else 'Queued'
+        self.stdout.write(self.style.SUCCESS(f'{action} {len(order_ids)} paid orders'))
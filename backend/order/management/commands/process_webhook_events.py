@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from order import webhooks
+
+
+class Command(BaseCommand):
+    help = 'Apply the payment webhooks waiting in the inbox, e.g. after a broker outage'
+
+    def handle(self, *args, **options):
+        count = webhooks.process_inbox()
+        self.stdout.write(self.style.SUCCESS(f'Applied {count} webhook events'))
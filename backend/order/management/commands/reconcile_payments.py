@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from order.gateway import get_gateway
+from order.reconcile import reconcile_pending_payments
+
+
+class Command(BaseCommand):
+    help = 'Ask the payment gateway what happened to payments left pending past their checkout window, and apply it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200)
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.PAYMENT_GATEWAY_POOL_SIZE, help='Concurrent gateway lookups'
+        )
+        parser.add_argument('--rate', type=float, default=20, help='Gateway lookups per second, 0 for no limit')
+        parser.add_argument('--after', type=int, default=0, help='Resume after this payment ID')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many payments')
+
+    def report(self, stats):
+        rate = stats['checked'] / stats['elapsed'] if stats['elapsed'] else 0
+        self.stdout.write(
+            f"{stats['checked']} checked up to payment {stats['last_id']} ({rate:.1f} payments/s): "
+            f"{stats['captured']} captured, {stats['failed']} failed, "
+            f"{stats['pending']} still pending, {stats['errors']} lookup errors"
+        )
+
+    def handle(self, *args, **options):
+        stats = reconcile_pending_payments(
+            get_gateway(),
+            chunk_size=options['chunk_size'],
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            after=options['after'],
+            limit=options['limit'],
+            progress=self.report,
+        )
+        if not stats['checked']:
+            self.stdout.write('No pending payments past their checkout window')
+        elif stats['errors']:
+            self.stdout.write(self.style.WARNING(
+                f"Lookups failed for {stats['errors']} payments, they stay pending for the next run"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS('Reconciliation finished'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from order.tasks import release_discount_reservations
+
+
+class Command(BaseCommand):
+    help = 'Give back the discount code uses reserved by orders that were not paid in time'
+
+    def handle(self, *args, **kwargs):
+        released = release_discount_reservations()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} discount code reservations'))
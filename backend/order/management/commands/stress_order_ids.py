@@ -0,0 +1,47 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from order.ids import OrderIdAllocator
+from order.models import OrderIdSequence
+
+SEQUENCE_NAME = 'stress-test'
+
+
+def allocate_ids(args):
+    count, block_size = args
+    # Forked workers must not reuse the parent's database connection
+    connections.close_all()
+    allocator = OrderIdAllocator(name=SEQUENCE_NAME, block_size=block_size)
+    ids = [allocator.allocate() for _ in range(count)]
+    connections.close_all()
+    return ids
+
+
+class Command(BaseCommand):
+    help = 'Allocate order IDs from several processes at once and check that none is handed out twice'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--ids', type=int, default=1000, help='IDs allocated by each process')
+        parser.add_argument('--block-size', type=int, default=20)
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        OrderIdSequence.objects.filter(name=SEQUENCE_NAME).delete()
+        connections.close_all()
+
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.map(allocate_ids, [(options['ids'], options['block_size'])] * processes)
+        elapsed = time.perf_counter() - start
+
+        OrderIdSequence.objects.filter(name=SEQUENCE_NAME).delete()
+
+        ids = [order_id for result in results for order_id in result]
+        duplicates = len(ids) - len(set(ids))
+        self.stdout.write(f'Allocated {len(ids)} IDs from {processes} processes in {elapsed:.2f}s ({len(ids) / elapsed:.0f} IDs/s)')
+        if duplicates:
+            raise CommandError(f'{duplicates} IDs were handed out more than once')
+        self.stdout.write(self.style.SUCCESS('No duplicate IDs'))
@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from order import waiting_room
+from order.loadtest import percentile, shoppers
+
+EMAIL_DOMAIN = "waiting-room-load.test"
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate a merch drop against the waiting room in-process: users join, poll their '
+        'position, then add to cart and check out once admitted'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--initial-rate', type=float, default=5, help='Admitted users per second at the start')
+        parser.add_argument('--max-rate', type=float, default=50)
+        parser.add_argument('--target-latency', type=float, default=0.5, help='Checkout seconds above which the rate is halved')
+        parser.add_argument('--adjust-interval', type=float, default=1)
+        parser.add_argument('--poll-interval', type=float, default=0.2, help='Upper bound on the wait between status polls')
+
+    def handle(self, *args, **options):
+        polls = []
+        waits = []
+        checkouts = []
+        failures = []
+        lock = threading.Lock()
+
+        def shopper(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            joined = time.perf_counter()
+            ticket = client.post("/queue/join/").json()
+            count = 0
+            while not ticket["admitted"]:
+                time.sleep(min(ticket["poll_after"], options['poll_interval']))
+                # Polled without credentials, as a browser in the waiting room would
+                ticket = APIClient().get("/queue/status/", {"ticket": ticket["ticket"]}).json()
+                count += 1
+            waited = time.perf_counter() - joined
+
+            added = client.post("/cart/add/", {"product_id": product.id, "quantity": 1}, format="json")
+            start = time.perf_counter()
+            placed = client.post("/order/place/", {}, format="json")
+            elapsed = time.perf_counter() - start
+            connection.close()
+            with lock:
+                polls.append(count)
+                waits.append(waited)
+                checkouts.append(elapsed)
+                if added.status_code != 200 or placed.status_code != 201:
+                    failures.append((added.status_code, placed.status_code))
+
+        settings_override = override_settings(
+            WAITING_ROOM_ENABLED=True,
+            WAITING_ROOM_INITIAL_RATE=options['initial_rate'],
+            WAITING_ROOM_MAX_RATE=options['max_rate'],
+            WAITING_ROOM_TARGET_LATENCY=options['target_latency'],
+            WAITING_ROOM_ADJUST_INTERVAL=options['adjust_interval'],
+        )
+        with shoppers(EMAIL_DOMAIN, options['users'], "Waiting room load test") as (users, product), settings_override:
+            waiting_room.open_room()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(len(users)) as pool:
+                list(pool.map(shopper, users))
+            elapsed = time.perf_counter() - start
+            current = waiting_room.generation()
+            rate = waiting_room.current_state(current)["rate"]
+
+        self.stdout.write(
+            f"{len(users)} users through the waiting room in {elapsed:.2f}s ({len(users) / elapsed:.1f} users/s)\n"
+            f"Wait in queue:  p50 {percentile(waits, 50):.2f}s, p95 {percentile(waits, 95):.2f}s, "
+            f"{sum(polls)} status polls\n"
+            f"Checkout:       p50 {percentile(checkouts, 50) * 1000:.0f}ms, p95 {percentile(checkouts, 95) * 1000:.0f}ms\n"
+            f"Admission rate: {options['initial_rate']:.1f} -> {rate:.1f} users/s"
+        )
+        if failures:
+            self.stdout.write(self.style.ERROR(f"{len(failures)} shoppers failed (add to cart, checkout status): {failures[:5]}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Every admitted shopper checked out"))
@@ -1,8 +1,13 @@
+from datetime import timedelta
 from decimal import Decimal
-from django.db import models
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
 from products.models import Product
 from login.models import CustomUser as User
 from discounts.models import DiscountCode
+from discounts import usage
 
 class ThreeCharAutoField(models.CharField):
     def __init__(self, *args, **kwargs):
@@ -11,18 +16,23 @@ class ThreeCharAutoField(models.CharField):
         super().__init__(*args, **kwargs)
 
     def pre_save(self, model_instance, add):
-        if add:
-            last_id = model_instance.__class__.objects.all().values_list('id', flat=True).last()
-            if last_id:
-                last_id = last_id.split('_')[1]
-                last_id = int(last_id) + 1
-            else:
-                last_id = 1
-
-            value = 'order_'+str(last_id)
+        if add and not getattr(model_instance, self.attname):
+            from .ids import order_id_allocator
+            value = 'order_'+str(order_id_allocator.allocate())
             setattr(model_instance, self.attname, value)
         return super().pre_save(model_instance, add)
 
+
+class OrderIdSequence(models.Model):
+    """
+    Next free number of an order ID sequence, see order.ids.OrderIdAllocator.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
 class Order(models.Model):
     id = models.CharField(primary_key=True, max_length=50)
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
@@ -30,21 +40,56 @@ class Order(models.Model):
     updated_amount = models.DecimalField(max_digits=10, decimal_places=2)
     is_verified = models.BooleanField(default=False)  # True if the payment of this order is verfied
     mail_added = models.BooleanField(default=False)
+    # Set when the post-payment job is queued and cleared once it is done, orders paid before the job existed never have it
+    fulfilment_pending = models.BooleanField(default=False)
     discount_code = models.ForeignKey(DiscountCode, null=True, blank=True, on_delete=models.SET_NULL)
-    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)  # Subtotal of the line totals
+    discount_percentage = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)  # Of the code at checkout
+    discount_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    discount_usage = models.CharField(max_length=10, blank=True, default='')  # 'reserved', 'confirmed' or 'released'
+    discount_shard = models.PositiveSmallIntegerField(null=True, blank=True)  # Counter shard of the reserved use
+    # Base64 QR codes of orders paid before they moved to OrderQRCode, emptied by the move_qr_codes command
     qr_code_data = models.TextField(blank=True, null=True)
     is_completed = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Order history is paginated by created_at per user
+            models.Index(fields=['user', 'is_verified', '-created_at']),
+        ]
+
     def __str__(self):
         return str(self.id)
 
     @property
     def calculated_total_amount(self):
-        total = sum(Decimal(item.product.price * item.quantity) for item in self.order_items.all())
-        if self.discount_code and self.discount_code.is_valid():
-            discount = total * (Decimal(self.discount_code.discount_percentage) / Decimal(100))
-            total -= discount
-        return total
+        # Read from the amounts stored at checkout, later price or code edits don't apply
+        return self.total_amount - self.discount_amount
+
+    def confirm_discount(self):
+        """
+        Count the order's discount code use once the order is paid. Safe to
+        call more than once, only the first call changes the counters.
+        """
+        with transaction.atomic():
+            for previous in ('reserved', 'released'):
+                if Order.objects.filter(pk=self.pk, discount_usage=previous).update(discount_usage='confirmed'):
+                    usage.confirm(self.discount_code_id, self.discount_shard, reserved=previous == 'reserved')
+                    self.discount_usage = 'confirmed'
+                    return
+
+    def release_discount(self):
+        """
+        Give the reserved use back to the code when the order will not be paid.
+        """
+        with transaction.atomic():
+            if Order.objects.filter(pk=self.pk, discount_usage='reserved').update(discount_usage='released'):
+                usage.release(self.discount_code_id, self.discount_shard)
+                self.discount_usage = 'released'
+
+    @staticmethod
+    def discount_for(subtotal, percentage):
+        return (subtotal * Decimal(percentage) / Decimal(100)).quantize(Decimal('0.01'))
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='order_items')
@@ -53,6 +98,9 @@ class OrderItem(models.Model):
     size = models.CharField(max_length=5, null=True, blank=True)
     image_url = models.URLField(max_length=5000, null=True, blank=True)
     quantity = models.PositiveIntegerField(default=1)
+    # Price of the product when the order was placed, null only before the backfill
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    line_total = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
 
     def __str__(self):
         return f"{self.order.id}_{self.product.name}"
@@ -65,7 +113,110 @@ class Payment(models.Model):
     payment_date = models.DateTimeField(auto_now_add=True)
     payment_id = models.CharField(max_length=100, null=True, blank=True, unique=True)  # Payment gateway's payment ID
     reason = models.TextField(null=True, blank=True)  # Reason for failure
-    
+    gateway_order_id = models.CharField(max_length=100, null=True, blank=True, db_index=True)  # Razorpay order paid by the checkout
 
     def __str__(self):
         return f"Payment for Order {self.order.id}"
+
+    def can_resume(self, amount):
+        """
+        Whether the checkout can continue with this payment's gateway order
+        instead of creating a new one.
+        """
+        return (
+            self.status == "pending"
+            and bool(self.gateway_order_id)
+            and self.paid_amount == amount
+            and self.payment_date > timezone.now() - timedelta(seconds=settings.PAYMENT_ORDER_TTL)
+        )
+
+    def gateway_order_ids(self):
+        """
+        The current gateway order and the ones it replaced, any of which a
+        checkout left open may still pay.
+        """
+        previous = [row.gateway_order_id for row in self.previous_gateway_orders.all()]
+        return [self.gateway_order_id, *previous] if self.gateway_order_id else previous
+
+    def mark_captured(self, payment_id):
+        """
+        Record the captured payment and verify its order. Returns False when
+        the payment was already captured, so the browser redirect and the
+        webhook for the same payment fulfil the order only once.
+        """
+        with transaction.atomic():
+            captured = Payment.objects.filter(pk=self.pk).exclude(status="PAYMENT_SUCCESS").update(
+                status="PAYMENT_SUCCESS", payment_id=payment_id, reason="captured"
+            )
+            if captured:
+                Order.objects.filter(pk=self.order_id).update(is_verified=True)
+                self.order.confirm_discount()
+        return bool(captured)
+
+
+class PreviousGatewayOrder(models.Model):
+    """
+    Gateway order a payment was moved off when it expired or failed and the
+    checkout created a new one. A checkout still open on it can be paid, so
+    verification, webhooks and reconciliation match it to the payment.
+    """
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='previous_gateway_orders')
+    gateway_order_id = models.CharField(max_length=100, unique=True)
+    transaction_id = models.CharField(max_length=100, db_index=True)  # Ours at the time, sent back by its checkout
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.gateway_order_id} of payment {self.payment_id}"
+
+
+class OrderQRCode(models.Model):
+    """
+    PNG QR code of a paid order, kept out of the order rows and served by
+    the QR code endpoint, see order.utils.
+    """
+    order = models.OneToOneField(Order, primary_key=True, on_delete=models.CASCADE, related_name='qr_code')
+    png = models.BinaryField()
+    etag = models.CharField(max_length=32)  # Of the payload and QR settings the image was made with
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"QR code of order {self.order_id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    Inbox of payment webhooks from the gateway, stored as they arrive and
+    applied to payments in batches, see order.webhooks.
+    """
+    event_id = models.CharField(max_length=100, unique=True)  # Gateway's event ID, redeliveries share it
+    event = models.CharField(max_length=50)  # e.g. 'payment.captured'
+    gateway_order_id = models.CharField(max_length=100, db_index=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.event} {self.event_id}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    First response to a request sent with an `Idempotency-Key` header,
+    replayed for retries of the same request, see order.idempotency.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)  # Hash of the request path and body
+    response_status = models.IntegerField(null=True, blank=True)  # None while the request is in flight
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    locked_until = models.DateTimeField(null=True, blank=True)  # Lease of the in-flight request
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}_{self.key}"
@@ -0,0 +1,73 @@
+"""
+Pre-generation of the QR codes of paid orders, so the QR code endpoint and
+the confirmation emails find them stored instead of rendering them inline.
+
+Orders without a stored QR code are read in keyset-paged chunks, their
+payloads are rendered in slices across a process pool (rendering is CPU
+bound, threads would take turns on the GIL), and each chunk is written with
+one bulk insert. The pregenerate_qr_codes job does the same one chunk per
+job, rendering in the Celery worker processes. Only orders still missing a
+code are selected, so a run that was interrupted picks up where it stopped
+when started again.
+"""
+import time
+
+from .models import Order, OrderQRCode
+from .utils import qr_etag, render_qr_batch
+
+
+def missing(after, limit):
+    """
+    `(order_id, payload)` of up to `limit` paid orders after `after` that
+    have no stored QR code.
+    """
+    rows = (
+        Order.objects.filter(pk__gt=after, is_verified=True, payment__isnull=False, qr_code__isnull=True)
+        .order_by("pk")
+        .values_list("pk", "payment__transaction_id")[:limit]
+    )
+    return [(order_id, f"{order_id}|{transaction_id}") for order_id, transaction_id in rows]
+
+
+def store(rows, pngs):
+    # A code generated meanwhile by the endpoint is kept
+    OrderQRCode.objects.bulk_create(
+        [
+            OrderQRCode(order_id=order_id, png=png, etag=qr_etag(payload))
+            for (order_id, payload), png in zip(rows, pngs)
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def render(payloads, pool, slices):
+    if pool is None:
+        return render_qr_batch(payloads)
+    size = -(-len(payloads) // slices)
+    parts = [payloads[i:i + size] for i in range(0, len(payloads), size)]
+    return [png for pngs in pool.map(render_qr_batch, parts) for png in pngs]
+
+
+def pregenerate_qr_codes(pool=None, slices=1, chunk_size=500, after="", limit=None, progress=None):
+    """
+    Store the missing QR codes of paid orders with a pk above `after`, at
+    most `limit` of them. Each chunk is split into `slices` for `pool`, an
+    executor, or rendered in this process without one. `progress` is called
+    with the running totals after each chunk, and the final totals are
+    returned.
+    """
+    stats = {"generated": 0, "last_id": after, "elapsed": 0}
+    start = time.perf_counter()
+    while limit is None or stats["generated"] < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - stats["generated"])
+        rows = missing(stats["last_id"], size)
+        if not rows:
+            break
+        store(rows, render([payload for _, payload in rows], pool, slices))
+        stats["generated"] += len(rows)
+        stats["last_id"] = rows[-1][0]
+        stats["elapsed"] = time.perf_counter() - start
+        if progress:
+            progress(dict(stats))
+    stats["elapsed"] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,187 @@
+"""
+Reconciliation of payments left pending, e.g. when the user closed the tab
+before the checkout redirect and the webhook never arrived.
+
+Pending payments whose checkout window (PAYMENT_ORDER_TTL) has passed are
+read in keyset-paged chunks, their gateway orders are looked up by a bounded
+pool of threads sharing a rate limit, and the outcomes of a chunk are
+written with a few bulk updates. The gateway orders a payment was moved off
+are looked up too, a checkout left open on one of them may have been paid. A payment captured at the gateway is
+captured here and fulfilled like a verified one. A payment whose attempts
+all failed, or that was never attempted, is marked failed and its discount
+use released. Lookups that fail leave the payment pending for the next run.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from .gateway import CircuitOpenError, PaymentGatewayError
+from .models import Order, Payment, PreviousGatewayOrder
+
+logger = logging.getLogger(__name__)
+
+# Attempts that may still be captured, the payment stays pending while one exists
+IN_PROGRESS_STATUSES = {"created", "authorized"}
+
+
+class RateLimiter:
+    """
+    Spaces calls from any number of threads at least 1/rate seconds apart.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_call, now)
+            self.next_call = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def outcome(attempts):
+    """
+    Return the state transition for a payment from its gateway attempts, as
+    `(status, payment_id or reason)`, or None to leave it pending.
+    """
+    captured = [attempt for attempt in attempts if attempt.get("status") == "captured"]
+    if captured:
+        return "PAYMENT_SUCCESS", captured[-1]["id"]
+    if any(attempt.get("status") in IN_PROGRESS_STATUSES for attempt in attempts):
+        return None
+    return "FAILED", "reconciled_failed" if attempts else "reconciled_expired"
+
+
+def capture(payment_ids):
+    """
+    Capture payments that are still pending, `payment_ids` maps payment pks
+    to gateway payment IDs. Returns the number captured.
+    """
+    from .tasks import enqueue_paid_order
+
+    with transaction.atomic():
+        # Locked, so a concurrent verify or webhook of the same payment waits and then finds it captured
+        rows = dict(
+            Payment.objects.select_for_update()
+            .filter(pk__in=payment_ids, status="pending")
+            .values_list("pk", "order_id")
+        )
+        if not rows:
+            return 0
+        Payment.objects.filter(pk__in=rows).update(
+            status="PAYMENT_SUCCESS",
+            reason="captured",
+            payment_id=Case(*[When(pk=pk, then=Value(payment_ids[pk])) for pk in rows]),
+        )
+        Order.objects.filter(pk__in=rows.values()).update(is_verified=True)
+        for order in Order.objects.filter(pk__in=rows.values(), discount_usage__in=("reserved", "released")):
+            order.confirm_discount()
+        for order_id in rows.values():
+            enqueue_paid_order(order_id)
+    return len(rows)
+
+
+def fail(reasons):
+    """
+    Mark payments that are still pending as failed, `reasons` maps payment
+    pks to the failure reason. Returns the number marked.
+    """
+    with transaction.atomic():
+        rows = dict(
+            Payment.objects.select_for_update()
+            .filter(pk__in=reasons, status="pending")
+            .values_list("pk", "order_id")
+        )
+        if not rows:
+            return 0
+        Payment.objects.filter(pk__in=rows).update(
+            status="FAILED",
+            reason=Case(*[When(pk=pk, then=Value(reasons[pk])) for pk in rows]),
+        )
+        for order in Order.objects.filter(pk__in=rows.values(), discount_usage="reserved"):
+            order.release_discount()
+    return len(rows)
+
+
+def reconcile_pending_payments(
+    gateway, chunk_size=200, concurrency=8, rate=20, after=0, limit=None, progress=None,
+):
+    """
+    Reconcile the pending payments with a pk above `after`, at most `limit`
+    of them. `progress` is called with the running totals after each chunk,
+    and the final totals are returned. Stops early when the gateway's circuit
+    opens, `last_id` tells where to resume.
+    """
+    limiter = RateLimiter(rate)
+    cutoff = timezone.now() - timedelta(seconds=settings.PAYMENT_ORDER_TTL)
+    stats = {"checked": 0, "captured": 0, "failed": 0, "pending": 0, "errors": 0, "last_id": after}
+    start = time.perf_counter()
+
+    def lookup(row):
+        attempts = []
+        try:
+            for gateway_order_id in row["gateway_order_ids"]:
+                limiter.wait()
+                attempts += gateway.fetch_order_payments(gateway_order_id)
+        except PaymentGatewayError as e:
+            return row, e
+        return row, outcome(attempts)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        while limit is None or stats["checked"] < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - stats["checked"])
+            rows = list(
+                Payment.objects.filter(
+                    pk__gt=stats["last_id"], status="pending", payment_date__lt=cutoff, gateway_order_id__isnull=False,
+                )
+                .exclude(gateway_order_id="")
+                .order_by("pk")
+                .values("pk", "gateway_order_id")[:size]
+            )
+            if not rows:
+                break
+            for row in rows:
+                row["gateway_order_ids"] = [row["gateway_order_id"]]
+            by_pk = {row["pk"]: row for row in rows}
+            for payment_id, gateway_order_id in PreviousGatewayOrder.objects.filter(
+                payment_id__in=by_pk
+            ).values_list("payment_id", "gateway_order_id"):
+                by_pk[payment_id]["gateway_order_ids"].append(gateway_order_id)
+
+            captured, failed = {}, {}
+            circuit_open = False
+            for row, result in pool.map(lookup, rows):
+                if isinstance(result, CircuitOpenError):
+                    circuit_open = True
+                if isinstance(result, Exception):
+                    stats["errors"] += 1
+                elif result is None:
+                    stats["pending"] += 1
+                elif result[0] == "PAYMENT_SUCCESS":
+                    captured[row["pk"]] = result[1]
+                else:
+                    failed[row["pk"]] = result[1]
+
+            stats["captured"] += capture(captured)
+            stats["failed"] += fail(failed)
+            stats["checked"] += len(rows)
+            stats["last_id"] = rows[-1]["pk"]
+            stats["elapsed"] = time.perf_counter() - start
+            if progress:
+                progress(dict(stats))
+            if circuit_open:
+                logger.warning(f"Payment reconciliation stopped at payment {stats['last_id']}, the gateway is failing")
+                break
+
+    stats["elapsed"] = time.perf_counter() - start
+    return stats
@@ -1,14 +1,26 @@
+from django.urls import reverse
 from rest_framework import serializers
 from .models import Order, OrderItem, Payment
+from .utils import QR_CONFIG_VERSION, qr_code_token
 from discounts.models import DiscountCode
 from products.serializers import ProductSerializer
 
+def qr_code_url(order):
+    """
+    Path of the order's QR code image, once the order is paid. The QR code
+    settings version is part of it, so a change gives the image a new URL.
+    """
+    if not order.is_verified:
+        return None
+    path = reverse("order_qr_png", kwargs={"token": qr_code_token(order.id)})
+    return f"{path}?v={QR_CONFIG_VERSION}"
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     
     class Meta:
         model = OrderItem
-        fields = ['product', 'printing_name', 'size', 'image_url', 'quantity']
+        fields = ['product', 'printing_name', 'size', 'image_url', 'quantity', 'unit_price', 'line_total']
 
 class DiscountCodeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -21,13 +33,11 @@ class OrderSerializer(serializers.ModelSerializer):
     is_verified = serializers.SerializerMethodField()
     discount_code = DiscountCodeSerializer(read_only=True)
     total_amount = serializers.SerializerMethodField()
-    qr_code_data = serializers.SerializerMethodField()
+    qr_code_url = serializers.SerializerMethodField()
     is_completed = serializers.SerializerMethodField()
     
-    def get_qr_code_data(self, obj):
-        if obj.qr_code_data:
-            return obj.qr_code_data
-        return None
+    def get_qr_code_url(self, obj):
+        return qr_code_url(obj)
     
     def get_is_completed(self, obj):
         return obj.is_completed
@@ -47,16 +57,14 @@ class OrderSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ['id', 'updated_amount', 'created_at', 'is_verified', 'order_items', 'discount_code', 'total_amount','qr_code_data', 'is_completed']
+        fields = ['id', 'updated_amount', 'created_at', 'is_verified', 'order_items', 'discount_code', 'total_amount', 'discount_percentage', 'discount_amount', 'qr_code_url', 'is_completed']
         
 class PaymentSerializer(serializers.ModelSerializer):
-    qr_code_data = serializers.SerializerMethodField()
+    qr_code_url = serializers.SerializerMethodField()
     
-    def get_qr_code_data(self, obj):
-        if obj.order.qr_code_data:
-            return obj.order.qr_code_data
-        return None
+    def get_qr_code_url(self, obj):
+        return qr_code_url(obj.order)
     
     class Meta:
         model = Payment
-        fields = ['transaction_id', 'paid_amount', 'status', 'payment_date', 'payment_id', 'reason', 'qr_code_data']
+        fields = ['transaction_id', 'paid_amount', 'status', 'payment_date', 'payment_id', 'reason', 'qr_code_url']
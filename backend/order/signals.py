@@ -0,0 +1,10 @@
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+from django.core.management import call_command
+
+
+@receiver(post_migrate)
+def backfill_order_prices(sender, **kwargs):
+    if sender.name == 'order':
+        call_command('backfill_order_prices')
+        call_command('move_qr_codes')
@@ -1,14 +1,20 @@
 from __future__ import absolute_import, unicode_literals
 import logging
+from datetime import timedelta
 
 from django.core.mail import EmailMessage, EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.conf import settings
 from email.mime.image import MIMEImage
-import base64
-import threading
-import requests
+
+from celery import shared_task
+from django.db import transaction
+from django.utils import timezone
+from products.models import CartItem
+
+from .models import Order
+from .utils import generate_qr_code
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +24,6 @@ def send_order_success_email(txn_id, total, items, name, qr_code, user_email):
 
     context = {
         "name": name,
-        "qr_code": qr_code,
         "txn_id": txn_id,
         "items": items,
         "total": total,
@@ -36,9 +41,7 @@ def send_order_success_email(txn_id, total, items, name, qr_code, user_email):
 
         email.attach_alternative(html_content, "text/html")
 
-        qr_code_data = base64.b64decode(qr_code)
-
-        mime_img = MIMEImage(qr_code_data)
+        mime_img = MIMEImage(qr_code)
         mime_img.add_header("Content-ID", "<qr_code>")
 
         email.attach(mime_img)
@@ -50,9 +53,90 @@ def send_order_success_email(txn_id, total, items, name, qr_code, user_email):
         raise
 
 
-def send_order_success_email_async(txn_id, total, items, name, qr_code, user_email):
-    thread = threading.Thread(
-        target=send_order_success_email,
-        args=(txn_id, total, items, name, qr_code, user_email),
+@shared_task(
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    retry_jitter=True,
+    max_retries=8,
+)
+def process_paid_order(order_id):
+    """
+    Post-payment work for a verified order: take its products out of the
+    user's cart, generate the QR code and send the confirmation email. Every
+    step is safe to repeat, so a failed run is simply retried, and
+    `mail_added` marks the order as done.
+    """
+    order = Order.objects.select_related("user", "payment").get(pk=order_id)
+    if order.mail_added:
+        Order.objects.filter(pk=order_id, fulfilment_pending=True).update(fulfilment_pending=False)
+        return
+
+    # Only the products bought, the user may have filled the cart again before a late retry
+    CartItem.objects.filter(user=order.user, product__in=order.order_items.values("product")).delete()
+    qr_code = generate_qr_code(order)
+    items = [
+        {"name": item.product.name, "quantity": item.quantity}
+        for item in order.order_items.select_related("product")
+    ]
+    send_order_success_email(
+        order.payment.transaction_id,
+        order.updated_amount,
+        items,
+        order.user.name,
+        qr_code,
+        order.user.email,
     )
-    thread.start()
+    Order.objects.filter(pk=order_id).update(mail_added=True, fulfilment_pending=False)
+
+
+def enqueue_paid_order(order_id):
+    """
+    Queue the post-payment work once the current transaction commits. The
+    order is flagged in the same transaction, so process_paid_orders can
+    queue it again if the job is lost.
+    """
+    Order.objects.filter(pk=order_id).update(fulfilment_pending=True)
+    transaction.on_commit(lambda: process_paid_order.delay(order_id))
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=8)
+def process_webhook_events():
+    """
+    Apply the payment webhooks waiting in the inbox, see order.webhooks.
+    """
+    from . import webhooks
+
+    return webhooks.process_inbox()
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=8)
+def pregenerate_qr_codes(after="", chunk_size=500):
+    """
+    Store the missing QR codes of the next chunk of paid orders, see
+    order.qr_batch. The job for the following chunk is queued before this
+    one renders, so the chunks are spread over the worker processes.
+    """
+    from . import qr_batch
+    from .utils import render_qr_batch
+
+    rows = qr_batch.missing(after, chunk_size)
+    if len(rows) == chunk_size:
+        pregenerate_qr_codes.delay(rows[-1][0], chunk_size)
+    qr_batch.store(rows, render_qr_batch([payload for _, payload in rows]))
+    return len(rows)
+
+
+@shared_task
+def release_discount_reservations():
+    """
+    Give back the discount code uses reserved by orders that were not paid
+    within DISCOUNT_RESERVATION_TTL, run periodically by celery beat.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.DISCOUNT_RESERVATION_TTL)
+    orders = Order.objects.filter(discount_usage="reserved", is_verified=False, created_at__lt=cutoff)
+    released = 0
+    for order in orders.iterator():
+        order.release_discount()
+        released += 1
+    return released
@@ -1,3 +1,859 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from discounts import usage
+from discounts.index import discount_index
+from discounts.models import DiscountCode
+from products.models import Product, CartItem
+from . import tasks, waiting_room, webhooks
+from .checks import check_shared_cache
+from .fake_gateway import FakeGatewayServer, FakeRazorpay
+from .gateway import CircuitOpenError, PaymentGatewayError, PaymentGatewayRejected, RazorpayGateway, get_gateway
+from .idempotency import idempotent
+from .ids import OrderIdAllocator
+from .models import (
+    Order, OrderItem, OrderIdSequence, OrderQRCode, IdempotencyKey, Payment, PreviousGatewayOrder, WebhookEvent,
+)
+from .reconcile import RateLimiter, reconcile_pending_payments
+from .serializers import OrderSerializer
+from .qr_batch import pregenerate_qr_codes
+from .utils import QR_CONFIG_VERSION, qr_code_token, render_qr, render_qr_batch
+
+
+class OrderHistoryQueryTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.orders = 0
+
+    def add_order(self, items):
+        self.orders += 1
+        order = Order.objects.create(id=str(self.orders), user=self.user, updated_amount=0, is_verified=True)
+        for i in range(items):
+            product = Product.objects.create(name=f"Product {self.orders}_{i}", for_user_positions=["user"])
+            CartItem.objects.create(user=self.user, product=product)
+            OrderItem.objects.create(order=order, product=product)
+        return order
+
+    def test_all_orders_query_count_is_constant(self):
+        self.add_order(1)
+        with self.assertNumQueries(3):
+            self.client.get("/order/all/")
+        self.add_order(5)
+        self.add_order(3)
+        with self.assertNumQueries(3):
+            response = self.client.get("/order/all/")
+        self.assertEqual(len(response.data), 3)
+
+    def test_order_view_query_count_is_constant(self):
+        small = self.add_order(1)
+        large = self.add_order(6)
+        with self.assertNumQueries(3):
+            self.client.get(f"/order/{small.id}/")
+        with self.assertNumQueries(3):
+            response = self.client.get(f"/order/{large.id}/")
+        self.assertEqual({i["product"]["status"] for i in response.data["order_items"]}, {"incart"})
+
+    def test_all_orders_pagination(self):
+        for _ in range(3):
+            self.add_order(1)
+        response = self.client.get("/order/all/", {"page_size": 2})
+        self.assertEqual([o["id"] for o in response.data["results"]], ["3", "2"])
+        response = self.client.get(response.data["next"])
+        self.assertEqual([o["id"] for o in response.data["results"]], ["1"])
+        self.assertIsNone(response.data["next"])
+
+
+class CheckoutTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fill_cart(self, count):
+        CartItem.objects.filter(user=self.user).delete()
+        for i in range(count):
+            product = Product.objects.create(name=f"Product {count}_{i}", price=100, for_user_positions=["user"])
+            CartItem.objects.create(user=self.user, product=product, quantity=2)
+
+    def checkout(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/order/place/", {}, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response, len(queries)
+
+    def test_query_count_is_constant(self):
+        # The first checkout also creates the order ID sequence
+        self.fill_cart(1)
+        self.checkout()
+        _, small = self.checkout()
+        self.fill_cart(10)
+        response, large = self.checkout()
+        self.assertEqual(small, large)
+        self.assertEqual(response.data["total_amount"], 2000)
+        order = Order.objects.get(id=response.data["order"]["id"])
+        self.assertEqual(order.order_items.count(), 10)
+        self.assertEqual(len(response.data["order"]["order_items"]), 10)
+
+    def test_prices_are_snapshotted(self):
+        self.fill_cart(2)
+        code = DiscountCode.objects.create(
+            code="TEN", discount_percentage=10, max_uses=5,
+            expiry_date=timezone.now() + timedelta(days=1), for_user_positions=[self.user.position],
+        )
+        response = self.client.post("/order/place/", {"discount_code": code.code}, format="json")
+        Product.objects.update(price=500)
+        DiscountCode.objects.filter(pk=code.pk).update(discount_percentage=50)
+
+        order = Order.objects.get(id=response.data["order"]["id"])
+        self.assertEqual(order.calculated_total_amount, Decimal("360.00"))
+        self.assertEqual(order.discount_amount, Decimal("40.00"))
+        data = OrderSerializer(order, context={"user": self.user}).data
+        self.assertEqual(data["discount_percentage"], "10.00")
+        self.assertEqual(
+            [(i["unit_price"], i["line_total"]) for i in data["order_items"]],
+            [("100.00", "200.00"), ("100.00", "200.00")],
+        )
+
+    def test_backfill(self):
+        code = DiscountCode.objects.create(
+            code="TEN", discount_percentage=10, max_uses=5, expiry_date=timezone.now() + timedelta(days=1),
+        )
+        order = Order.objects.create(id="legacy", user=self.user, updated_amount=270, total_amount=300, discount_code=code)
+        product = Product.objects.create(name="Mug", price=150)
+        OrderItem.objects.create(order=order, product=product, quantity=2)
+
+        call_command("backfill_order_prices", stdout=StringIO())
+        item = order.order_items.get()
+        self.assertEqual((item.unit_price, item.line_total), (Decimal("150.00"), Decimal("300.00")))
+        order.refresh_from_db()
+        self.assertEqual((order.discount_percentage, order.discount_amount), (Decimal("10.00"), Decimal("30.00")))
+
+    def test_discount_use_is_reserved_then_confirmed_or_released(self):
+        code = DiscountCode.objects.create(
+            code="ONCE", discount_percentage=10, max_uses=1,
+            expiry_date=timezone.now() + timedelta(days=1), for_user_positions=[self.user.position],
+        )
+        self.fill_cart(1)
+        response = self.client.post("/order/place/", {"discount_code": code.code}, format="json")
+        order = Order.objects.get(id=response.data["order"]["id"])
+        self.assertEqual(order.discount_usage, "reserved")
+        self.assertEqual(self.client.post("/order/place/", {"discount_code": code.code}, format="json").status_code, 400)
+
+        order.release_discount()
+        order.release_discount()
+        code.refresh_from_db()
+        self.assertEqual((code.uses, code.reserved), (0, 0))
+
+        # A payment that arrives after the release still counts once
+        order.confirm_discount()
+        order.confirm_discount()
+        code.refresh_from_db()
+        self.assertEqual((code.uses, code.reserved), (1, 0))
+
+    def test_use_released_after_the_index_loaded_the_code_can_be_taken(self):
+        code = DiscountCode.objects.create(
+            code="ONCE", discount_percentage=10, max_uses=1, reserved=1,
+            expiry_date=timezone.now() + timedelta(days=1), for_user_positions=[self.user.position],
+        )
+        self.assertFalse(discount_index.get("ONCE").is_valid())
+        usage.release(code.pk, None)
+        self.fill_cart(1)
+        response = self.client.post("/order/place/", {"discount_code": code.code}, format="json")
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post("/order/place/", {"discount_code": code.code}, format="json")
+        self.assertEqual(response.data["detail"], "Discount code has no uses left.")
+
+    @override_settings(DISCOUNT_RESERVATION_TTL=60)
+    def test_unpaid_reservations_are_released_by_the_periodic_job(self):
+        code = DiscountCode.objects.create(
+            code="ONCE", discount_percentage=10, max_uses=1,
+            expiry_date=timezone.now() + timedelta(days=1), for_user_positions=[self.user.position],
+        )
+        self.fill_cart(1)
+        response = self.client.post("/order/place/", {"discount_code": code.code}, format="json")
+        self.assertEqual(tasks.release_discount_reservations(), 0)
+
+        Order.objects.update(created_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(tasks.release_discount_reservations(), 1)
+        self.assertEqual(Order.objects.get(id=response.data["order"]["id"]).discount_usage, "released")
+        code.refresh_from_db()
+        self.assertEqual((code.uses, code.reserved), (0, 0))
+        self.assertIn("release-discount-reservations", settings.CELERY_BEAT_SCHEDULE)
+
+
+@override_settings(WAITING_ROOM_ENABLED=True, WAITING_ROOM_INITIAL_RATE=2, WAITING_ROOM_ADJUST_INTERVAL=0)
+class WaitingRoomTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        waiting_room.open_room()
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_users_are_admitted_in_ticket_order(self):
+        response = self.client.post("/order/place/", {}, format="json")
+        self.assertEqual(response.status_code, 429)
+        ticket = self.client.post("/queue/join/").data
+        self.assertEqual((ticket["position"], ticket["admitted"]), (1, False))
+        self.assertEqual(self.client.post("/queue/join/").data["ticket"], ticket["ticket"])
+
+        time.sleep(0.6)
+        with self.assertNumQueries(0):
+            response = APIClient().get("/queue/status/", {"ticket": ticket["ticket"]})
+        self.assertTrue(response.data["admitted"])
+        self.assertEqual(self.client.post("/order/place/", {}, format="json").status_code, 400)  # Empty cart
+
+    def test_stale_tickets_are_rejected(self):
+        ticket = self.client.post("/queue/join/").data["ticket"]
+        waiting_room.open_room()
+        self.assertEqual(APIClient().get("/queue/status/", {"ticket": ticket}).status_code, 404)
+        self.assertEqual(APIClient().get("/queue/status/", {"ticket": "forged"}).status_code, 404)
+
+    def test_rate_follows_checkout_latency(self):
+        current = waiting_room.generation()
+        waiting_room.record_latency(5)
+        self.assertEqual(waiting_room.current_state(current)["rate"], 1)
+        for _ in range(20):
+            waiting_room.record_latency(0.01)
+        self.assertEqual(waiting_room.current_state(current)["rate"], 2)
+
+
+class PaymentGatewayTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeGatewayServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def gateway(self, **kwargs):
+        options = dict(base_url=self.server.url, retries=1, backoff=0, failure_threshold=2, reset_timeout=60)
+        return RazorpayGateway("key", "secret", **{**options, **kwargs})
+
+    def test_create_order(self):
+        gateway = self.gateway()
+        order = gateway.create_order(1000, "INR", "txn_1")
+        self.assertEqual((order["amount"], order["receipt"]), (1000, "txn_1"))
+        gateway.create_order(1000, "INR", "txn_2")
+        self.assertEqual(gateway.metrics.snapshot()["create_order"]["calls"], 2)
+        with self.assertRaises(PaymentGatewayRejected):
+            gateway.create_order(0, "INR", "txn_3")
+
+    def test_failed_attempts_are_retried(self):
+        gateway = self.gateway()
+        self.server.fail_requests = 1
+        self.assertEqual(gateway.fetch_order_payments("gw_1"), [])
+        self.assertEqual(gateway.metrics.snapshot()["fetch_order_payments"]["retries"], 1)
+
+    def test_order_creation_is_only_retried_before_reaching_the_gateway(self):
+        gateway = self.gateway(timeout=(1, 0.1))
+        self.server.delay = 0.3
+        with self.assertRaises(PaymentGatewayError):
+            gateway.create_order(1000, "INR", "txn_1")
+        self.assertEqual(len(self.server.requests), 1)
+
+        unreachable = self.gateway(base_url="http://127.0.0.1:9", retries=2)
+        with mock.patch.object(unreachable.session, "request", wraps=unreachable.session.request) as request:
+            with self.assertRaises(PaymentGatewayError):
+                unreachable.create_order(1000, "INR", "txn_1")
+        self.assertEqual(request.call_count, 2)
+
+    def test_attempts_stop_at_the_deadline(self):
+        gateway = self.gateway(timeout=(1, 5), deadline=0.3, retries=5, failure_threshold=10)
+        self.server.delay = 1
+        start = time.monotonic()
+        with self.assertRaises(PaymentGatewayError):
+            gateway.fetch_order_payments("gw_1")
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_slow_gateway_times_out(self):
+        gateway = self.gateway(timeout=(1, 0.1), retries=0)
+        self.server.delay = 0.5
+        start = time.monotonic()
+        with self.assertRaises(PaymentGatewayError):
+            gateway.create_order(1000, "INR", "txn_1")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        gateway = self.gateway()
+        self.server.fail_requests = 2
+        # Every failed attempt counts, the retry of the first call opens the circuit
+        with self.assertRaises(PaymentGatewayError):
+            gateway.fetch_order_payments("gw_1")
+        with self.assertRaises(CircuitOpenError):
+            gateway.create_order(1000, "INR", "txn_1")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(gateway.breaker.state, "open")
+
+        gateway.breaker.reset_timeout = 0
+        self.assertEqual(gateway.breaker.state, "half-open")
+        gateway.create_order(1000, "INR", "txn_1")
+        self.assertEqual(gateway.breaker.state, "closed")
+
+
+class FakeGatewayTests(SimpleTestCase):
+
+    def gateway(self, **kwargs):
+        overrides = override_settings(
+            PAYMENT_GATEWAY="fake", RAZORPAY_KEY_SECRET="secret", FAKE_GATEWAY_LATENCY=0,
+            PAYMENT_GATEWAY_RETRIES=0, PAYMENT_GATEWAY_TIMEOUT=(1, 0.05), **kwargs,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        return get_gateway()
+
+    def test_checkout_is_signed_like_the_real_gateway(self):
+        gateway = self.gateway()
+        self.assertIsInstance(gateway.api, FakeRazorpay)
+        order = gateway.create_order(1000, "INR", "txn_1")
+        paid = gateway.api.pay(order["id"])
+        self.assertTrue(gateway.verify_payment_signature(**{
+            "order_id": paid["razorpay_order_id"],
+            "payment_id": paid["razorpay_payment_id"],
+            "signature": paid["razorpay_signature"],
+        }))
+        self.assertFalse(gateway.verify_payment_signature(order["id"], "pay_other", paid["razorpay_signature"]))
+        self.assertEqual([p["status"] for p in gateway.fetch_order_payments(order["id"])], ["captured"])
+
+    def test_configured_errors(self):
+        with self.assertRaisesMessage(PaymentGatewayError, "Fake outage"):
+            self.gateway(FAKE_GATEWAY_ERROR_RATE=1).create_order(1000, "INR", "txn_1")
+
+    def test_configured_timeouts(self):
+        start = time.monotonic()
+        with self.assertRaisesMessage(PaymentGatewayError, "did not answer"):
+            self.gateway(FAKE_GATEWAY_TIMEOUT_RATE=1).create_order(1000, "INR", "txn_1")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class PaymentViewTests(TestCase):
+
+    def setUp(self):
+        self.server = FakeGatewayServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        settings_override = override_settings(
+            RAZORPAY_KEY_ID="key", RAZORPAY_KEY_SECRET="secret", RAZORPAY_API_URL=self.server.url,
+            PAYMENT_GATEWAY_RETRIES=0, PAYMENT_GATEWAY_BREAKER_THRESHOLD=1,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.order = Order.objects.create(id="order_1", user=self.user, updated_amount=250)
+
+    def test_payment_creates_gateway_order(self):
+        response = self.client.post(f"/payment/{self.order.id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["amount"], 25000)
+        self.assertTrue(response.data["razorpay_order_id"].startswith("order_"))
+        self.assertEqual(self.server.requests[0][1]["receipt"], response.data["transaction_id"])
+
+    def test_pending_payment_is_resumed(self):
+        first = self.client.post(f"/payment/{self.order.id}/").data
+        second = self.client.post(f"/payment/{self.order.id}/").data
+        self.assertEqual(second, first)
+        self.assertEqual(len(self.server.requests), 1)
+
+        Payment.objects.update(status="FAILED")
+        retried = self.client.post(f"/payment/{self.order.id}/").data
+        self.assertNotEqual(retried["razorpay_order_id"], first["razorpay_order_id"])
+        with override_settings(PAYMENT_ORDER_TTL=0):
+            expired = self.client.post(f"/payment/{self.order.id}/").data
+        self.assertNotEqual(expired["transaction_id"], retried["transaction_id"])
+        self.assertEqual(len(self.server.requests), 3)
+        payment = Payment.objects.get()
+        self.assertEqual((payment.status, payment.gateway_order_id), ("pending", expired["razorpay_order_id"]))
+
+        Payment.objects.update(status="PAYMENT_SUCCESS")
+        self.assertEqual(self.client.post(f"/payment/{self.order.id}/").status_code, 400)
+
+    def test_checkout_left_open_on_a_replaced_gateway_order_is_verified(self):
+        first = self.client.post(f"/payment/{self.order.id}/").data
+        Payment.objects.update(status="FAILED")
+        self.client.post(f"/payment/{self.order.id}/")
+        payment = Payment.objects.get()
+        self.assertEqual(payment.gateway_order_ids()[1:], [first["razorpay_order_id"]])
+
+        paid = self.server.pay(first["razorpay_order_id"])
+        with self.captureOnCommitCallbacks():
+            response = self.client.post(
+                "/payment_completed/verify/", {**paid, "transaction_id": first["transaction_id"]}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.is_verified)
+
+    def test_degraded_gateway_fails_fast(self):
+        self.server.fail_requests = 1
+        self.assertEqual(self.client.post(f"/payment/{self.order.id}/").status_code, 400)
+        response = self.client.post(f"/payment/{self.order.id}/")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+@override_settings(RAZORPAY_KEY_ID="key", RAZORPAY_KEY_SECRET="secret", CELERY_TASK_ALWAYS_EAGER=True)
+class PaymentVerifyTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo", name="Normal")
+        product = Product.objects.create(name="Sticker", price=100, for_user_positions=["user"])
+        CartItem.objects.create(user=self.user, product=product)
+        self.order = Order.objects.create(id="order_1", user=self.user, updated_amount=100)
+        OrderItem.objects.create(order=self.order, product=product, quantity=2)
+        self.payment = Payment.objects.create(
+            order=self.order, transaction_id="txn_1", paid_amount=100, status="pending", gateway_order_id="gw_1"
+        )
+
+    def verify(self):
+        signature = hmac.new(b"secret", b"gw_1|pay_1", hashlib.sha256).hexdigest()
+        return self.client.post("/payment_completed/verify/", {
+            "razorpay_order_id": "gw_1", "razorpay_payment_id": "pay_1",
+            "razorpay_signature": signature, "transaction_id": "txn_1",
+        })
+
+    def test_verify_defers_fulfilment_to_the_job_queue(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.verify()
+        self.assertEqual(response.status_code, 200)
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.is_verified)
+        self.assertTrue(self.order.fulfilment_pending)
+        self.assertFalse(OrderQRCode.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Added after paying, the job leaves it in the cart
+        mug = Product.objects.create(name="Mug", price=300, for_user_positions=["user"])
+        CartItem.objects.create(user=self.user, product=mug)
+        for callback in callbacks:
+            callback()
+        self.order.refresh_from_db()
+        self.assertTrue(OrderQRCode.objects.filter(order=self.order).exists())
+        self.assertTrue(self.order.mail_added)
+        self.assertEqual(list(CartItem.objects.filter(user=self.user).values_list("product", flat=True)), [mug.pk])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("Sticker x2", mail.outbox[0].body)
+
+    def test_failed_jobs_are_retried_without_repeating_work(self):
+        Payment.objects.filter(pk=self.payment.pk).update(status="PAYMENT_SUCCESS")
+        Order.objects.filter(pk=self.order.pk).update(is_verified=True, fulfilment_pending=True)
+        send = mock.Mock(side_effect=[ConnectionError("SMTP down"), None])
+        with mock.patch("order.tasks.send_order_success_email", send), \
+                mock.patch("order.utils.render_qr", wraps=render_qr) as render:
+            call_command("process_paid_orders", "--sync", stdout=StringIO())
+            call_command("process_paid_orders", "--sync", stdout=StringIO())
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(render.call_count, 1)
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.mail_added)
+        self.assertFalse(self.order.fulfilment_pending)
+
+    def test_process_local_cache_is_flagged_when_jobs_run_in_a_worker(self):
+        local = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        shared = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://"}}
+        with override_settings(CELERY_TASK_ALWAYS_EAGER=False, CACHES=local):
+            self.assertEqual([w.id for w in check_shared_cache(None)], ["order.W001"])
+        with override_settings(CELERY_TASK_ALWAYS_EAGER=False, CACHES=shared):
+            self.assertEqual(check_shared_cache(None), [])
+        self.assertEqual(check_shared_cache(None), [])
+
+    def test_orders_paid_before_the_job_queue_are_not_processed_again(self):
+        Order.objects.filter(pk=self.order.pk).update(is_verified=True)
+        out = StringIO()
+        call_command("process_paid_orders", "--sync", stdout=out)
+        self.assertIn("Processed 0 paid orders", out.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(CartItem.objects.filter(user=self.user).exists())
+
+
+@override_settings(
+    RAZORPAY_KEY_ID="key", RAZORPAY_KEY_SECRET="secret", RAZORPAY_WEBHOOK_SECRET="webhook-secret",
+    CELERY_TASK_ALWAYS_EAGER=True,
+)
+class PaymentWebhookTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo", name="Normal")
+        product = Product.objects.create(name="Sticker", price=100, for_user_positions=["user"])
+        self.order = Order.objects.create(id="order_1", user=self.user, updated_amount=100)
+        OrderItem.objects.create(order=self.order, product=product, quantity=1)
+        self.payment = Payment.objects.create(
+            order=self.order, transaction_id="txn_1", paid_amount=100, status="pending", gateway_order_id="gw_1"
+        )
+
+    def send(self, event_id, event, payment_id="pay_1", secret=b"webhook-secret", gateway_order_id="gw_1"):
+        body = json.dumps({
+            "event": event,
+            "payload": {"payment": {"entity": {"id": payment_id, "order_id": gateway_order_id, "amount": 10000}}},
+        })
+        return self.client.post(
+            "/payment/webhook/", body, content_type="application/json",
+            HTTP_X_RAZORPAY_SIGNATURE=hmac.new(secret, body.encode(), hashlib.sha256).hexdigest(),
+            HTTP_X_RAZORPAY_EVENT_ID=event_id,
+        )
+
+    def test_invalid_signature_is_rejected(self):
+        response = self.send("evt_1", "payment.captured", secret=b"wrong")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_burst_is_applied_once_per_payment(self):
+        with mock.patch("order.tasks.process_webhook_events.apply_async") as schedule:
+            for event_id, event, payment_id in [
+                ("evt_1", "payment.failed", "pay_0"),
+                ("evt_2", "payment.captured", "pay_1"),
+                ("evt_2", "payment.captured", "pay_1"),  # Redelivery
+                ("evt_3", "order.paid", "pay_1"),
+            ]:
+                self.assertEqual(self.send(event_id, event, payment_id).status_code, 200)
+        self.assertEqual(schedule.call_count, 1)
+        self.assertEqual(WebhookEvent.objects.count(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(webhooks.process_inbox(), 3)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "PAYMENT_SUCCESS")
+        self.assertEqual(self.payment.payment_id, "pay_1")
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.is_verified)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_webhook_after_browser_verification_does_not_fulfil_again(self):
+        signature = hmac.new(b"secret", b"gw_1|pay_1", hashlib.sha256).hexdigest()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/payment_completed/verify/", {
+                "razorpay_order_id": "gw_1", "razorpay_payment_id": "pay_1",
+                "razorpay_signature": signature, "transaction_id": "txn_1",
+            })
+            self.send("evt_1", "payment.captured")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(WebhookEvent.objects.get().processed_at)
+
+    def test_replaced_gateway_orders_can_capture_but_not_fail_the_payment(self):
+        PreviousGatewayOrder.objects.create(payment=self.payment, gateway_order_id="gw_0", transaction_id="txn_0")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send("evt_1", "payment.failed", "pay_0", gateway_order_id="gw_0")
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "pending")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send("evt_2", "payment.captured", "pay_1", gateway_order_id="gw_0")
+            webhooks.process_inbox()
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.payment_id), ("PAYMENT_SUCCESS", "pay_1"))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_payment_releases_its_discount_use(self):
+        code = DiscountCode.objects.create(
+            code="DROP", discount_percentage=10, max_uses=1, reserved=1,
+            expiry_date=timezone.now() + timedelta(days=1),
+        )
+        Order.objects.filter(pk=self.order.pk).update(discount_code=code, discount_usage="reserved")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send("evt_1", "payment.failed")
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "FAILED")
+        code.refresh_from_db()
+        self.assertEqual(code.reserved, 0)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class ReconcilePaymentsTests(TestCase):
+
+    def setUp(self):
+        self.server = FakeGatewayServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.gateway = RazorpayGateway(
+            "key", "secret", base_url=self.server.url, retries=0, backoff=0, failure_threshold=1,
+        )
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo", name="Normal")
+        product = Product.objects.create(name="Sticker", price=100, for_user_positions=["user"])
+        for i in range(1, 6):
+            order = Order.objects.create(id=f"order_{i}", user=self.user, updated_amount=100)
+            OrderItem.objects.create(order=order, product=product)
+            Payment.objects.create(
+                order=order, transaction_id=f"txn_{i}", paid_amount=100, status="pending", gateway_order_id=f"gw_{i}"
+            )
+        # The last checkout is still within its window
+        Payment.objects.exclude(gateway_order_id="gw_5").update(payment_date=timezone.now() - timedelta(hours=1))
+
+    def test_outcomes_are_applied_in_chunks(self):
+        self.server.payments = {
+            "gw_1": [{"id": "pay_0", "status": "failed"}, {"id": "pay_1", "status": "captured"}],
+            "gw_2": [{"id": "pay_2", "status": "failed"}],
+            "gw_4": [{"id": "pay_4", "status": "authorized"}],
+        }
+        progress = []
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = reconcile_pending_payments(self.gateway, chunk_size=2, concurrency=2, rate=0, progress=progress.append)
+
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(
+            {key: stats[key] for key in ("checked", "captured", "failed", "pending", "errors")},
+            {"checked": 4, "captured": 1, "failed": 2, "pending": 1, "errors": 0},
+        )
+        self.assertEqual(len(self.server.requests), 4)
+        payments = {p.gateway_order_id: p for p in Payment.objects.all()}
+        self.assertEqual((payments["gw_1"].status, payments["gw_1"].payment_id), ("PAYMENT_SUCCESS", "pay_1"))
+        self.assertEqual(payments["gw_2"].reason, "reconciled_failed")
+        self.assertEqual(payments["gw_3"].reason, "reconciled_expired")
+        self.assertEqual({payments[key].status for key in ("gw_4", "gw_5")}, {"pending"})
+        self.assertTrue(Order.objects.get(id="order_1").is_verified)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_replaced_gateway_orders_are_looked_up(self):
+        payment = Payment.objects.get(gateway_order_id="gw_3")
+        PreviousGatewayOrder.objects.create(payment=payment, gateway_order_id="gw_3_old", transaction_id="txn_3_old")
+        self.server.payments = {"gw_3_old": [{"id": "pay_3", "status": "captured"}]}
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = reconcile_pending_payments(self.gateway, rate=0)
+        self.assertEqual(stats["captured"], 1)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.payment_id), ("PAYMENT_SUCCESS", "pay_3"))
+
+    def test_stops_when_the_gateway_fails(self):
+        self.server.fail_requests = 100
+        stats = reconcile_pending_payments(self.gateway, chunk_size=2, concurrency=1, rate=0)
+        self.assertEqual((stats["checked"], stats["errors"]), (2, 2))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(stats["last_id"], Payment.objects.order_by("pk")[1].pk)
+        self.assertEqual(Payment.objects.filter(status="pending").count(), 5)
+
+        self.server.fail_requests = 0
+        self.gateway.breaker.record_success()
+        resumed = reconcile_pending_payments(self.gateway, after=stats["last_id"], rate=0)
+        self.assertEqual(resumed["checked"], 2)
+
+    def test_rate_limit_spaces_lookups(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+
+class OrderQRCodeTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.order = Order.objects.create(id="order_1", user=self.user, updated_amount=100, is_verified=True)
+        Payment.objects.create(order=self.order, transaction_id="txn_1", paid_amount=100, status="PAYMENT_SUCCESS")
+
+    def test_order_json_links_to_a_cacheable_image(self):
+        url = OrderSerializer(self.order).data["qr_code_url"]
+        self.assertNotIn("qr_code_data", OrderSerializer(self.order).data)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(bytes(OrderQRCode.objects.get().png), response.content)
+
+        with mock.patch("order.utils.render_qr") as render:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+            self.assertEqual(self.client.get(url).content, response.content)
+        render.assert_not_called()
+
+        svg = self.client.get(url.replace(".png", ".svg"))
+        self.assertEqual(svg["Content-Type"], "image/svg+xml")
+        self.assertNotEqual(svg["ETag"], response["ETag"])
+
+    def test_urls_of_other_qr_settings_versions_are_revalidated(self):
+        url = OrderSerializer(self.order).data["qr_code_url"]
+        self.assertTrue(url.endswith(f"?v={QR_CONFIG_VERSION}"))
+        for stale in (url.split("?")[0], url.replace(f"v={QR_CONFIG_VERSION}", f"v={QR_CONFIG_VERSION - 1}")):
+            response = self.client.get(stale)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+    def test_only_signed_urls_of_paid_orders_are_served(self):
+        self.assertEqual(self.client.get(f"/order/qr/{self.order.id}:forged.png").status_code, 404)
+        Order.objects.filter(pk=self.order.pk).update(is_verified=False)
+        self.order.refresh_from_db()
+        self.assertIsNone(OrderSerializer(self.order).data["qr_code_url"])
+        self.assertEqual(self.client.get(f"/order/qr/{qr_code_token(self.order.id)}.png").status_code, 404)
+
+    def test_stored_base64_codes_are_moved_out_of_the_orders(self):
+        png = render_qr("order_1|txn_1")
+        Order.objects.filter(pk=self.order.pk).update(qr_code_data=base64.b64encode(png).decode())
+        call_command("move_qr_codes", stdout=StringIO())
+        self.order.refresh_from_db()
+        self.assertIsNone(self.order.qr_code_data)
+        with mock.patch("order.utils.render_qr") as render:
+            response = self.client.get(OrderSerializer(self.order).data["qr_code_url"])
+        render.assert_not_called()
+        self.assertEqual(response.content, png)
+
+
+class QRCodeBatchTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        user = User.objects.create_user(email="normal@user.com", password="foo")
+        for i in range(5):
+            order = Order.objects.create(id=f"order_{i}", user=user, updated_amount=100, is_verified=i < 4)
+            Payment.objects.create(order=order, transaction_id=f"txn_{i}", paid_amount=100, status="PAYMENT_SUCCESS")
+        OrderQRCode.objects.create(order_id="order_0", png=b"stored", etag="stored")
+
+    def test_missing_codes_are_generated_in_resumable_chunks(self):
+        progress = []
+        first = pregenerate_qr_codes(chunk_size=2, limit=2, progress=progress.append)
+        self.assertEqual((first["generated"], first["last_id"]), (2, "order_2"))
+        self.assertEqual(len(progress), 1)
+        with ProcessPoolExecutor(2) as pool:
+            rest = pregenerate_qr_codes(pool=pool, slices=2, chunk_size=2)
+        self.assertEqual(rest["generated"], 1)
+
+        codes = {code.order_id: bytes(code.png) for code in OrderQRCode.objects.all()}
+        self.assertEqual(sorted(codes), ["order_0", "order_1", "order_2", "order_3"])
+        self.assertEqual(codes["order_0"], b"stored")
+        self.assertEqual(codes["order_3"], render_qr("order_3|txn_3"))
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_job_queues_one_job_per_chunk(self):
+        with mock.patch("order.utils.render_qr_batch", wraps=render_qr_batch) as render:
+            tasks.pregenerate_qr_codes.delay("", 2)
+        self.assertEqual(OrderQRCode.objects.count(), 4)
+        self.assertEqual(render.call_count, 2)
+
+    def test_codes_have_a_fixed_size(self):
+        short, long = (render_qr(payload) for payload in ("o|t", "Barracks_order_123456|Barracks_order_1234561718000000000"))
+        self.assertEqual(Image.open(BytesIO(short)).size, Image.open(BytesIO(long)).size)
+
+
+class IdempotencyTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        product = Product.objects.create(name="Sticker", price=100, for_user_positions=["user"])
+        CartItem.objects.create(user=self.user, product=product)
+
+    def checkout(self, key, **data):
+        return self.client.post("/order/place/", data, format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retries_replay_the_first_response(self):
+        first = self.checkout("abc")
+        second = self.checkout("abc")
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(second.json()["order"]["id"], first.data["order"]["id"])
+        self.assertEqual(Order.objects.count(), 1)
+        self.checkout("def")
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_key_reused_for_a_different_request(self):
+        self.checkout("abc")
+        self.assertEqual(self.checkout("abc", discount_code="X").status_code, 422)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0.2, IDEMPOTENCY_POLL_INTERVAL=0.05)
+    def test_duplicates_wait_for_the_in_flight_request(self):
+        self.checkout("abc")
+        record = IdempotencyKey.objects.get(key="abc")
+        record.response_status = None
+        record.save()
+        self.assertEqual(self.checkout("abc").status_code, 409)
+
+        IdempotencyKey.objects.filter(id=record.id).update(response_status=201, response_body={"done": True})
+        response = self.checkout("abc")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"done": True})
+
+    def test_abandoned_requests_are_taken_over_once_their_lease_passes(self):
+        self.checkout("abc")
+        IdempotencyKey.objects.filter(key="abc").update(
+            response_status=None, locked_until=timezone.now() - timedelta(seconds=1),
+        )
+        response = self.checkout("abc")
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_interrupted_requests_release_the_key(self):
+        class InterruptedView(APIView):
+            @idempotent
+            def post(self, request):
+                raise SystemExit
+
+        request = APIRequestFactory().post("/interrupted/", {}, format="json", HTTP_IDEMPOTENCY_KEY="abc")
+        force_authenticate(request, self.user)
+        with self.assertRaises(SystemExit):
+            InterruptedView.as_view()(request)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+@override_settings(ORDER_ID_START=1000000)
+class OrderIdAllocatorTests(TransactionTestCase):
+
+    def test_workers_never_overlap(self):
+        workers = [OrderIdAllocator(block_size=size) for size in (1, 3, 7, 20)]
+        ids = [random.choice(workers).allocate() for _ in range(2000)]
+        self.assertEqual(len(set(ids)), 2000)
+        self.assertGreaterEqual(min(ids), 1000000)
+
+    def test_threads_share_an_allocator(self):
+        allocator = OrderIdAllocator(block_size=7)
+        results = []
+
+        def allocate():
+            results.extend(allocator.allocate() for _ in range(250))
+            connection.close()
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 2000)
+        self.assertEqual(len(set(results)), 2000)
+
+    def test_rolled_back_reservations_are_not_reused(self):
+        allocator = OrderIdAllocator(block_size=20)
+        try:
+            with transaction.atomic():
+                allocator.allocate()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(allocator.end, 0)
+        self.assertEqual(allocator.allocate(), 1000000)
+        self.assertEqual(OrderIdSequence.objects.get(name="order").next_value, 1000020)
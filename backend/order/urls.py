@@ -5,7 +5,11 @@ from .views import *
 urlpatterns = [
     path("order/all/", AllOrders.as_view(), name="all_orders"),
     path("order/<int:order_id>/", OrderView.as_view(), name="order_view"),
+    path("order/qr/<str:token>.png", serve_qr_code, {"image_format": "png"}, name="order_qr_png"),
+    path("order/qr/<str:token>.svg", serve_qr_code, {"image_format": "svg"}, name="order_qr_svg"),
     path("order/place/", Checkout.as_view(), name="place_order"),
+    path("queue/join/", JoinWaitingRoom.as_view(), name="join_waiting_room"),
+    path("queue/status/", WaitingRoomStatus.as_view(), name="waiting_room_status"),
     path("order/apply-discount/", ApplyDiscount.as_view(), name="apply_discount"),
     # path("payment/success/", PaymentSuccessView.as_view(), name="payment_success"),
     # path("payment/failure/", PaymentFailureView.as_view(), name="payment_failure"),
@@ -16,6 +20,7 @@ urlpatterns = [
     path(
         "payment_completed/result/", PaymentResultView.as_view(), name="payment_result"
     ),
+    path("payment/webhook/", PaymentWebhookView.as_view(), name="payment_webhook"),
     path("payment/<str:order_id>/", PaymentView.as_view(), name="payment_checkout"),
     # VULN-C1D2E3: Open Redirect after payment
     path("redirect/", OpenRedirectView.as_view(), name="open_redirect"),
@@ -1,28 +1,90 @@
-import qrcode
-import base64
+import hashlib
 from io import BytesIO
 
+import qrcode
+import qrcode.image.svg
+from qrcode.exceptions import DataOverflowError
+from django.core import signing
 
-def generate_qr_code(order):
+QR_SIGNING_SALT = "order.qr_code"
+# Part of every QR code's ETag, bump it when the QR code settings change so cached images are replaced
+QR_CONFIG_VERSION = 2
+# Fixed settings, so every code has the same size and takes the same time to make. Version 4 at
+# error correction M fits order IDs of up to 12 digits, longer payloads fall back to a bigger version.
+QR_VERSION = 4
+QR_ERROR_CORRECTION = qrcode.constants.ERROR_CORRECT_M
+QR_BOX_SIZE = 6
+QR_BORDER = 4  # The quiet zone scanners expect
+QR_MASK_PATTERN = 0  # Skips scoring all eight masks for every code
+
+
+def qr_payload(order):
+    """
+    What the QR code encodes, scanned at pickup, see dashboard.views.
+    """
+    return f"{order.id}|{order.payment.transaction_id}"
+
+
+def qr_etag(payload):
+    return hashlib.sha256(f"{QR_CONFIG_VERSION}:{payload}".encode()).hexdigest()[:32]
+
+
+def render_qr(payload, image_format="png"):
     qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=2,
+        version=QR_VERSION,
+        error_correction=QR_ERROR_CORRECTION,
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER,
+        mask_pattern=QR_MASK_PATTERN,
     )
-    data = f"{order.id}|{order.payment.transaction_id}"
-    qr.add_data(data)
-    qr.make(fit=True)
-
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    qr_img_io = BytesIO()
-    qr_img.save(qr_img_io, format="PNG")
-    qr_img_io.seek(0)
-
-    # Encode the QR image as Base64
-    qr_base64 = base64.b64encode(qr_img_io.read()).decode("utf-8")
-
-    # Save the Base64 string to the order
-    order.qr_code_data = qr_base64
-    order.save()
-    return qr_base64
+    qr.add_data(payload)
+    try:
+        qr.make(fit=False)
+    except DataOverflowError:
+        qr.make(fit=True)
+
+    output = BytesIO()
+    if image_format == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(output)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(output, format="PNG")
+    return output.getvalue()
+
+
+def render_qr_batch(payloads):
+    """
+    PNG QR codes of `payloads`, the unit of work of the process pool in
+    order.qr_batch.
+    """
+    return [render_qr(payload) for payload in payloads]
+
+
+def generate_qr_code(order):
+    """
+    Return the PNG QR code of a paid order, generating and storing it on
+    first use.
+    """
+    from .models import OrderQRCode
+
+    payload = qr_payload(order)
+    etag = qr_etag(payload)
+    stored = OrderQRCode.objects.filter(order=order, etag=etag).values_list("png", flat=True).first()
+    if stored is not None:
+        return bytes(stored)
+    png = render_qr(payload)
+    OrderQRCode.objects.update_or_create(order=order, defaults={"png": png, "etag": etag})
+    return png
+
+
+def qr_code_token(order_id):
+    return signing.Signer(salt=QR_SIGNING_SALT).sign(str(order_id))
+
+
+def qr_code_order_id(token):
+    """
+    Return the order ID a QR code URL was signed for, or None.
+    """
+    try:
+        return signing.Signer(salt=QR_SIGNING_SALT).unsign(token)
+    except signing.BadSignature:
+        return None
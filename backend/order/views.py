@@ -1,31 +1,38 @@
 import time
 import json
-import razorpay
 from rest_framework.views import APIView
 from django.shortcuts import redirect
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.conf import settings
-from django.db import transaction
+from django.utils import timezone
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from .models import Order, OrderItem, Payment
+from django.views.decorators.http import require_safe
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from .models import Order, OrderItem, Payment, PreviousGatewayOrder
 from .serializers import OrderSerializer, PaymentSerializer
-from .utils import generate_qr_code
-from discounts.models import DiscountCode
+from .ids import new_order_id
+from .utils import QR_CONFIG_VERSION, generate_qr_code, qr_code_order_id, qr_etag, qr_payload, render_qr
+from .idempotency import idempotent
+from .gateway import CircuitOpenError, PaymentGatewayError, get_gateway
+from . import waiting_room, webhooks
+from .waiting_room import Admitted
+from backend.pagination import KeysetPagination
+from discounts import usage
+from discounts.index import discount_index
 from products.models import CartItem
 from requests.exceptions import HTTPError
 
-from .tasks import send_order_success_email_async
+from .tasks import enqueue_paid_order
 from datetime import datetime, timedelta
 import pytz
-import random
 
-# Razorpay client
-razorpay_client = razorpay.Client(
-    auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET)
-)
 
 
 class AllOrders(APIView):
@@ -33,7 +40,19 @@ class AllOrders(APIView):
 
     def get(self, request):
         user = request.user
-        queryset = Order.objects.filter(user=user, is_verified=True)
+        queryset = (
+            Order.objects.filter(user=user, is_verified=True)
+            .select_related("discount_code")
+            .prefetch_related(
+                Prefetch("order_items", queryset=OrderItem.objects.select_related("product"))
+            )
+        )
+        paginator = KeysetPagination(ordering=("-created_at", "-id"))
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            serializer = OrderSerializer(page, many=True, context={"user": user})
+            return paginator.get_paginated_response(serializer.data)
+
         serializer = OrderSerializer(queryset, many=True, context={"user": user})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -43,13 +62,50 @@ class OrderView(APIView):
 
     def get(self, request, order_id):
         user = request.user
-        order = Order.objects.filter(id=order_id, user=user).first()
+        order = (
+            Order.objects.filter(id=order_id, user=user)
+            .select_related("discount_code")
+            .prefetch_related(
+                Prefetch("order_items", queryset=OrderItem.objects.select_related("product"))
+            )
+            .first()
+        )
         if order is None:
             return Response(status=status.HTTP_400_BAD_REQUEST)
         serializer = OrderSerializer(order, context={"user": user})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+QR_CODE_CONTENT_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+@require_safe
+def serve_qr_code(request, token, image_format):
+    """
+    QR code image of a paid order. The URL is signed, so it can be used in an
+    <img> tag without credentials. A URL of the current QR code settings
+    version never changes image, so it is cached by the browser for good,
+    others are revalidated by ETag.
+    """
+    order_id = qr_code_order_id(token)
+    order = Order.objects.filter(id=order_id, is_verified=True).select_related("payment").first()
+    if order is None or not hasattr(order, "payment"):
+        raise Http404("QR code not found")
+
+    payload = qr_payload(order)
+    etag = quote_etag(f"{qr_etag(payload)}-{image_format}")
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        image = generate_qr_code(order) if image_format == "png" else render_qr(payload, image_format)
+        response = HttpResponse(image, content_type=QR_CODE_CONTENT_TYPES[image_format])
+    response["ETag"] = etag
+    if request.GET.get("v") == str(QR_CONFIG_VERSION):
+        response["Cache-Control"] = f"private, max-age={settings.MEDIA_CACHE_MAX_AGE}, immutable"
+    else:
+        response["Cache-Control"] = "private, no-cache"
+    return response
+
+
 class ApplyDiscount(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -90,50 +146,79 @@ class ApplyDiscount(APIView):
                 status=status.HTTP_200_OK,
             )
 
-        try:
-            discount = DiscountCode.objects.get(code=discount_code)
-            if discount.is_valid() and user.position in discount.for_user_positions:
-                discount_percentage = discount.discount_percentage
-                if discount_percentage == 100:
-                    return Response(
-                        {
-                            "total_amount": float(total_amount),
-                            "discount_percentage": float(discount_percentage),
-                            "updated_amount": 1.00,
-                        },
-                        status=status.HTTP_200_OK,
-                    )
-                updated_amount = (total_amount) - (total_amount) * (
-                    discount_percentage / 100
-                )
+        discount = discount_index.get(discount_code)
+        if discount is None:
+            return Response(
+                {"detail": "Discount code does not exist."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # Usage limits are checked on the live counters when the order is placed, see discounts.index
+        if not discount.has_expired() and user.position in discount.positions:
+            discount_percentage = discount.discount_percentage
+            if discount_percentage == 100:
                 return Response(
                     {
                         "total_amount": float(total_amount),
                         "discount_percentage": float(discount_percentage),
-                        "updated_amount": float(updated_amount),
+                        "updated_amount": 1.00,
                     },
                     status=status.HTTP_200_OK,
                 )
-            else:
-                return Response(
-                    {"detail": "Invalid or expired discount code."},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-        except DiscountCode.DoesNotExist:
+            updated_amount = (total_amount) - (total_amount) * (
+                discount_percentage / 100
+            )
             return Response(
-                {"detail": "Discount code does not exist."},
+                {
+                    "total_amount": float(total_amount),
+                    "discount_percentage": float(discount_percentage),
+                    "updated_amount": float(updated_amount),
+                },
+                status=status.HTTP_200_OK,
+            )
+        else:
+            return Response(
+                {"detail": "Invalid or expired discount code."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
 
-class Checkout(APIView):
+class JoinWaitingRoom(APIView):
     permission_classes = [IsAuthenticated]
 
+    def post(self, request):
+        if not settings.WAITING_ROOM_ENABLED:
+            return Response({"position": 0, "admitted": True}, status=status.HTTP_200_OK)
+        return Response(waiting_room.join(request.user.id), status=status.HTTP_200_OK)
+
+
+class WaitingRoomStatus(APIView):
+    # Polled by every waiting client, the signed ticket stands in for the token so no query is made
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        if not settings.WAITING_ROOM_ENABLED:
+            return Response({"position": 0, "admitted": True}, status=status.HTTP_200_OK)
+        ticket_status = waiting_room.ticket_status(request.query_params.get("ticket", ""))
+        if ticket_status is None:
+            return Response(
+                {"detail": "Invalid or expired ticket, join the waiting room again."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        return Response(ticket_status, status=status.HTTP_200_OK)
+
+
+class Checkout(APIView):
+    permission_classes = [IsAuthenticated, Admitted]
+
+    @waiting_room.observe_latency
+    @idempotent
     def post(self, request):
         user = request.user
-        cart_items = CartItem.objects.filter(user=user)
+        # The cart and its products are read once and reused for every step below
+        cart_items = list(CartItem.objects.for_user(user))
 
-        if not cart_items.exists():
+        if not cart_items:
             return Response(
                 {"detail": "No items in cart."}, status=status.HTTP_400_BAD_REQUEST
             )
@@ -160,70 +245,90 @@ class Checkout(APIView):
         discount_code = request.data.get("discount_code")
 
         if discount_code:
-            try:
-                discount = DiscountCode.objects.get(code=discount_code)
-                if discount.is_valid() and user.position in discount.for_user_positions:
-                    discount_percentage = discount.discount_percentage
-                    if discount_percentage == 100:
-                        updated_amount = 1.00
-                    else:
-                        # Only apply discount if no client amount was provided
-                        if client_amount is None:
-                            updated_amount = total_amount - total_amount * (
-                                discount_percentage / 100
-                            )
-                else:
-                    return Response(
-                        {"detail": "Invalid or expired discount code."},
-                        status=status.HTTP_400_BAD_REQUEST,
-                    )
-            except DiscountCode.DoesNotExist:
+            discount = discount_index.get(discount_code)
+            if discount is None:
                 return Response(
                     {"detail": "Discount code does not exist."},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
+            # The index counters are stale, usage.reserve() below decides whether uses are left
+            if not discount.has_expired() and user.position in discount.positions:
+                discount_percentage = discount.discount_percentage
+                if discount_percentage == 100:
+                    updated_amount = 1.00
+                else:
+                    # Only apply discount if no client amount was provided
+                    if client_amount is None:
+                        updated_amount = total_amount - total_amount * (
+                            discount_percentage / 100
+                        )
+            else:
+                return Response(
+                    {"detail": "Invalid or expired discount code."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
 
+        discount_percentage = discount.discount_percentage if discount_code else None
+
+        # Allocated outside the transaction so the ID can come from the reserved block
+        order_id = new_order_id()
         with transaction.atomic():
-            id_num = random.randint(100000, 999999)
-            while Order.objects.filter(id=f"Barracks_order_{id_num}").exists():
-                id_num = random.randint(100000, 999999)
+            discount_shard = None
+            if discount_code:
+                # Rolled back with the order if anything below fails
+                try:
+                    discount_shard = usage.reserve(discount)
+                except usage.DiscountCodeExhausted:
+                    return Response(
+                        {"detail": "Discount code has no uses left."},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
             order = Order.objects.create(
-                id=f"Barracks_order_{id_num}",
+                id=order_id,
                 user=user,
                 updated_amount=updated_amount,
                 total_amount=total_amount,
+                discount_code=discount if discount_code else None,
+                discount_percentage=discount_percentage,
+                discount_amount=Order.discount_for(total_amount, discount_percentage or 0),
+                discount_usage="reserved" if discount_code else "",
+                discount_shard=discount_shard,
+            )
+            OrderItem.objects.bulk_create(
+                [
+                    OrderItem(
+                        order=order,
+                        product=item.product,
+                        printing_name=item.printing_name,
+                        size=item.size,
+                        image_url=item.image_url,
+                        quantity=item.quantity,
+                        unit_price=item.product.price,
+                        line_total=item.product.price * item.quantity,
+                    )
+                    for item in cart_items
+                ]
             )
-            for item in cart_items:
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    printing_name=item.printing_name,
-                    size=item.size,
-                    image_url=item.image_url,
-                    quantity=item.quantity,
-                )
-
-            if discount_code:
-                order.discount_code = discount
-                order.save()
 
+        prefetch_related_objects(
+            [order], Prefetch("order_items", queryset=OrderItem.objects.select_related("product"))
+        )
         serializer = OrderSerializer(order, context={"request": request})
         return Response(
             {
                 "order": serializer.data,
                 "total_amount": float(total_amount),
                 "updated_amount": float(updated_amount),
-                "discount_percentage": float(
-                    discount.discount_percentage if discount_code else 0
-                ),
+                "discount_percentage": float(discount_percentage or 0),
             },
             status=status.HTTP_201_CREATED,
         )
 
 
 class PaymentView(APIView):
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, Admitted]
 
+    @idempotent
     def post(self, request, order_id):
         user = request.user
         try:
@@ -233,44 +338,77 @@ class PaymentView(APIView):
                 {"detail": "Order not found."}, status=status.HTTP_404_NOT_FOUND
             )
 
-        unique_transaction_id = str(order.id) + str(int(time.time() * 1000))
-        amount = int(order.updated_amount * 100)
+        payment = Payment.objects.filter(order=order).first()
+        if order.is_verified or (payment and payment.status == "PAYMENT_SUCCESS"):
+            return Response(
+                {"detail": "Order is already paid."}, status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Create pending payment record
-        Payment.objects.create(
-            order=order,
-            transaction_id=unique_transaction_id,
-            paid_amount=order.updated_amount,
-            status="pending",
-        )
+        # A pending payment keeps its gateway order, only expired or failed ones get a new one
+        if payment is None or not payment.can_resume(order.updated_amount):
+            unique_transaction_id = str(order.id) + str(int(time.time() * 1000))
+            amount = int(order.updated_amount * 100)
 
-        # Create Razorpay order
-        try:
-            razorpay_order = razorpay_client.order.create(
-                dict(
-                    amount=amount,
-                    currency="INR",
-                    receipt=unique_transaction_id,
-                    payment_capture=1,
+            # Create Razorpay order
+            try:
+                razorpay_order = get_gateway().create_order(amount, "INR", unique_transaction_id)
+            except CircuitOpenError as e:
+                return Response(
+                    {"detail": "Payment gateway is unavailable, please retry shortly."},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={"Retry-After": str(int(e.retry_after))},
                 )
-            )
-        except Exception as e:
-            return Response(
-                {"detail": "Payment initiation failed."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+            except PaymentGatewayError:
+                return Response(
+                    {"detail": "Payment initiation failed."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            payment = self.save_payment(order, payment, unique_transaction_id, razorpay_order.get("id"))
 
         return Response(
             {
-                "razorpay_order_id": razorpay_order.get("id"),
+                "razorpay_order_id": payment.gateway_order_id,
                 "razorpay_key_id": settings.RAZORPAY_KEY_ID,
-                "amount": amount,
+                "amount": int(payment.paid_amount * 100),
                 "currency": "INR",
-                "transaction_id": unique_transaction_id,
+                "transaction_id": payment.transaction_id,
             },
             status=status.HTTP_200_OK,
         )
 
+    def save_payment(self, order, previous, transaction_id, gateway_order_id):
+        """
+        Store the new gateway order as the order's pending payment, keeping the
+        one it replaces, which a checkout left open may still pay. If a
+        concurrent request stored one first, that payment is returned instead.
+        """
+        fields = dict(
+            transaction_id=transaction_id,
+            gateway_order_id=gateway_order_id,
+            paid_amount=order.updated_amount,
+            status="pending",
+            payment_id=None,
+            reason=None,
+            payment_date=timezone.now(),
+        )
+        if previous is None:
+            try:
+                with transaction.atomic():
+                    return Payment.objects.create(order=order, **fields)
+            except IntegrityError:
+                pass
+        else:
+            with transaction.atomic():
+                if Payment.objects.filter(pk=previous.pk, transaction_id=previous.transaction_id).update(**fields):
+                    if previous.gateway_order_id:
+                        PreviousGatewayOrder.objects.create(
+                            payment=previous,
+                            gateway_order_id=previous.gateway_order_id,
+                            transaction_id=previous.transaction_id,
+                        )
+                    return Payment.objects.get(pk=previous.pk)
+        return Payment.objects.get(order=order)
+
 
 # Working with POST UI CALLBACK, SHUDNT BE USED IN PROD
 # class PaymentVerifyView(APIView):
@@ -324,65 +462,68 @@ class PaymentVerifyView(APIView):
                 {"detail": "Invalid payload."}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            payment = Payment.objects.get(transaction_id=transaction_id)
-        except Payment.DoesNotExist:
+        # A checkout left open on a replaced gateway order sends that order's transaction ID
+        payment = (
+            Payment.objects.filter(transaction_id=transaction_id).first()
+            or Payment.objects.filter(previous_gateway_orders__transaction_id=transaction_id).first()
+        )
+        if payment is None:
             return Response(
                 {"detail": "Payment record not found."},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        # Verify signature
-        try:
-            razorpay_client.utility.verify_payment_signature(
-                {
-                    "razorpay_order_id": razorpay_order_id,
-                    "razorpay_payment_id": razorpay_payment_id,
-                    "razorpay_signature": razorpay_signature,
-                }
+        # The signature only covers the gateway order it was issued for
+        gateway_order_ids = payment.gateway_order_ids()
+        if gateway_order_ids and razorpay_order_id not in gateway_order_ids:
+            return Response(
+                {"detail": "Payment verification failed."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-        except Exception:
+
+        # Verify signature
+        if not get_gateway().verify_payment_signature(
+            razorpay_order_id, razorpay_payment_id, razorpay_signature
+        ):
             payment.status = "FAILED"
             payment.reason = "signature_verification_failed"
             payment.save()
             payment.order.is_verified = False
             payment.order.save()
+            payment.order.release_discount()
             return Response(
                 {"detail": "Payment verification failed."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Success: mark order verified and send email
-        payment.status = "PAYMENT_SUCCESS"
-        payment.payment_id = razorpay_payment_id
-        payment.reason = "captured"
-        payment.save()
-
-        payment.order.is_verified = True
-        payment.order.save()
-
-        if payment.order.discount_code:
-            payment.order.discount_code.uses += 1
-            payment.order.discount_code.save()
-
-        CartItem.objects.filter(user=payment.order.user).delete()
-
-        order_items = OrderItem.objects.filter(order=payment.order).all()
-        prod_list = []
-        for item in order_items:
-            prod_list.append(f"{item.product.name}x{item.quantity}")
-        qr_data = generate_qr_code(payment.order)
-        send_order_success_email_async(
-            payment.transaction_id,
-            payment.order.updated_amount,
-            prod_list,
-            payment.order.user.name,
-            qr_data,
-            payment.order.user.email,
-        )
+        # Success: commit the state change, the rest runs as a background job.
+        # The payment webhook may have captured it first.
+        if payment.mark_captured(razorpay_payment_id):
+            enqueue_paid_order(payment.order_id)
         return Response({"detail": "Payment successful."}, status=status.HTTP_200_OK)
 
 
+class PaymentWebhookView(APIView):
+    """
+    Server to server payment events from Razorpay. Events are only stored
+    here and applied in batches by a background job, see order.webhooks.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        body = request.body.decode("utf-8", errors="replace")
+        if not get_gateway().verify_webhook_signature(body, request.headers.get("X-Razorpay-Signature")):
+            return Response({"detail": "Invalid signature."}, status=status.HTTP_400_BAD_REQUEST)
+        event_id = request.headers.get("X-Razorpay-Event-Id")
+        if not event_id:
+            return Response({"detail": "Missing event ID."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if webhooks.store(event_id, body):
+            webhooks.schedule_batch()
+        return Response({"detail": "Received."}, status=status.HTTP_200_OK)
+
+
 class PaymentResultView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -433,20 +574,19 @@ class CheckDiscountUnlimited(APIView):
             return Response({'valid': False, 'message': 'Code required'}, status=status.HTTP_400_BAD_REQUEST)
         
         # VULN: No rate limiting - attacker can brute force discount codes
-        try:
-            discount = DiscountCode.objects.get(code=code)
-            if discount.is_valid():
-                return Response({
-                    'valid': True,
-                    'code': discount.code,
-                    'discount_percentage': discount.discount_percentage,
-                    'max_uses': discount.max_uses,
-                    'uses': discount.uses
-                }, status=status.HTTP_200_OK)
-            else:
-                return Response({'valid': False, 'message': 'Code expired or max uses reached'}, status=status.HTTP_200_OK)
-        except DiscountCode.DoesNotExist:
+        discount = discount_index.get(code)
+        if discount is None:
             return Response({'valid': False, 'message': 'Invalid code'}, status=status.HTTP_200_OK)
+        if discount.is_valid():
+            return Response({
+                'valid': True,
+                'code': discount.code,
+                'discount_percentage': discount.discount_percentage,
+                'max_uses': discount.max_uses,
+                'uses': discount.uses
+            }, status=status.HTTP_200_OK)
+        else:
+            return Response({'valid': False, 'message': 'Code expired or max uses reached'}, status=status.HTTP_200_OK)
 
 
 # VULN-G8H9I1: IDOR - View any user's order details
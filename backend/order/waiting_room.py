@@ -0,0 +1,202 @@
+"""
+Virtual waiting room in front of the cart and checkout flow during drops.
+
+Users join the room and get a numbered ticket. Tickets up to the admission
+frontier are admitted, and the frontier moves forward at an admission rate
+that adapts to the observed checkout latency: it grows by
+WAITING_ROOM_RATE_STEP while checkouts are faster than
+WAITING_ROOM_TARGET_LATENCY and is halved when they are slower. All state
+lives in the shared cache, and ticket positions are polled with a signed
+ticket on an unauthenticated endpoint, so waiting users never touch the
+database.
+
+The room only applies while WAITING_ROOM_ENABLED is set, and is reset each
+time orders are opened from the dashboard.
+"""
+import functools
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from rest_framework.exceptions import Throttled
+from rest_framework.permissions import BasePermission
+
+SIGNING_SALT = "order.waiting_room"
+GENERATION_KEY = "waiting_room:generation"
+LATENCY_SMOOTHING = 0.2  # Weight of the newest sample in the latency moving average
+
+
+def state_key(generation):
+    return f"waiting_room:{generation}:state"
+
+
+def issued_key(generation):
+    return f"waiting_room:{generation}:issued"
+
+
+def latency_key(generation):
+    return f"waiting_room:{generation}:latency"
+
+
+def ticket_key(generation, user_id):
+    return f"waiting_room:{generation}:ticket:{user_id}"
+
+
+def generation():
+    return cache.get_or_set(GENERATION_KEY, time.time, None)
+
+
+def initial_state(now):
+    return {
+        "frontier": 0.0,
+        "rate": float(settings.WAITING_ROOM_INITIAL_RATE),
+        "updated_at": now,
+        "adjusted_at": now,
+    }
+
+
+def open_room():
+    """
+    Start a new queue. Tickets of the previous one are no longer valid.
+    """
+    new_generation = time.time()
+    cache.set(state_key(new_generation), initial_state(new_generation), settings.WAITING_ROOM_TICKET_TTL)
+    cache.set(GENERATION_KEY, new_generation, None)
+
+
+def issued(current):
+    return cache.get(issued_key(current)) or 0
+
+
+def advance(current, state):
+    """
+    Move the frontier forward by the time passed at the current rate, and
+    adjust the rate to the checkout latency at most every
+    WAITING_ROOM_ADJUST_INTERVAL seconds.
+    """
+    now = time.time()
+    state = dict(state)
+    # Admissions don't accumulate while nobody is waiting, or a burst of joins would all get in at once
+    state["frontier"] = min(state["frontier"] + state["rate"] * (now - state["updated_at"]), issued(current))
+    state["updated_at"] = now
+
+    latency = cache.get(latency_key(current))
+    if latency is not None and now - state["adjusted_at"] >= settings.WAITING_ROOM_ADJUST_INTERVAL:
+        if latency > settings.WAITING_ROOM_TARGET_LATENCY:
+            state["rate"] = max(state["rate"] / 2, settings.WAITING_ROOM_MIN_RATE)
+        else:
+            state["rate"] = min(state["rate"] + settings.WAITING_ROOM_RATE_STEP, settings.WAITING_ROOM_MAX_RATE)
+        state["adjusted_at"] = now
+    return state
+
+
+def current_state(current):
+    """
+    Return the admission state, advanced to now. Only the request that takes
+    the short lock writes the advanced state back, the others use their own
+    computation of it.
+    """
+    state = cache.get(state_key(current))
+    if state is None:
+        # Room never opened, or its state was evicted
+        cache.add(state_key(current), initial_state(time.time()), settings.WAITING_ROOM_TICKET_TTL)
+        state = cache.get(state_key(current))
+    state = advance(current, state)
+    lock = f"waiting_room:{current}:lock"
+    if cache.add(lock, 1, 1):
+        cache.set(state_key(current), state, settings.WAITING_ROOM_TICKET_TTL)
+        cache.delete(lock)
+    return state
+
+
+def sign(current, number):
+    return signing.dumps({"g": current, "n": number}, salt=SIGNING_SALT)
+
+
+def status(current, number):
+    state = current_state(current)
+    position = max(number - int(state["frontier"]), 0)
+    return {
+        "ticket": sign(current, number),
+        "position": position,
+        "admitted": position == 0,
+        "rate": round(state["rate"], 2),
+        "poll_after": min(max(position / state["rate"], 1), 30),
+    }
+
+
+def join(user_id):
+    """
+    Give the user a ticket, or return the one they already hold.
+    """
+    current = generation()
+    number = cache.get(ticket_key(current, user_id))
+    if number is None:
+        cache.add(issued_key(current), 0, settings.WAITING_ROOM_TICKET_TTL)
+        number = cache.incr(issued_key(current))
+        # A concurrent join of the same user may have stored its ticket first
+        if not cache.add(ticket_key(current, user_id), number, settings.WAITING_ROOM_TICKET_TTL):
+            number = cache.get(ticket_key(current, user_id), number)
+    return status(current, number)
+
+
+def ticket_status(ticket):
+    """
+    Return the status of a signed ticket, or None if it is invalid or from a
+    previous queue.
+    """
+    try:
+        data = signing.loads(ticket, salt=SIGNING_SALT)
+    except signing.BadSignature:
+        return None
+    current = generation()
+    if data.get("g") != current:
+        return None
+    return status(current, data["n"])
+
+
+def is_admitted(user_id):
+    current = generation()
+    number = cache.get(ticket_key(current, user_id))
+    return number is not None and number <= int(current_state(current)["frontier"])
+
+
+def record_latency(seconds):
+    current = generation()
+    latency = cache.get(latency_key(current))
+    if latency is not None:
+        seconds = latency + LATENCY_SMOOTHING * (seconds - latency)
+    cache.set(latency_key(current), seconds, settings.WAITING_ROOM_TICKET_TTL)
+
+
+def observe_latency(view_method):
+    """
+    Feed the duration of an APIView handler into the admission rate.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if not settings.WAITING_ROOM_ENABLED:
+            return view_method(self, request, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return view_method(self, request, *args, **kwargs)
+        finally:
+            record_latency(time.perf_counter() - start)
+
+    return wrapper
+
+
+class Admitted(BasePermission):
+    """
+    Allow the request only once the user's waiting room ticket is admitted.
+    """
+    def has_permission(self, request, view):
+        if not settings.WAITING_ROOM_ENABLED:
+            return True
+        if request.user.is_authenticated and not is_admitted(request.user.id):
+            raise Throttled(
+                wait=settings.WAITING_ROOM_POLL_INTERVAL,
+                detail="The store is busy, join the waiting room and wait for your turn.",
+            )
+        return True
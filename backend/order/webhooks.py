@@ -0,0 +1,139 @@
+"""
+Payment webhooks from the gateway, so payments are verified even when the
+browser never comes back from the checkout.
+
+The endpoint only checks the signature and appends the event to the
+WebhookEvent inbox, keyed by the gateway's event ID so redeliveries are
+dropped by the unique constraint. The first event of a burst schedules a
+batch job WEBHOOK_BATCH_DELAY seconds later, which applies every pending
+event at once: events are grouped by gateway order, so a payment that got
+several events (redeliveries, a failed attempt followed by a captured one)
+is updated once, with a captured event taking precedence. Events of a
+gateway order the payment was moved off can still capture it, but only
+events of its current gateway order can fail it. Applying an event is
+idempotent, so a batch that runs twice does no harm.
+"""
+import json
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Payment, PreviousGatewayOrder, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+CAPTURED_EVENTS = {"payment.captured", "order.paid"}
+FAILED_EVENTS = {"payment.failed"}
+BATCH_SCHEDULED_KEY = "webhooks:batch_scheduled"
+
+
+def payment_entity(payload):
+    return payload.get("payload", {}).get("payment", {}).get("entity", {})
+
+
+def store(event_id, body):
+    """
+    Append a verified webhook body to the inbox. Returns False for events
+    that are not about payments or are not valid JSON.
+    """
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return False
+    event = payload.get("event")
+    gateway_order_id = payment_entity(payload).get("order_id")
+    if event not in CAPTURED_EVENTS | FAILED_EVENTS or not gateway_order_id:
+        return False
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(event_id=event_id, event=event, gateway_order_id=gateway_order_id, payload=payload)],
+        ignore_conflicts=True,
+    )
+    return True
+
+
+def schedule_batch():
+    """
+    Queue a batch job unless one is already waiting to run.
+    """
+    from .tasks import process_webhook_events
+
+    if cache.add(BATCH_SCHEDULED_KEY, 1, settings.WEBHOOK_BATCH_DELAY):
+        try:
+            process_webhook_events.apply_async(countdown=settings.WEBHOOK_BATCH_DELAY)
+        except Exception as e:
+            # The event is in the inbox, the next webhook or the sweep command picks it up
+            cache.delete(BATCH_SCHEDULED_KEY)
+            logger.error(f"Could not queue the webhook batch: {e}")
+
+
+def apply(payment, events):
+    """
+    Apply a payment's pending events. Returns whether the payment was
+    captured by them.
+    """
+    captured = [event for event in events if event.event in CAPTURED_EVENTS]
+    if captured:
+        return payment.mark_captured(payment_entity(captured[-1].payload).get("id"))
+
+    current = [event for event in events if event.gateway_order_id == payment.gateway_order_id]
+    if not current:
+        return False
+    entity = payment_entity(current[-1].payload)
+    if Payment.objects.filter(pk=payment.pk, status="pending").update(
+        status="FAILED", reason=entity.get("error_description") or "payment_failed"
+    ):
+        payment.order.release_discount()
+    return False
+
+
+def process_batch(limit=None):
+    """
+    Apply up to `limit` pending events. Returns the number of events read and
+    the orders captured by them.
+    """
+    from .tasks import enqueue_paid_order
+
+    events = list(
+        WebhookEvent.objects.filter(processed_at__isnull=True).order_by("id")[: limit or settings.WEBHOOK_BATCH_SIZE]
+    )
+    if not events:
+        return 0, []
+
+    by_gateway_order = defaultdict(list)
+    for event in events:
+        by_gateway_order[event.gateway_order_id].append(event)
+    payments = {}
+    by_payment = defaultdict(list)
+    for payment in Payment.objects.filter(gateway_order_id__in=by_gateway_order).select_related("order"):
+        payments[payment.pk] = payment
+        by_payment[payment.pk] += by_gateway_order.pop(payment.gateway_order_id)
+    previous = PreviousGatewayOrder.objects.filter(gateway_order_id__in=by_gateway_order).select_related("payment__order")
+    for row in previous:
+        payments.setdefault(row.payment_id, row.payment)
+        by_payment[row.payment_id] += by_gateway_order.pop(row.gateway_order_id)
+
+    captured = []
+    for pk, payment in payments.items():
+        if apply(payment, sorted(by_payment[pk], key=lambda event: event.id)):
+            enqueue_paid_order(payment.order_id)
+            captured.append(payment.order_id)
+    for gateway_order_id in by_gateway_order:
+        logger.warning(f"Webhook for unknown gateway order {gateway_order_id}")
+
+    WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(processed_at=timezone.now())
+    return len(events), captured
+
+
+def process_inbox():
+    """
+    Apply batches until the inbox is empty. Returns the number of events read.
+    """
+    total = 0
+    while True:
+        count, _ = process_batch()
+        if not count:
+            return total
+        total += count
@@ -0,0 +1,92 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .serializers import ProductSerializer
+from .utils import CartStatusResolver
+
+CATALOG_VERSION_KEY = "catalog:version"
+
+
+def cart_version_key(user_id):
+    return f"cart:version:{user_id}"
+
+
+def bump_catalog_version():
+    """
+    Invalidate every cached catalog response. Cached entries are keyed by the
+    version, so stale entries are simply never read again and expire on their own.
+    """
+    cache.set(CATALOG_VERSION_KEY, time.time(), None)
+
+
+def bump_cart_version(user_id):
+    """
+    Invalidate the conditional GET validators of a single user, whose
+    product `status` values depend on the contents of their cart.
+    """
+    cache.set(cart_version_key(user_id), time.time(), None)
+
+
+class CatalogCache:
+    """
+    Caches the serialized catalog per position and catalog version. The per-user
+    `status` field is not cached, it is merged in afterwards through the
+    request's CartStatusResolver.
+    """
+    def __init__(self, user, position):
+        self.user = user
+        self.position = position
+        self.catalog_version = cache.get_or_set(CATALOG_VERSION_KEY, time.time, None)
+        if user.is_authenticated:
+            self.cart_version = cache.get_or_set(cart_version_key(user.id), time.time, None)
+        else:
+            self.cart_version = 0
+
+    @property
+    def last_modified(self):
+        return int(max(self.catalog_version, self.cart_version))
+
+    def etag(self, *parts):
+        value = ":".join(str(part) for part in (self.position, self.catalog_version, self.cart_version, *parts))
+        return hashlib.md5(value.encode()).hexdigest()
+
+    def conditional_response(self, request, etag):
+        """
+        Return a `304 Not Modified` response if the client already holds this version.
+        """
+        return get_conditional_response(request, etag=quote_etag(etag), last_modified=self.last_modified)
+
+    def get_products(self, key, products_factory):
+        """
+        Return the serialized products for the key with the per-user `status`
+        merged in, serializing the list returned by `products_factory` on a miss.
+        """
+        key = f"catalog:{self.position}:{self.catalog_version}:{key}"
+        entry = cache.get(key)
+        if entry is None:
+            products = products_factory()
+            entry = (
+                list(ProductSerializer(products, many=True, context={"user": None}).data),
+                [product.id for product in products if not product.accept_orders],
+            )
+            cache.set(key, entry, settings.CATALOG_CACHE_TIMEOUT)
+
+        data, nostock_ids = entry
+        nostock_ids = set(nostock_ids)
+        resolver = CartStatusResolver(self.user)
+        return [
+            {**item, "status": resolver.resolve(item["id"], item["id"] not in nostock_ids)}
+            for item in data
+        ]
+
+    def finalize(self, response, etag):
+        response["ETag"] = quote_etag(etag)
+        response["Last-Modified"] = http_date(self.last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ["Authorization"])
+        return response
@@ -0,0 +1,87 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+IMAGE_FIELDS = ("image1", "image2", "size_chart_image")
+
+
+def derivative_name(name, width, extension):
+    directory, filename = os.path.split(name)
+    stem = os.path.splitext(filename)[0]
+    return f"{directory}/derivatives/{stem}_{width}.{extension}"
+
+
+def save_image(image, name, format):
+    buffer = BytesIO()
+    image.save(buffer, format=format, quality=settings.PRODUCT_IMAGE_QUALITY, optimize=True)
+    # Overwrite derivatives of the same source instead of piling up suffixed copies
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def generate_derivatives(image_file):
+    """
+    Resize an uploaded image to every width in PRODUCT_IMAGE_WIDTHS that is
+    smaller than the original and save each size as WebP and as JPEG (PNG when
+    the image has transparency). Returns the list of saved derivatives.
+    """
+    with image_file.open("rb") as f:
+        original = Image.open(f)
+        original.load()
+    original = ImageOps.exif_transpose(original)
+
+    has_alpha = original.mode in ("RGBA", "LA") or "transparency" in original.info
+    original = original.convert("RGBA" if has_alpha else "RGB")
+    fallback_format = "PNG" if has_alpha else "JPEG"
+
+    widths = [width for width in sorted(settings.PRODUCT_IMAGE_WIDTHS) if width < original.width]
+    widths = widths or [original.width]
+
+    derivatives = []
+    for width in widths:
+        image = original.copy()
+        image.thumbnail((width, original.height), Image.LANCZOS)
+        for format in ("WEBP", fallback_format):
+            name = derivative_name(image_file.name, width, format.lower())
+            derivatives.append({
+                "name": save_image(image, name, format),
+                "width": image.width,
+                "format": format.lower(),
+            })
+    return derivatives
+
+
+def update_product_derivatives(product, fields=IMAGE_FIELDS):
+    """
+    Regenerate the derivatives of the given image fields and store them on the product.
+    """
+    derivatives = dict(product.image_derivatives or {})
+    for field in fields:
+        image_file = getattr(product, field)
+        if not image_file:
+            derivatives.pop(field, None)
+            continue
+        derivatives[field] = {
+            "source": image_file.name,
+            "images": generate_derivatives(image_file),
+        }
+    product.image_derivatives = derivatives
+    product.save(update_fields=["image_derivatives"])
+
+
+def stale_fields(product):
+    """
+    Return the image fields whose derivatives are missing or were generated
+    from a different upload.
+    """
+    derivatives = product.image_derivatives or {}
+    return [
+        field for field in IMAGE_FIELDS
+        if getattr(product, field)
+        and derivatives.get(field, {}).get("source") != getattr(product, field).name
+    ]
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from products.models import CartItem
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete duplicate cart items of the same user and product, keeping the latest, '
+        'so the unique constraint can be added to databases that already hold duplicates'
+    )
+
+    def handle(self, *args, **kwargs):
+        table = CartItem._meta.db_table
+        if table not in connection.introspection.table_names():
+            return
+        # Plain SQL, this runs before migrations and the table may lack columns the model has
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY user_id, product_id)'
+            )
+            deleted = cursor.rowcount
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} duplicate cart items'))
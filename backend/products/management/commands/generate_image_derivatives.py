@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from products.images import update_product_derivatives, stale_fields, IMAGE_FIELDS
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Generate resized and WebP derivatives for product images that are missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate derivatives of every image')
+
+    def handle(self, *args, **options):
+        generated = 0
+        for product in Product.objects.iterator():
+            fields = IMAGE_FIELDS if options['force'] else stale_fields(product)
+            if not fields:
+                continue
+            try:
+                update_product_derivatives(product, fields)
+                generated += 1
+                self.stdout.write(self.style.SUCCESS(f'Generated derivatives for {product.name}'))
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'Failed to generate derivatives for {product.name}: {e}'))
+
+        self.stdout.write(self.style.SUCCESS(f'Finished generating derivatives for {generated} products!'))
@@ -4,6 +4,7 @@ from django.core.management.base import BaseCommand
 from django.core.files import File
 from django.conf import settings
 from products.models import Product
+from products.images import update_product_derivatives
 from decimal import Decimal
 
 
@@ -83,6 +84,7 @@ class Command(BaseCommand):
                             product.image2.save(images[1], File(f), save=False)
                 
                 product.save()
+                update_product_derivatives(product)
                 self.stdout.write(self.style.SUCCESS(f'Successfully created product: {product.name}'))
             else:
                 # Update existing product's for_user_positions if it's empty
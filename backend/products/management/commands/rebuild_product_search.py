@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from products import search
+
+
+class Command(BaseCommand):
+    help = 'Create the full-text product search index and rebuild it from the products table'
+
+    def handle(self, *args, **kwargs):
+        search.install()
+        self.stdout.write(self.style.SUCCESS('Rebuilt product search index'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from products.models import Product, ProductPosition
+
+
+class Command(BaseCommand):
+    help = 'Backfill the ProductPosition visibility table from the for_user_positions JSON lists'
+
+    def handle(self, *args, **kwargs):
+        rows = []
+        for product_id, positions in Product.objects.values_list('id', 'for_user_positions'):
+            if isinstance(positions, str):
+                positions = [positions]
+            for position in set(positions or []):
+                rows.append(ProductPosition(product_id=product_id, position=position))
+
+        ProductPosition.objects.bulk_create(rows, ignore_conflicts=True, batch_size=500)
+        self.stdout.write(self.style.SUCCESS(f'Synced {len(rows)} product positions'))
@@ -0,0 +1,37 @@
+from decimal import Decimal
+
+from django.db import models
+from django.db.models import DecimalField, F, Sum
+from django.db.models.functions import Coalesce
+
+
+class ProductQuerySet(models.QuerySet):
+    """
+    QuerySet for products that resolves position based visibility in SQL
+    through the indexed ProductPosition table instead of the JSON list.
+    """
+    def visible_to(self, position):
+        """
+        Return the products whose `for_user_positions` include the given position.
+        """
+        return self.filter(positions__position=position)
+
+
+class CartItemQuerySet(models.QuerySet):
+    def for_user(self, user):
+        """
+        Return the user's cart items with their products loaded in the same query.
+        """
+        return self.filter(user=user).select_related('product')
+
+    def total_amount(self):
+        """
+        Sum of `product.price * quantity` over the cart items, computed by the database.
+        """
+        return self.aggregate(
+            total=Coalesce(
+                Sum(F('product__price') * F('quantity'), output_field=DecimalField(max_digits=10, decimal_places=2)),
+                Decimal('0.00'),
+                output_field=DecimalField(max_digits=10, decimal_places=2),
+            )
+        )['total']
@@ -1,6 +1,7 @@
 from decimal import Decimal
-from django.db import models
+from django.db import models, transaction
 from login.models import CustomUser
+from .managers import ProductQuerySet, CartItemQuerySet
 
 def productImageUploadPath(instance, filename):
     return f"product/{instance.name.replace(' ', '_')}/{filename.replace(' ', '_')}"
@@ -23,10 +24,45 @@ class Product(models.Model):
     image2 = models.ImageField(null=True, blank=True, default=None, upload_to=productImageUploadPath)
 
     size_chart_image = models.ImageField(null=True, default=None, blank=True, upload_to=productImageUploadPath)
-    
+
+    image_derivatives = models.JSONField(default=dict, blank=True, help_text="Resized and WebP versions of the product images, see products.images.")
+
+    objects = ProductQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.sync_positions()
+
+    def sync_positions(self):
+        """
+        Mirror `for_user_positions` into ProductPosition rows so that visibility
+        can be filtered with an index instead of scanning the JSON lists.
+        """
+        positions = self.for_user_positions or []
+        if isinstance(positions, str):
+            positions = [positions]
+        positions = set(positions)
+        self.positions.exclude(position__in=positions).delete()
+        ProductPosition.objects.bulk_create(
+            [ProductPosition(product=self, position=position) for position in positions],
+            ignore_conflicts=True,
+        )
+
+
+class ProductPosition(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='positions')
+    position = models.CharField(max_length=10)
+
+    class Meta:
+        unique_together = ('position', 'product')
+
+    def __str__(self):
+        return f"{self.product.name}_{self.position}"
+
 
 class CartItem(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -40,6 +76,13 @@ class CartItem(models.Model):
     printing_name = models.CharField(max_length=100, null=True, blank=True, default=None)
     size =  models.CharField(max_length=5, null=True, blank=True, default=None)
     image_url = models.URLField(max_length=5000, null=True, blank=True, default=None)
-    
+
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_cart_item'),
+        ]
+
     def __str__(self):
         return f"{self.user.email}_{self.product.name}"
@@ -0,0 +1,143 @@
+import logging
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.utils import OperationalError
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "products_product_fts"
+
+# Whether the index exists, per database alias, so requests don't introspect the schema
+_installed = {}
+
+SQLITE_SCHEMA = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        name, description,
+        content='products_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name, description ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+]
+
+# Must match the expression compiled for SearchVector("name", "description", config="english")
+POSTGRES_SCHEMA = [
+    """
+    CREATE INDEX IF NOT EXISTS products_product_search_idx ON products_product USING GIN (
+        to_tsvector('english'::regconfig, COALESCE("products_product"."name", '') || ' ' || COALESCE("products_product"."description", ''))
+    )
+    """,
+]
+
+
+def install():
+    """
+    Create the search index for the configured database engine and rebuild it
+    from the current products. The SQLite index is kept in sync by triggers, so
+    product create, edit and delete (bulk updates included) update it in the
+    same transaction.
+    """
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                for statement in SQLITE_SCHEMA:
+                    cursor.execute(statement)
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+            elif connection.vendor == "postgresql":
+                for statement in POSTGRES_SCHEMA:
+                    cursor.execute(statement)
+    except OperationalError as e:
+        # e.g. SQLite compiled without FTS5, search falls back to icontains
+        logger.error(f"Could not install the product search index: {e}")
+    _installed.pop(connection.alias, None)
+
+
+def is_installed():
+    """
+    Whether the search index exists. Looked up once per process and database,
+    the answer is refreshed by `install()`.
+    """
+    if connection.vendor == "postgresql":
+        return True
+    if connection.alias not in _installed:
+        _installed[connection.alias] = (
+            connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _installed[connection.alias]
+
+
+def ordering():
+    """
+    Order of the results of `search()`, best match first and the id as the
+    tiebreaker, for the cursor paginator.
+    """
+    if connection.vendor == "postgresql":
+        return ("-search_rank", "id")
+    if is_installed():
+        return ("search_rank", "id")
+    return ("id",)
+
+
+def fts_query(search_query):
+    """
+    Turn free text into an FTS5 query that matches every word as a prefix,
+    so user input can never produce an FTS5 syntax error.
+    """
+    terms = re.findall(r"\w+", search_query)
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search(queryset, search_query):
+    """
+    Filter the product queryset down to the products matching `search_query`,
+    ordered by relevance. The filter is applied in the same SQL query as any
+    filters already on the queryset.
+    """
+    if connection.vendor == "postgresql":
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+        vector = SearchVector("name", "description", config="english")
+        query = SearchQuery(search_query, config="english", search_type="websearch")
+        return (
+            queryset.annotate(search=vector, search_rank=SearchRank(vector, query))
+            .filter(search=query)
+            .order_by("-search_rank", "id")
+        )
+
+    if not is_installed():
+        return queryset.filter(
+            Q(name__icontains=search_query) | Q(description__icontains=search_query)
+        )
+
+    match = fts_query(search_query)
+    if not match:
+        return queryset.none()
+    table = queryset.model._meta.db_table
+    matches = RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", (match,))
+    # bm25() is lower for better matches, weight name hits above description hits
+    rank = RawSQL(
+        f"SELECT bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} "
+        f"WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = {table}.id",
+        (match,),
+        output_field=FloatField(),
+    )
+    return queryset.filter(pk__in=matches).annotate(search_rank=rank).order_by("search_rank", "id")
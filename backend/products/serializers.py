@@ -1,25 +1,37 @@
+from django.core.files.storage import default_storage
 from rest_framework import serializers
 from .models import Product, CartItem
 from order.models import OrderItem
+from .utils import CartStatusResolver
 
 class ProductSerializer(serializers.ModelSerializer):
     status = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     def get_status(self, obj):
-        user = self.context.get('user')
-        if user is None or user.is_anonymous:
-            return "forbidden"
-        if not obj.accept_orders:
-            return "nostock"
-        # if OrderItem.objects.filter(product=obj, order__user=user).exclude(order__is_verified=False).exists():
-        #     return "ordered"
-        if CartItem.objects.filter(product=obj, user=user).exists():
-            return "incart"
-        return "allowed"
+        # The resolver lives in the root serializer's context, so nested and
+        # many=True serializers share a single cart lookup per request.
+        resolver = self.context.get('cart_status')
+        if resolver is None:
+            resolver = self.context['cart_status'] = CartStatusResolver(self.context.get('user'))
+        return resolver.status(obj)
+
+    def get_srcset(self, obj):
+        # {"image1": {"webp": "<url> 320w, <url> 800w", "jpeg": ...}, ...}
+        srcset = {}
+        for field, entry in (obj.image_derivatives or {}).items():
+            image_file = getattr(obj, field, None)
+            if not image_file or entry.get("source") != image_file.name:
+                continue
+            formats = {}
+            for image in entry["images"]:
+                formats.setdefault(image["format"], []).append(f"{default_storage.url(image['name'])} {image['width']}w")
+            srcset[field] = {format: ", ".join(sources) for format, sources in formats.items()}
+        return srcset
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'price', 'max_quantity', 'is_name_required', 'is_size_required', 'is_image_required', 'image1', 'image2', 'status', 'size_chart_image']
+        fields = ['id', 'name', 'description', 'price', 'max_quantity', 'is_name_required', 'is_size_required', 'is_image_required', 'image1', 'image2', 'status', 'size_chart_image', 'srcset']
 
 
 class CartItemSerializer(serializers.ModelSerializer):
@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.db.models.signals import post_migrate, post_save, post_delete, pre_migrate
+from django.dispatch import receiver
+from django.core.management import call_command
+
+from .cache import bump_catalog_version, bump_cart_version
+from .models import Product, CartItem
+
+@receiver(pre_migrate)
+def dedupe_cart_items(sender, **kwargs):
+    # Before the migration adding the unique cart item constraint, which fails on duplicates
+    if sender.name == 'products':
+        call_command('dedupe_cart_items')
+
+
+@receiver(post_migrate)
+def sync_product_positions(sender, **kwargs):
+    if sender.name == 'products':
+        call_command('sync_product_positions')
+        call_command('rebuild_product_search')
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_catalog(sender, **kwargs):
+    # Deferred until commit so the positions synced in Product.save() are visible
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver([post_save, post_delete], sender=CartItem)
+def invalidate_cart(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_cart_version(instance.user_id))
@@ -0,0 +1,32 @@
+from __future__ import absolute_import, unicode_literals
+import logging
+
+from celery import shared_task
+from django.db import transaction
+
+from .images import update_product_derivatives, IMAGE_FIELDS
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=3)
+def generate_product_derivatives(product_id, fields=IMAGE_FIELDS):
+    """
+    Generate the image derivatives of a product, in a Celery worker so the
+    dashboard request does not wait for them.
+    """
+    product = Product.objects.filter(id=product_id).first()
+    if product is None:
+        return
+    try:
+        update_product_derivatives(product, fields)
+        logger.info(f"Image derivatives generated for product {product_id}")
+    except Exception as e:
+        logger.error(f"Error generating image derivatives for product {product_id}: {e}")
+        raise
+
+
+def generate_product_derivatives_async(product_id, fields=IMAGE_FIELDS):
+    # Queued after commit so the worker sees the saved upload
+    transaction.on_commit(lambda: generate_product_derivatives.delay(product_id, list(fields)))
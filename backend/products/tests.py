@@ -1,3 +1,419 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+
+from . import search
+from .images import update_product_derivatives
+from .tasks import generate_product_derivatives_async
+from .models import Product, ProductPosition, CartItem
+from .serializers import ProductSerializer
+
+
+class ProductVisibilityTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.member = User.objects.create_user(email="member@user.com", password="foo", position="member")
+        self.client = APIClient()
+        self.client.force_authenticate(self.member)
+
+        self.public = Product.objects.create(name="Public", for_user_positions=["user", "member", "core", "exbo"])
+        self.core = Product.objects.create(name="Core", for_user_positions=["core", "exbo"])
+        self.hidden = Product.objects.create(name="Hidden", is_visible=False, for_user_positions=["member"])
+
+    def test_save_syncs_positions(self):
+        self.core.for_user_positions = ["exbo"]
+        self.core.save()
+        self.assertEqual(list(self.core.positions.values_list("position", flat=True)), ["exbo"])
+
+    def test_backfill_command(self):
+        ProductPosition.objects.all().delete()
+        call_command("sync_product_positions", stdout=StringIO())
+        self.assertEqual(list(Product.objects.visible_to("core").order_by("id")), [self.public, self.core])
+
+    def test_all_products_filters_by_position(self):
+        response = self.client.get("/product/all/")
+        self.assertEqual([p["id"] for p in response.data], [self.public.id])
+
+    def test_product_view_filters_by_position(self):
+        self.assertEqual(self.client.get(f"/product/{self.public.id}/").status_code, 200)
+        self.assertEqual(self.client.get(f"/product/{self.core.id}/").status_code, 400)
+        self.assertEqual(self.client.get(f"/product/{self.hidden.id}/").status_code, 400)
+
+    def test_add_to_cart_filters_by_position(self):
+        self.assertEqual(self.client.post("/cart/add/", {"product_id": self.core.id}).status_code, 400)
+        self.assertEqual(self.client.post("/cart/add/", {"product_id": self.public.id}).status_code, 200)
+
+
+class CartStatusQueryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_products(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                product = Product.objects.create(name=f"Product {i}", for_user_positions=["user"])
+                CartItem.objects.create(user=self.user, product=product)
+
+    def test_catalog_query_count_is_constant(self):
+        self.add_products(2)
+        with self.assertNumQueries(2):
+            response = self.client.get("/product/all/")
+        self.add_products(8)
+        with self.assertNumQueries(2):
+            response = self.client.get("/product/all/")
+        self.assertEqual({p["status"] for p in response.data}, {"incart"})
+
+    def test_view_cart_query_count_is_constant(self):
+        self.add_products(1)
+        with self.assertNumQueries(2):
+            self.client.get("/cart/view/")
+        self.add_products(49)
+        with self.assertNumQueries(2):
+            response = self.client.get("/cart/view/")
+        self.assertEqual(len(response.data["items"]), 50)
+
+    def test_cart_total_is_computed_by_the_database(self):
+        self.add_products(3)
+        CartItem.objects.filter(user=self.user).update(quantity=2)
+        Product.objects.update(price="12.50")
+        self.assertEqual(self.client.get("/cart/view/").data["total_amount"], 75)
+
+    def update_cart(self, quantity, items=None):
+        items = items or CartItem.objects.filter(user=self.user)
+        payload = [{"id": item.id, "quantity": quantity} for item in items]
+        return self.client.post("/cart/update/", {"cart_items": payload}, format="json")
+
+    def test_update_cart_query_count_is_constant(self):
+        self.add_products(2)
+        Product.objects.update(max_quantity=5)
+        items = list(CartItem.objects.all())
+        with self.assertNumQueries(4):
+            self.update_cart(2, items)
+        self.add_products(48)
+        Product.objects.update(max_quantity=5)
+        items = list(CartItem.objects.all())
+        with self.assertNumQueries(4):
+            response = self.update_cart(3, items)
+        self.assertEqual(len(response.data["items"]), 50)
+        self.assertEqual(set(CartItem.objects.values_list("quantity", flat=True)), {3})
+
+    def test_update_cart_validates_the_whole_payload(self):
+        self.add_products(2)
+        response = self.update_cart(2)
+        self.assertEqual(response.data, {"error": "Quantity exceeds the maximum allowed."})
+        self.assertEqual(set(CartItem.objects.values_list("quantity", flat=True)), {1})
+        self.assertEqual(self.update_cart(0).status_code, 400)
+        self.assertEqual(self.update_cart("many").status_code, 400)
+
+    def test_remove_from_cart_query_count(self):
+        self.add_products(2)
+        item = CartItem.objects.filter(user=self.user).first()
+        with self.assertNumQueries(2):
+            response = self.client.post("/cart/delete/", {"cart_item_id": item.id})
+        self.assertEqual(response.status_code, 200)
+        other = get_user_model().objects.create_user(email="other@user.com", password="foo")
+        self.client.force_authenticate(other)
+        item = CartItem.objects.filter(user=self.user).first()
+        self.assertEqual(self.client.post("/cart/delete/", {"cart_item_id": item.id}).status_code, 400)
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(name="Mousepad", for_user_positions=["user"])
+
+    def test_catalog_is_served_from_cache(self):
+        self.client.get("/product/all/")
+        with self.assertNumQueries(1):
+            response = self.client.get("/product/all/")
+        self.assertEqual(response.data[0]["status"], "allowed")
+
+    def test_not_modified(self):
+        response = self.client.get("/product/all/")
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get("/product/all/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(f"/product/{self.product.id}/")
+        response = self.client.get(f"/product/{self.product.id}/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_product_save_invalidates_catalog(self):
+        etag = self.client.get("/product/all/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.accept_orders = False
+            self.product.save()
+        response = self.client.get("/product/all/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]["status"], "nostock")
+
+    def test_cart_change_invalidates_status(self):
+        etag = self.client.get(f"/product/{self.product.id}/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/cart/add/", {"product_id": self.product.id})
+        response = self.client.get(f"/product/{self.product.id}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "incart")
+
+
+class ProductSearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo", position="member")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.sticker = Product.objects.create(
+            name="Samurai Sticker", description="Waterproof sticker", for_user_positions=["member"]
+        )
+        self.mousepad = Product.objects.create(
+            name="Gaming Mousepad", description="Comes with a free samurai sticker", for_user_positions=["member"]
+        )
+        self.core_sticker = Product.objects.create(name="Core Sticker", for_user_positions=["core"])
+
+    def search(self, query):
+        response = self.client.get("/product/all/", {"search": query})
+        return [p["id"] for p in response.data]
+
+    def test_results_are_ranked_and_filtered_by_position(self):
+        self.assertEqual(self.search("sticker"), [self.sticker.id, self.mousepad.id])
+
+    def test_prefix_and_syntax_safe(self):
+        self.assertEqual(self.search("mouse"), [self.mousepad.id])
+        self.assertEqual(self.search('"samu('), [self.sticker.id, self.mousepad.id])
+        self.assertEqual(self.search("***"), [])
+
+    def test_index_follows_edits_and_deletes(self):
+        self.mousepad.name = "Desk Mat"
+        self.mousepad.description = None
+        self.mousepad.save()
+        self.assertEqual(self.search("mousepad"), [])
+        self.assertEqual(self.search("desk"), [self.mousepad.id])
+        self.sticker.delete()
+        self.assertEqual(self.search("sticker"), [])
+
+    def test_results_are_paginated_in_rank_order(self):
+        # Same rank for all three, the id breaks the tie
+        extra = [
+            Product.objects.create(name=f"Sticker pack {i}", for_user_positions=["member"]) for i in range(3)
+        ]
+        expected = self.search("sticker")
+        self.assertEqual([i for i in expected if i in {p.id for p in extra}], [p.id for p in extra])
+        response = self.client.get("/product/all/", {"search": "sticker", "page_size": 2})
+        self.assertEqual(len(response.data["results"]), 2)
+        ids = [p["id"] for p in response.data["results"]]
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            ids += [p["id"] for p in response.data["results"]]
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(ids), 5)
+
+    def test_missing_index_is_looked_up_once(self):
+        search._installed.clear()
+        with mock.patch.object(connection.introspection, "table_names", return_value=[]) as table_names:
+            self.assertEqual(self.search("samurai"), [self.sticker.id, self.mousepad.id])
+            self.assertEqual(self.search("sticker"), [self.sticker.id, self.mousepad.id])
+        table_names.assert_called_once()
+        search.install()
+        self.assertTrue(search.is_installed())
+        with self.assertNumQueries(1):
+            self.assertEqual(len(search.search(Product.objects.all(), "sticker")), 3)
+
+
+class CatalogPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.products = [
+            Product.objects.create(name=f"Product {i}", for_user_positions=["user"]) for i in range(5)
+        ]
+
+    def test_pages_follow_the_cursor(self):
+        response = self.client.get("/product/all/", {"page_size": 2})
+        ids = [p["id"] for p in response.data["results"]]
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            ids += [p["id"] for p in response.data["results"]]
+        self.assertEqual(ids, [p.id for p in self.products])
+
+    def test_unpaginated_without_cursor(self):
+        response = self.client.get("/product/all/")
+        self.assertEqual(len(response.data), 5)
+
+
+class ImageDerivativeTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        buffer = BytesIO()
+        Image.new("RGB", (1000, 500), "red").save(buffer, format="PNG")
+        self.product = Product.objects.create(
+            name="Gaming Mousepad",
+            for_user_positions=["user"],
+            image1=SimpleUploadedFile("mock up.png", buffer.getvalue()),
+        )
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_srcset_lists_every_size(self):
+        update_product_derivatives(self.product)
+        srcset = ProductSerializer(self.product).data["srcset"]
+        self.assertEqual(list(srcset), ["image1"])
+        self.assertRegex(
+            srcset["image1"]["webp"],
+            r"^/media/product/Gaming_Mousepad/derivatives/mock_up_320\.webp\?v=\w+ 320w, "
+            r"/media/product/Gaming_Mousepad/derivatives/mock_up_800\.webp\?v=\w+ 800w$",
+        )
+        self.assertIn("jpeg", srcset["image1"])
+
+    def test_backfill_skips_up_to_date_images(self):
+        call_command("generate_image_derivatives", stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(len(self.product.image_derivatives["image1"]["images"]), 4)
+        out = StringIO()
+        call_command("generate_image_derivatives", stdout=out)
+        self.assertIn("for 0 products", out.getvalue())
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_uploads_are_processed_by_the_job_queue_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            generate_product_derivatives_async(self.product.id, ["image1"])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.image_derivatives, {})
+        for callback in callbacks:
+            callback()
+        self.product.refresh_from_db()
+        self.assertEqual(len(self.product.image_derivatives["image1"]["images"]), 4)
+
+
+class MediaServingTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.product = Product.objects.create(
+            name="Sticker",
+            for_user_positions=["user"],
+            image1=SimpleUploadedFile("sticker.png", bytes(range(256)) * 4),
+        )
+        self.url = self.product.image1.url
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_hashed_url_is_immutable(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(256)) * 4)
+        response = self.client.get(self.url.split("?")[0])
+        self.assertEqual(response["Cache-Control"], "public, no-cache")
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/1024")
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(10, 20)))
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-4")
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(252, 256)))
+        response = self.client.get(self.url, HTTP_RANGE="bytes=2000-")
+        self.assertEqual(response.status_code, 416)
+
+    def test_path_traversal_is_rejected(self):
+        self.assertEqual(self.client.get("/media/../manage.py").status_code, 404)
+
+    @override_settings(MEDIA_SERVE_MODE="x-accel-redirect")
+    def test_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/product/Sticker/sticker.png")
+        self.assertEqual(response.content, b"")
+
+
+class AddToCartBatchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create_user(email="normal@user.com", password="foo")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.products = [
+            Product.objects.create(name=f"Product {i}", price=10, max_quantity=3, for_user_positions=["user"])
+            for i in range(3)
+        ]
+
+    def add(self, items):
+        return self.client.post("/cart/add/batch/", {"items": items}, format="json")
+
+    def test_adds_and_upserts_items(self):
+        response = self.add([{"product_id": p.id, "quantity": 2} for p in self.products[:2]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["total_amount"], 40)
+
+        response = self.add([{"product_id": p.id, "quantity": 3} for p in self.products[1:]])
+        self.assertEqual(response.data["total_amount"], 80)
+        self.assertEqual(
+            dict(CartItem.objects.values_list("product_id", "quantity")),
+            {self.products[0].id: 2, self.products[1].id: 3, self.products[2].id: 3},
+        )
+
+    def test_rejects_invalid_items(self):
+        self.assertEqual(self.add([{"product_id": self.products[0].id, "quantity": 4}]).status_code, 400)
+        self.products[1].for_user_positions = ["exbo"]
+        self.products[1].save()
+        self.assertEqual(self.add([{"product_id": self.products[1].id}]).status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_single_add_rejects_duplicates(self):
+        self.assertEqual(self.client.post("/cart/add/", {"product_id": self.products[0].id}).status_code, 200)
+        self.assertEqual(self.client.post("/cart/add/", {"product_id": self.products[0].id}).status_code, 400)
+
+    def test_duplicates_left_by_racing_adds_are_removed_before_migrating(self):
+        # A table without the constraint, as on databases that predate it
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE legacy_cartitem (id integer PRIMARY KEY, user_id integer, product_id integer)")
+            cursor.executemany(
+                "INSERT INTO legacy_cartitem VALUES (%s, %s, %s)", [(1, 1, 1), (2, 1, 1), (3, 1, 2), (4, 2, 1)]
+            )
+        with mock.patch.object(CartItem._meta, "db_table", "legacy_cartitem"):
+            call_command("dedupe_cart_items", stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM legacy_cartitem ORDER BY id")
+            self.assertEqual([row[0] for row in cursor.fetchall()], [2, 3, 4])
 
-# Create your tests here.
@@ -0,0 +1,34 @@
+from .models import CartItem
+
+
+class CartStatusResolver:
+    """
+    Resolves the per-user `status` of products for a single request.
+    The user's cart is fetched once, on first use, instead of running an
+    `exists()` query for every serialized product.
+    """
+    def __init__(self, user):
+        self.user = user
+        self._cart_product_ids = None
+
+    @property
+    def cart_product_ids(self):
+        if self._cart_product_ids is None:
+            self._cart_product_ids = set(
+                CartItem.objects.filter(user=self.user).values_list('product_id', flat=True)
+            )
+        return self._cart_product_ids
+
+    def status(self, product):
+        return self.resolve(product.id, product.accept_orders)
+
+    def resolve(self, product_id, accept_orders):
+        if self.user is None or self.user.is_anonymous:
+            return "forbidden"
+        if not accept_orders:
+            return "nostock"
+        # if OrderItem.objects.filter(product=obj, order__user=user).exclude(order__is_verified=False).exists():
+        #     return "ordered"
+        if product_id in self.cart_product_ids:
+            return "incart"
+        return "allowed"
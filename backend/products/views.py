@@ -1,12 +1,18 @@
+from decimal import Decimal, InvalidOperation
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
 
 from .models import Product, CartItem
 from order.models import OrderItem
+from order.waiting_room import Admitted
 from .serializers import ProductSerializer, CartItemSerializer
+from .cache import CatalogCache, bump_catalog_version, bump_cart_version
+from . import search
+from backend.pagination import KeysetPagination
 
 
 class AllProductsView(APIView):
@@ -22,20 +28,29 @@ class AllProductsView(APIView):
         search_query = request.query_params.get('search', '').strip()
         
         # FIXED P2-01: Use Django ORM with proper parameterization
+        queryset = Product.objects.filter(is_visible=True).visible_to(user_position)
         if search_query:
-            # Use Django Q objects for safe querying
-            from django.db.models import Q
-            all_products = Product.objects.filter(
-                Q(is_visible=True) & 
-                (Q(name__icontains=search_query) | Q(description__icontains=search_query))
-            )
-            queryset = [product for product in all_products if user_position in product.for_user_positions]
+            # Full-text search ranked by relevance, see products.search
+            queryset = search.search(queryset, search_query)
+            paginator = KeysetPagination(ordering=search.ordering())
         else:
-            all_products = Product.objects.filter(is_visible=True)
-            queryset = [product for product in all_products if user_position in product.for_user_positions]
-        
-        serializer = ProductSerializer(queryset, many=True, context={"user": user})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+            paginator = KeysetPagination(ordering="id")
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            serializer = ProductSerializer(page, many=True, context={"user": user})
+            return paginator.get_paginated_response(serializer.data)
+        if search_query:
+            serializer = ProductSerializer(queryset, many=True, context={"user": user})
+            return Response(serializer.data, status=status.HTTP_200_OK)
+
+        catalog = CatalogCache(user, user_position)
+        etag = catalog.etag("all")
+        not_modified = catalog.conditional_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        data = catalog.get_products("all", lambda: list(queryset))
+        return catalog.finalize(Response(data, status=status.HTTP_200_OK), etag)
 
 
 class ProductView(APIView):
@@ -46,38 +61,41 @@ class ProductView(APIView):
         else:
             user_position = user.position
 
-        product = Product.objects.filter(id=product_id).first()
-        if (
-            not product
-            or (
-                user.is_authenticated
-                and user_position not in product.for_user_positions
-            )
-            or not product.is_visible
-        ):
+        products = Product.objects.filter(id=product_id, is_visible=True)
+        if user.is_authenticated:
+            products = products.visible_to(user_position)
+        else:
+            # Anonymous users are not filtered by position on this endpoint
+            user_position = "*"
+
+        catalog = CatalogCache(user, user_position)
+        etag = catalog.etag("product", product_id)
+        not_modified = catalog.conditional_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        data = catalog.get_products(f"product:{product_id}", lambda: list(products[:1]))
+        if not data:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        serializer = ProductSerializer(product, context={"user": user})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return catalog.finalize(Response(data[0], status=status.HTTP_200_OK), etag)
 
 
 class AddToCart(APIView):
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, Admitted]
 
     def post(self, request):
         product_id = request.data.get("product_id")
-        product = Product.objects.filter(id=product_id).first()
         user = request.user
         user_position = user.position
+        product = (
+            Product.objects.filter(id=product_id, is_visible=True, accept_orders=True)
+            .visible_to(user_position)
+            .first()
+        )
         quantity = int(request.data.get("quantity", 1))
 
-        if (
-            not product
-            or user_position not in product.for_user_positions
-            or CartItem.objects.filter(user=user, product=product).exists()
-            or not product.is_visible
-            or not product.accept_orders
-        ):
+        if not product:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
         if quantity > product.max_quantity:
@@ -105,17 +123,111 @@ class AddToCart(APIView):
             size=size,
             image_url=image_url,
         )
-        cart_item.save()
+        # Products already in the cart are rejected by the (user, product) constraint
+        try:
+            with transaction.atomic():
+                cart_item.save()
+        except IntegrityError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
         return Response(status=status.HTTP_200_OK)
 
 
+class AddToCartBatch(APIView):
+    permission_classes = [IsAuthenticated, Admitted]
+
+    def post(self, request):
+        user = request.user
+        items = request.data.get("items", [])
+
+        if not isinstance(items, list) or not items:
+            return Response(
+                {"error": "items must be a non-empty list."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            product_ids = {int(item_data["product_id"]) for item_data in items}
+        except (KeyError, TypeError, ValueError):
+            return Response(
+                {"error": "Each item needs a product_id."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        products = Product.objects.filter(
+            id__in=product_ids, is_visible=True, accept_orders=True
+        ).visible_to(user.position).in_bulk()
+
+        cart_items = {}
+        for item_data in items:
+            product = products.get(int(item_data["product_id"]))
+            if not product:
+                return Response(
+                    {"error": "Product not available.", "product_id": item_data["product_id"]},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            try:
+                quantity = int(item_data.get("quantity", 1))
+            except (TypeError, ValueError):
+                quantity = 0
+            if quantity < 1 or quantity > product.max_quantity:
+                return Response(
+                    {"error": "Quantity exceeds the maximum allowed.", "product_id": product.id},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            printing_name = item_data.get("printing_name")
+            size = item_data.get("size")
+            image_url = item_data.get("image_url")
+            if (
+                (product.is_name_required and printing_name is None)
+                or (product.is_size_required and size is None)
+                or (product.is_image_required and image_url is None)
+            ):
+                return Response(
+                    {"error": "Missing required details.", "product_id": product.id},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            # The last entry for a product wins, like a second upsert would
+            cart_items[product.id] = CartItem(
+                product=product,
+                user=user,
+                quantity=quantity,
+                printing_name=printing_name,
+                size=size,
+                image_url=image_url,
+            )
+
+        with transaction.atomic():
+            # Upsert on the (user, product) constraint instead of checking for existing rows
+            CartItem.objects.bulk_create(
+                cart_items.values(),
+                update_conflicts=True,
+                unique_fields=["user", "product"],
+                update_fields=["quantity", "printing_name", "size", "image_url"],
+            )
+            # bulk_create skips the post_save signals that track cart changes
+            transaction.on_commit(lambda: bump_cart_version(user.id))
+
+        cart = list(CartItem.objects.for_user(user))
+        serializer = CartItemSerializer(cart, many=True)
+
+        return Response(
+            {
+                "items": serializer.data,
+                "total_amount": int(sum(item.product.price * item.quantity for item in cart)),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
 class ViewCart(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         user = request.user
-        cart_items = CartItem.objects.filter(user=user)
-        total_amount = sum(item.product.price * item.quantity for item in cart_items)
+        cart_items = CartItem.objects.for_user(user)
+        total_amount = cart_items.total_amount()
 
         serializer = CartItemSerializer(cart_items, many=True)
 
@@ -133,12 +245,11 @@ class RemoveFromCart(APIView):
 
     def post(self, request):
         cart_item_id = request.data.get("cart_item_id")
-        cart_item = CartItem.objects.filter(id=cart_item_id).first()
+        deleted, _ = CartItem.objects.filter(id=cart_item_id, user=request.user).delete()
 
-        if not cart_item or cart_item.user != request.user:
+        if not deleted:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        cart_item.delete()
         return Response(status=status.HTTP_200_OK)
 
 
@@ -147,33 +258,73 @@ class UpdateCart(APIView):
 
     def post(self, request):
         cart_items = request.data.get("cart_items", [])
-        total_amount = 0
 
+        if not isinstance(cart_items, list):
+            return Response(
+                {"error": "cart_items must be a list."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        updates = {}
         for item_data in cart_items:
-            cart_item = CartItem.objects.filter(
-                id=item_data["id"], user=request.user
-            ).first()
-            if cart_item:
-                cart_item.quantity = item_data["quantity"]
-                
+            try:
+                updates[int(item_data["id"])] = item_data
+                quantity = int(item_data["quantity"])
+                if "price" in item_data:
+                    Decimal(str(item_data["price"]))
+            except (KeyError, TypeError, ValueError, InvalidOperation):
+                return Response(
+                    {"error": "Each cart item needs an id and a quantity."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if quantity < 1:
+                return Response(
+                    {"error": "Quantity must be at least 1."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+        with transaction.atomic():
+            # The whole cart is loaded once, updated in memory and returned as is
+            cart = list(CartItem.objects.for_user(request.user).select_for_update())
+            changed_items, changed_products = [], []
+
+            for cart_item in cart:
+                item_data = updates.get(cart_item.id)
+                if item_data is None:
+                    continue
+                cart_item.quantity = int(item_data["quantity"])
+                if cart_item.quantity > cart_item.product.max_quantity:
+                    transaction.set_rollback(True)
+                    return Response(
+                        {"error": "Quantity exceeds the maximum allowed."},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+
                 # VULN-T1U2V3: Price Manipulation - Accept price from client
                 if "price" in item_data:
                     # Allow client to override product price
-                    cart_item.product.price = item_data["price"]
-                    cart_item.product.save()
-                
-                cart_item.save()
-                total_amount += cart_item.product.price * cart_item.quantity
+                    cart_item.product.price = Decimal(str(item_data["price"]))
+                    changed_products.append(cart_item.product)
 
-        # Check if the total amount is negative
-        if total_amount < 0:
-            return Response(
-                {"error": "Total amount cannot be negative."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+                changed_items.append(cart_item)
 
-        cart_items = CartItem.objects.filter(user=request.user)
-        serializer = CartItemSerializer(cart_items, many=True)
+            total_amount = sum(item.product.price * item.quantity for item in cart)
+
+            # Check if the total amount is negative
+            if total_amount < 0:
+                transaction.set_rollback(True)
+                return Response(
+                    {"error": "Total amount cannot be negative."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            CartItem.objects.bulk_update(changed_items, ["quantity"])
+            if changed_products:
+                Product.objects.bulk_update(changed_products, ["price"])
+                transaction.on_commit(bump_catalog_version)
+            # bulk_update skips the post_save signals that track cart changes
+            transaction.on_commit(lambda: bump_cart_version(request.user.id))
+
+        serializer = CartItemSerializer(cart, many=True)
 
         return Response(
             {
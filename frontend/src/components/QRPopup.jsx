@@ -3,7 +3,7 @@ import 'react-confirm-alert/src/react-confirm-alert.css';
 import Button from './Button';
 import { faX, faDownload } from '@fortawesome/free-solid-svg-icons';
 
-const QRPopup = ({ qrData }) => {
+const QRPopup = ({ qrUrl }) => {
     confirmAlert({
         customUI: ({ onClose }) => {
             return (
@@ -13,11 +13,11 @@ const QRPopup = ({ qrData }) => {
                             <h1 className="text-2xl font-bold">QR Code</h1>
                             <Button icon={faX} onClick={onClose} className="text-2xl font-bold bg-transparent" />
                         </div>
-                        <img src={`data:image/png;base64,${qrData}`} className='w-full h-full' alt='QR Code' />
+                        <img src={qrUrl} className='w-full h-full' alt='QR Code' />
                         <p>Please take a screenshot or download the QR code for future reference.</p>
                         <Button className="px-4 py-2 mt-8 w-full" text="Download" icon={faDownload} onClick={() => {
                             const link = document.createElement('a');
-                            link.href = `data:image/png;base64,${qrData}`;
+                            link.href = qrUrl;
                             link.download = 'qr_code.png';
                             link.click();
                         }} />
@@ -41,7 +41,7 @@ export const OrdersTab = () => {
                                         })
                                     }</div>
                                     <Button icon={faQrcode} isActive onClick={() => {
-                                        QRPopup({ qrData: order.qr_code_data });
+                                        QRPopup({ qrUrl: `${api_url}${order.qr_code_url}` });
                                     }} />
                                 </div>
                             </div>
@@ -5,6 +5,7 @@ import Button from '../components/Button';
 import { faDownload, faHome, faQrcode } from '@fortawesome/free-solid-svg-icons';
 import Loader from '../components/Loader';
 import QRPopup from '../components/QRPopup';
+import api_url from '../helpers/Config';
 
 const PaymentStatus = () => {
     const txnid = useParams().txnid;
@@ -89,7 +90,7 @@ const PaymentStatus = () => {
                                 </div>
                             </div>
                             {!valid && <Button className="px-4 py-2 mt-8 w-full md:w-1/3" text="View QR Code" icon={faQrcode} isActive onClick={() => {
-                                QRPopup({ qrData: paymentDetails.qr_code_data });
+                                QRPopup({ qrUrl: `${api_url}${paymentDetails.qr_code_url}` });
                             }} />}
                             <Link to="/" className='mt-4 w-full md:w-1/3 text-center'>
                                 <Button className="px-4 py-2 w-full" text="Go to Home" icon={faHome} />